@@ -1,17 +1,45 @@
 from flask import Flask, jsonify, request
 from waitress import serve
 
+from database.database import Database
+from database.migrations import MigrationRunner
+
 from models.device_model import DeviceSchema
 from models.octoprint_model import OctoPrintSchema
 from models.user_model import UserSchema
+from models.email_outbox_model import EmailOutboxSchema
+from models.token_model import TokenSchema
 
 from services.login_service import LoginService
+from services.auth_cache_service import auth_cache
+from services.token_service import token_service
+from services.rate_limiter_service import rate_limiter
+from services.email_outbox_service import email_outbox
+from devices_manager.session_pool import session_pool
+from devices_manager.health_tracker import health_tracker
+from devices_manager.state_store import state_store
+from devices_manager.single_flight import single_flight
+from devices_manager.command_queue import command_queue
+from services.status_poller_service import status_poller
+from services.device_registry_service import device_registry
 from services.device_service import DeviceService
+from services.shard_service import shard_service
+from services.shared_cache_service import shared_cache
+from services.state_ingest_service import state_ingest
 
 DOMAIN = "djd-server.ddns.net"
 
+# DB connections each process opens at startup
+DEFAULT_WARM_UP_CONNECTIONS = 2
+
+# name -> Callable that returns the stats of an optional part of the server, e.g. the async mode
+extra_stats = {}
+
 app = Flask(__name__)
 
+rate_limiter.init_app(app, lambda: make_response(False, "Too many requests", 429))
+Database.init_app(app, lambda: make_response(False, "Error", 500))
+
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -38,13 +66,9 @@ def otp_request():
         email = credential['email']
         api_key = credential['api_key']
 
-        login_service = LoginService()
+        res = LoginService().send_otp_code(email, api_key)
 
-        if login_service.user_exists(email, api_key):
-            if login_service.send_otp_code(email, api_key):
-                return make_response(True, "Email send", 200)
-            return make_response(False, "Error when send OTP code", 500)
-        return make_response(False, "Not valid user", 400)
+        return make_response(res["valid"], res["info"], res["code"])
     else:
         return make_response(False, "Not valid input", 400)
 
@@ -60,7 +84,9 @@ def login():
         login_service = LoginService()
 
         if login_service.user_logged(email, api_key, otp_code):
-            return make_response(True, "User logged", 200)
+            token, expires_in = token_service.issue(api_key)
+
+            return make_response(True, {"token": token, "expires_in": expires_in}, 200)
         else:
             login_service.clear_otp(api_key, otp_code)
 
@@ -69,6 +95,16 @@ def login():
         return make_response(False, "Not valid input", 400)
 
 
+@app.route("/logout", methods=["POST"])
+def logout():
+    data = request.get_json(force=True)
+
+    if "token" in data and token_service.revoke(data["token"]):
+        return make_response(True, "User logged out", 200)
+
+    return make_response(False, "Not valid token", 400)
+
+
 @app.route("/change_password", methods=["POST"])
 def change_password():
     # TODO
@@ -85,17 +121,50 @@ def reset_password():
 def device():
     data = request.get_json(force=True)
 
-    if LoginService().check_api_key(data["api_key"]):
-        res = DeviceService().manager(data)
+    if LoginService.is_authenticated(data):
+        if "actions" in data:
+            res = DeviceService().batch(data["actions"])
+        else:
+            res = DeviceService().manager(data)
 
         if res["valid"]:
             return make_response(True, res["info"], res['code'])
 
         return make_response(False, res["info"], res['code'])
 
+    return make_response(False, "Not valid API KEY or token", 400)
+
+
+@app.route("/state", methods=["POST"])
+def state():
+    # The signature is of the raw body, as sent by the device
+    res = state_ingest.ingest(request.get_data(), request.headers.get("X-Signature", ""))
+
+    return make_response(res["valid"], res["info"], res["code"])
+
+
+@app.route("/stats", methods=["POST"])
+def stats():
+    data = request.get_json(force=True)
+
+    if LoginService.is_authenticated(data):
+        return make_response(True, {"db_pool": Database.get_stats(), "db_statements": Database.get_statement_stats(), "db_replicas": Database.get_replica_stats(), "auth_cache": auth_cache.get_stats(), "tokens": token_service.get_stats(), "rate_limiter": rate_limiter.get_stats(), "email_outbox": email_outbox.get_stats(), "device_sessions": session_pool.get_stats(), "device_health": health_tracker.get_stats(), "device_state": state_store.get_stats(), "status_poller": status_poller.get_stats(), "device_reads": single_flight.get_stats(), "device_commands": command_queue.get_stats(), "device_registry": device_registry.get_stats(), "shards": shard_service.get_stats(), "shared_cache": shared_cache.get_stats(), "state_ingest": state_ingest.get_stats(), **{name: get_stats() for name, get_stats in extra_stats.items()}}, 200)
+
     return make_response(False, "Not valid API KEY", 400)
 
 
+def register_stats(name, get_stats):
+    """
+    Add a section to /stats
+
+    :param name: Name of the section
+    :param get_stats: Callable that returns the stats
+    :return: void
+    """
+
+    extra_stats[name] = get_stats
+
+
 def make_response(is_valid, info, error_code):
     """
     Make response for the client
@@ -109,10 +178,60 @@ def make_response(is_valid, info, error_code):
     return jsonify({'valid': is_valid, 'info': info}), error_code
 
 
-if __name__ == "__main__":
+def init_schema():
+    """
+    Create the schemas and apply the migrations, once before any process serves requests
+
+    :return: void
+    """
+
     DeviceSchema()
     OctoPrintSchema()
     UserSchema()
+    EmailOutboxSchema()
+    TokenSchema()
+    MigrationRunner().run()
+
+
+def warm_up(connections=DEFAULT_WARM_UP_CONNECTIONS):
+    """
+    Start the background work and fill the caches of this process, before it serves requests
+
+    :param connections: DB connections opened ahead of the first requests
+    :return: void
+    """
+
+    if shared_cache.is_enabled():
+        auth_cache.use_shared(shared_cache.auth)
+        device_registry.use_shared(shared_cache.devices)
+        state_ingest.use_shared(shared_cache.reports)
+
+    # Send the emails left in the outbox by a previous run
+    email_outbox.start()
+    # Ready for the actions of the devices of this worker before any request is served
+    shard_service.start(lambda item: DeviceService(use_db=False).run_owned(item))
+    token_service.get_keys()
+    token_service.start()
+    device_registry.load()
+    state_ingest.start()
+    status_poller.start()
+    Database.warm_up(connections)
+
+
+def startup():
+    """
+    Prepare a single process server
+
+    :return: void
+    """
+
+    init_schema()
+    warm_up()
+
+
+if __name__ == "__main__":
+    startup()
 
     app.run(host='0.0.0.0', debug=True)  # For development
-    # serve(app, port=5000, threads=6)
+    # serve(app, port=5000, threads=6)  # Keep "pool_size" in credentials.json >= threads
+    # python asgi.py  # Async mode, see README
@@ -0,0 +1,219 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+import json
+import sys
+
+import uvicorn
+
+from app import app, startup, register_stats
+from devices_manager.async_device_manager import async_session_pool, async_single_flight
+from services.async_device_service import async_device_service
+from services.rate_limiter_service import rate_limiter
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+# Threads running the Flask app for the requests not served on the event loop, keep "pool_size" in credentials.json >= threads
+DEFAULT_WSGI_THREADS = 6
+
+wsgi_executor = ThreadPoolExecutor(max_workers=DEFAULT_WSGI_THREADS, thread_name_prefix="wsgi")
+
+register_stats("async_device_sessions", async_session_pool.get_stats)
+register_stats("async_device_reads", async_single_flight.get_stats)
+
+
+async def read_body(receive):
+    """
+    Read the whole body of a request
+
+    :param receive: ASGI receive
+    :return: bytes
+    """
+
+    chunks = []
+
+    while True:
+        message = await receive()
+
+        if message["type"] == "http.disconnect":
+            break
+
+        chunks.append(message.get("body", b""))
+
+        if not message.get("more_body", False):
+            break
+
+    return b"".join(chunks)
+
+
+async def send_response(send, status, headers, body):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, is_valid, info, code):
+    """
+    Send the same JSON as make_response of app.py
+
+    :param send: ASGI send
+    :param is_valid: The success of the operation
+    :param info: Some information
+    :param code: HTML code
+    :return: void
+    """
+
+    body = json.dumps({'valid': is_valid, 'info': info}).encode()
+
+    await send_response(send, code, [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())], body)
+
+
+def make_environ(scope, body):
+    """
+    Make the WSGI environ of an ASGI request
+
+    :param scope: ASGI scope
+    :param body: Body of the request
+    :return: dict()
+    """
+
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"],
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+        else:
+            key = "HTTP_" + name
+            environ[key] = environ[key] + "," + value if key in environ else value
+
+    return environ
+
+
+def call_wsgi(environ):
+    """
+    Run the Flask app on a request, it blocks
+
+    :param environ: WSGI environ
+    :return: tuple(status, headers, body)
+    """
+
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers]
+
+    result = app(environ, start_response)
+
+    try:
+        body = b"".join(result)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+
+    return response["status"], response["headers"], body
+
+
+async def serve_device(scope, data, send):
+    """
+    Serve a /device request on the event loop, with the checks of the Flask app
+
+    :param scope: ASGI scope
+    :param data: Body of the request
+    :param send: ASGI send
+    :return: void
+    """
+
+    client = scope.get("client") or ("", 0)
+
+    if rate_limiter.allow(rate_limiter.get_checks("/device", client[0], data)) is not None:
+        return await send_json(send, False, "Too many requests", 429)
+
+    if not await async_device_service.is_authenticated(data):
+        return await send_json(send, False, "Not valid API KEY or token", 400)
+
+    try:
+        res = await async_device_service.manager(data)
+    except Exception:
+        logger.exception("asgi -> serve_device")
+
+        return await send_json(send, False, "Error", 500)
+
+    await send_json(send, res["valid"], res["info"], res["code"])
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await async_session_pool.close()
+            await send({"type": "lifespan.shutdown.complete"})
+
+            return
+
+
+async def application(scope, receive, send):
+    """
+    ASGI app: the /device actions that contact devices are served on the event loop,
+    every other request is served by the Flask app on a thread
+
+    :param scope: ASGI scope
+    :param receive: ASGI receive
+    :param send: ASGI send
+    :return: void
+    """
+
+    if scope["type"] == "lifespan":
+        return await lifespan(receive, send)
+
+    if scope["type"] != "http":
+        return
+
+    body = await read_body(receive)
+
+    if scope["method"] == "POST" and scope["path"] == "/device":
+        try:
+            data = json.loads(body)
+        except ValueError:
+            data = None
+
+        if async_device_service.can_handle(data):
+            return await serve_device(scope, data, send)
+
+    status, headers, body = await asyncio.get_running_loop().run_in_executor(wsgi_executor, call_wsgi, make_environ(scope, body))
+
+    await send_response(send, status, headers, body)
+
+
+if __name__ == "__main__":
+    startup()
+
+    uvicorn.run(application, host='0.0.0.0', port=5000, lifespan="on")
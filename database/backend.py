@@ -0,0 +1,109 @@
+import sqlite3
+
+try:
+    import mysql.connector as mysql
+except ImportError:  # Not needed by SQLite deployments
+    mysql = None
+
+# Errors raised by the queries of the models, whatever the backend
+DatabaseError = (sqlite3.Error,) + ((mysql.Error,) if mysql is not None else ())
+
+
+class Backend:
+    """
+    Provide the storage specific operations used by Database and by the migrations
+    """
+
+    name = None
+
+    def __init__(self, credential):
+        """
+        :param credential: DB section of credentials.json
+        """
+
+        self.credential = credential
+
+    def connect(self):
+        """
+        Open a new raw connection, queries use the %s placeholder of MariaDB
+
+        :return: raw_conn
+        """
+
+        raise NotImplementedError
+
+    def ping(self, raw_conn):
+        """
+        Raise if a raw connection is not usable anymore
+
+        :param raw_conn: The raw connection
+        :return: void
+        """
+
+        raise NotImplementedError
+
+    def prepare(self, raw_conn):
+        """
+        Open a cursor that prepares its statement on the server once and then only sends the params
+
+        :param raw_conn: The raw connection
+        :return: cursor | None if the backend does not support it
+        """
+
+        return None
+
+    def get_replica_lag(self, conn):
+        """
+        Get how many seconds a replica is behind its primary
+
+        :param conn: Connection to the replica
+        :return: Seconds | None if replication is not running
+        """
+
+        return None
+
+    def lock(self, conn, name, timeout):
+        """
+        Take a lock shared by all the processes using the DB
+
+        :param conn: Connection used by the caller
+        :param name: Name of the lock
+        :param timeout: Max seconds to wait for the lock
+        :return: True | False
+        """
+
+        raise NotImplementedError
+
+    def unlock(self, conn, name):
+        """
+        Release a lock taken by lock()
+
+        :param conn: Connection used by the caller
+        :param name: Name of the lock
+        :return: void
+        """
+
+        raise NotImplementedError
+
+
+def get_backend(credential):
+    """
+    Build the backend selected by "backend" in the DB section of credentials.json
+
+    :param credential: DB section of credentials.json
+    :return: Backend
+    """
+
+    name = credential.get("backend", "mariadb")
+
+    if name == "sqlite":
+        from database.sqlite_backend import SQLiteBackend
+
+        return SQLiteBackend(credential)
+
+    if name == "mariadb":
+        from database.mariadb_backend import MariaDBBackend
+
+        return MariaDBBackend(credential)
+
+    raise ValueError("Unknown DB backend \"" + str(name) + "\"")
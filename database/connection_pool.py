@@ -0,0 +1,277 @@
+import threading
+import time
+
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+DEFAULT_POOL_SIZE = 6
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_PING_INTERVAL = 30
+
+
+class PoolError(Exception):
+    """
+    Raised when no connection can be borrowed from the pool
+    """
+
+
+class PooledConnection:
+    """
+    Wrap a raw connection borrowed from a ConnectionPool.
+    Calling close() gives the connection back to the pool instead of closing it
+    """
+
+    def __init__(self, pool, raw_conn):
+        self.pool = pool
+        self.raw_conn = raw_conn
+
+    def __getattr__(self, item):
+        if self.raw_conn is None:
+            raise PoolError("Connection already returned to the pool")
+
+        return getattr(self.raw_conn, item)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Give the connection back to the pool
+
+        :return: void
+        """
+
+        if self.raw_conn is not None:
+            raw_conn = self.raw_conn
+            self.raw_conn = None
+
+            self.pool.release(raw_conn)
+
+
+class ConnectionPool:
+    """
+    Provide a bounded, thread-safe pool of DB connections
+    """
+
+    def __init__(self, factory, ping, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT, ping_interval=DEFAULT_PING_INTERVAL, name="db"):
+        """
+        :param factory: Callable that opens a new raw connection
+        :param ping: Callable that raises if a raw connection is not usable anymore
+        :param size: Max number of open connections
+        :param timeout: Max seconds to wait for a free connection
+        :param ping_interval: Connections idle for more seconds than this are checked before being borrowed
+        :param name: Name used in logs and stats
+        """
+
+        self.factory = factory
+        self.ping = ping
+        self.size = size
+        self.timeout = timeout
+        self.ping_interval = ping_interval
+        self.name = name
+
+        # LIFO keeps the most recently used connections hot and lets the others age out
+        self.idle = []
+        self.lock = threading.Lock()
+        # Notified when a connection is given back or a slot is freed
+        self.available = threading.Condition(self.lock)
+
+        self.created = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.health_check_failures = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def get_conn(self):
+        """
+        Borrow a connection, waiting up to timeout seconds if the pool is exhausted
+
+        :return: PooledConnection | PoolError
+        """
+
+        start = time.monotonic()
+        raw_conn, last_used, waited = self._acquire()
+        raw_conn = self._open() if raw_conn is None else self._check(raw_conn, last_used)
+        wait_time = time.monotonic() - start
+
+        with self.lock:
+            self.checkouts += 1
+            self.waits += int(waited)
+            self.wait_time_total += wait_time
+            self.wait_time_max = max(self.wait_time_max, wait_time)
+
+        return PooledConnection(self, raw_conn)
+
+    def release(self, raw_conn):
+        """
+        Give back a borrowed connection, discarding any uncommitted work
+
+        :param raw_conn: The raw connection
+        :return: void
+        """
+
+        try:
+            raw_conn.rollback()
+        except Exception:
+            logger.exception("connection_pool -> release (" + self.name + ")")
+
+            self._close_quietly(raw_conn)
+
+            with self.available:
+                self.in_use -= 1
+                self._free_slot()
+
+            return
+
+        with self.available:
+            self.idle.append((raw_conn, time.monotonic()))
+            self.in_use -= 1
+            self.available.notify()
+
+    def _acquire(self):
+        """
+        Take an idle connection, open a new one if the pool is not full, otherwise wait for one of them
+
+        :return: tuple(raw_conn, last_used, waited), raw_conn is None when a new connection must be opened
+        """
+
+        deadline = time.monotonic() + self.timeout
+        waited = False
+
+        with self.available:
+            while not self.idle and self.created >= self.size:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    self.timeouts += 1
+
+                    break
+
+                waited = True
+                self.available.wait(remaining)
+            else:
+                self._mark_borrowed()
+
+                if self.idle:
+                    raw_conn, last_used = self.idle.pop()
+
+                    return raw_conn, last_used, waited
+
+                self.created += 1
+
+                return None, None, waited
+
+        logger.error("connection_pool -> pool \"" + self.name + "\" exhausted")
+
+        raise PoolError("No connection available in pool \"" + self.name + "\"")
+
+    def _mark_borrowed(self):
+        self.in_use += 1
+        self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def _check(self, raw_conn, last_used):
+        """
+        Health check of a connection that stayed idle for more than ping_interval
+
+        :param raw_conn: The raw connection
+        :param last_used: When the connection was given back, None if just opened
+        :return: raw_conn
+        """
+
+        if last_used is None or time.monotonic() - last_used < self.ping_interval:
+            return raw_conn
+
+        try:
+            self.ping(raw_conn)
+
+            return raw_conn
+        except Exception:
+            logger.warning("connection_pool -> stale connection replaced (" + self.name + ")")
+
+            with self.lock:
+                self.health_check_failures += 1
+
+            self._close_quietly(raw_conn)
+
+            return self._open()
+
+    def _open(self):
+        """
+        Open a new raw connection for a slot already counted as created and in use
+
+        :return: raw_conn
+        """
+
+        try:
+            return self.factory()
+        except Exception:
+            with self.available:
+                self.in_use -= 1
+                self._free_slot()
+
+            raise
+
+    def _free_slot(self):
+        """
+        Forget a discarded connection and wake up a waiting thread, that can open a new one.
+        Must be called holding the lock
+
+        :return: void
+        """
+
+        self.created -= 1
+        self.available.notify()
+
+    @staticmethod
+    def _close_quietly(raw_conn):
+        try:
+            raw_conn.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        """
+        Close every idle connection
+
+        :return: void
+        """
+
+        with self.available:
+            idle = self.idle
+            self.idle = []
+
+            for _ in idle:
+                self._free_slot()
+
+        for raw_conn, _ in idle:
+            self._close_quietly(raw_conn)
+
+    def get_stats(self):
+        """
+        Get usage and wait time of the pool
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {
+                "name": self.name,
+                "size": self.size,
+                "created": self.created,
+                "in_use": self.in_use,
+                "max_in_use": self.max_in_use,
+                "idle": len(self.idle),
+                "checkouts": self.checkouts,
+                "waits": self.waits,
+                "timeouts": self.timeouts,
+                "health_check_failures": self.health_check_failures,
+                "wait_time_avg_ms": round(self.wait_time_total * 1000 / self.checkouts, 3) if self.checkouts else 0,
+                "wait_time_max_ms": round(self.wait_time_max * 1000, 3)
+            }
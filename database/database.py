@@ -1,18 +1,229 @@
-import mysql.connector as mysql
+import threading
 import json
 
+from database.backend import get_backend
+from database.connection_pool import ConnectionPool, DEFAULT_POOL_SIZE, DEFAULT_POOL_TIMEOUT, DEFAULT_PING_INTERVAL
+from database.replica_set import Replica, ReplicaSet, DEFAULT_MAX_LAG
+from database.statement_cache import StatementConnection, DEFAULT_MAX_STATEMENTS, statement_stats
+from database.unit_of_work import UnitOfWork
+
 
 class Database:
     """
-    Provide methods fom MariaDB connection
+    Provide methods fom DB connection, to MariaDB or to an embedded SQLite file
     """
 
+    backend = None
+    pool = None
+    replicas = None
+    replicas_loaded = False
+    pool_lock = threading.Lock()
+
     def __init__(self):
+        self.pool = self.get_pool()
+
+    @staticmethod
+    def load_credential():
+        """
+        Read DB section of credentials.json
+
+        :return: dict()
+        """
+
         with open('credentials.json') as json_file:
             file = json.load(json_file)
-            self.credential = file["db"]
-        
-        self.conn = mysql.connect(host=self.credential["host"], database=self.credential["db_name"], user=self.credential["user"], password=self.credential["user_password"])
+
+        return file["db"]
+
+    @classmethod
+    def get_backend(cls):
+        """
+        Get the backend selected by credentials.json, creating it on first use
+
+        :return: Backend
+        """
+
+        if cls.backend is None:
+            with cls.pool_lock:
+                if cls.backend is None:
+                    cls.backend = get_backend(cls.load_credential())
+
+        return cls.backend
+
+    @classmethod
+    def get_pool(cls):
+        """
+        Get the process wide connection pool, creating it on first use
+
+        :return: ConnectionPool
+        """
+
+        if cls.pool is None:
+            backend = cls.get_backend()
+
+            with cls.pool_lock:
+                if cls.pool is None:
+                    cls.pool = cls.make_pool(backend, cls.load_credential(), "primary")
+
+        return cls.pool
+
+    @staticmethod
+    def make_pool(backend, credential, name, timeout=None):
+        """
+        Make a connection pool configured by a DB section of credentials.json
+
+        :param backend: Backend that opens the connections
+        :param credential: DB section of credentials.json
+        :param name: Name of the pool
+        :param timeout: Max seconds to wait for a free connection, None to read "pool_timeout"
+        :return: ConnectionPool
+        """
+
+        max_statements = credential.get("statement_cache_size", DEFAULT_MAX_STATEMENTS)
+
+        return ConnectionPool(
+            factory=lambda: StatementConnection(backend.connect(), backend.prepare, max_statements),
+            ping=backend.ping,
+            size=credential.get("pool_size", DEFAULT_POOL_SIZE),
+            timeout=credential.get("pool_timeout", DEFAULT_POOL_TIMEOUT) if timeout is None else timeout,
+            ping_interval=credential.get("pool_ping_interval", DEFAULT_PING_INTERVAL),
+            name=name
+        )
+
+    @classmethod
+    def get_replicas(cls):
+        """
+        Get the replicas listed in "replicas" of credentials.json, creating their pools on first use.
+        Each replica only lists the keys that differ from the primary, e.g. "host" and "db_port"
+
+        :return: ReplicaSet | None if there are no replicas
+        """
+
+        if not cls.replicas_loaded:
+            with cls.pool_lock:
+                if not cls.replicas_loaded:
+                    credential = cls.load_credential()
+                    replicas = []
+
+                    for i, replica_credential in enumerate(credential.get("replicas", [])):
+                        replica_credential = {**credential, **replica_credential}
+                        backend = get_backend(replica_credential)
+                        name = "replica-" + str(i)
+
+                        # A busy replica must not make reads wait, they go to the primary instead
+                        replicas.append(Replica(name, backend, cls.make_pool(backend, replica_credential, name, timeout=0)))
+
+                    if replicas:
+                        cls.replicas = ReplicaSet(replicas, max_lag=credential.get("replica_max_lag", DEFAULT_MAX_LAG))
+
+                    cls.replicas_loaded = True
+
+        return cls.replicas
 
     def get_conn(self):
-        return self.conn
+        """
+        Get the connection of the current request unit of work,
+        otherwise borrow one from the pool (close() gives it back)
+
+        :return: SharedConnection | PooledConnection
+        """
+
+        unit_of_work = UnitOfWork.current()
+
+        if unit_of_work is not None:
+            return unit_of_work.get_conn()
+
+        return self.pool.get_conn()
+
+    @staticmethod
+    def on_commit(callback):
+        """
+        Run a callback once the current request work is committed,
+        right away outside of a request since models commit on their own
+
+        :param callback: Callable without arguments
+        :return: void
+        """
+
+        unit_of_work = UnitOfWork.current()
+
+        if unit_of_work is not None:
+            unit_of_work.on_commit(callback)
+        else:
+            callback()
+
+    @classmethod
+    def init_app(cls, app, error_response):
+        """
+        Make every request of the app share one connection and one transaction,
+        reads go to the replicas until the request writes
+
+        :param app: Flask app
+        :param error_response: Callable that returns the response sent when the final commit fails
+        :return: void
+        """
+
+        UnitOfWork.init_app(app, cls.get_pool, error_response, cls.get_replicas)
+
+    @classmethod
+    def warm_up(cls, connections):
+        """
+        Open connections to the primary and to the replicas before the first requests need them
+
+        :param connections: Number of connections to open to each DB, at most the pool size
+        :return: void
+        """
+
+        cls.open_connections(cls.get_pool(), connections)
+
+        replicas = cls.get_replicas()
+
+        for replica in replicas.replicas if replicas is not None else []:
+            try:
+                cls.open_connections(replica.pool, connections)
+            except Exception:
+                # A replica down is skipped by the replica set, it must not stop the server
+                pass
+
+    @staticmethod
+    def open_connections(pool, connections):
+        conns = []
+
+        try:
+            for _ in range(min(connections, pool.size)):
+                conns.append(pool.get_conn())
+        finally:
+            for conn in conns:
+                conn.close()
+
+    @classmethod
+    def get_stats(cls):
+        """
+        Get usage stats of the connection pool
+
+        :return: dict()
+        """
+
+        return cls.get_pool().get_stats()
+
+    @classmethod
+    def get_replica_stats(cls):
+        """
+        Get usage, lag and failures of the replicas
+
+        :return: dict() | None if there are no replicas
+        """
+
+        replicas = cls.get_replicas()
+
+        return replicas.get_stats() if replicas is not None else None
+
+    @staticmethod
+    def get_statement_stats():
+        """
+        Get executions and time of the statements that took most time
+
+        :return: list(dict())
+        """
+
+        return statement_stats.get_stats()
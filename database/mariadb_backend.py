@@ -0,0 +1,53 @@
+import mysql.connector as mysql
+
+from database.backend import Backend
+
+DEFAULT_PORT = 3306
+
+
+class MariaDBBackend(Backend):
+    """
+    Provide connections to the MariaDB server
+    """
+
+    name = "mariadb"
+
+    def connect(self):
+        return mysql.connect(
+            host=self.credential["host"],
+            port=self.credential.get("db_port", DEFAULT_PORT),
+            database=self.credential["db_name"],
+            user=self.credential["user"],
+            password=self.credential["user_password"]
+        )
+
+    def ping(self, raw_conn):
+        raw_conn.ping(reconnect=False)
+
+    def prepare(self, raw_conn):
+        try:
+            return raw_conn.cursor(prepared=True)
+        except NotImplementedError:
+            # C extension of older connectors
+            return None
+
+    def get_replica_lag(self, conn):
+        curs = conn.cursor()
+        curs.execute("SHOW SLAVE STATUS")
+        row = curs.fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip([column[0] for column in curs.description], row)).get("Seconds_Behind_Master")
+
+    def lock(self, conn, name, timeout):
+        curs = conn.cursor()
+        curs.execute("SELECT GET_LOCK(%s, %s)", (name, timeout))
+
+        return bool(curs.fetchone()[0])
+
+    def unlock(self, conn, name):
+        curs = conn.cursor()
+        curs.execute("SELECT RELEASE_LOCK(%s)", (name,))
+        curs.fetchone()
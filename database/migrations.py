@@ -0,0 +1,151 @@
+from database.database import Database
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+LOCK_NAME = "schema_migrations"
+LOCK_TIMEOUT = 60
+
+
+def add_column(table, column, definition):
+    """
+    Make a migration step that adds a column only if it is missing, so that it can run again after a crash.
+    ADD COLUMN IF NOT EXISTS is not supported by SQLite
+
+    :param table: Name of the table
+    :param column: Name of the column
+    :param definition: Type and constraints of the column
+    :return: Callable(curs)
+    """
+
+    def step(curs):
+        curs.execute("SELECT * FROM " + table + " LIMIT 0")
+        curs.fetchall()
+
+        if column not in [description[0] for description in curs.description]:
+            curs.execute("ALTER TABLE " + table + " ADD COLUMN " + column + " " + definition)
+
+    return step
+
+# (version, description, statements), append new migrations at the end and never change applied ones.
+# A statement is a query or a Callable(curs), and must do nothing if it was already applied
+MIGRATIONS = [
+    (1, "index power_strip by name", [
+        "CREATE INDEX IF NOT EXISTS idx_power_strip_name ON power_strip (name)"
+    ]),
+    (2, "index power_strip by device and switch number", [
+        "CREATE INDEX IF NOT EXISTS idx_power_strip_device_switch ON power_strip (device_id, switch_number)"
+    ]),
+    (3, "index otp by timestamp", [
+        "CREATE INDEX IF NOT EXISTS idx_otp_timestamp ON otp (otp_timestamp)"
+    ]),
+    (4, "secret of device state reports", [
+        add_column("device", "push_secret", "CHAR(64)")
+    ]),
+    (5, "index email_outbox by state and next attempt", [
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_pending ON email_outbox (sent_on, failed, next_attempt_at)"
+    ]),
+    (6, "last sequence of device state reports", [
+        add_column("device", "push_boot", "BIGINT NOT NULL DEFAULT -1"),
+        add_column("device", "push_seq", "BIGINT NOT NULL DEFAULT -1")
+    ]),
+]
+
+
+class MigrationRunner:
+    """
+    Provide methods to apply the schema migrations not applied yet, tracked into the schema_migrations table
+    """
+
+    def __init__(self, migrations=None):
+        self.migrations = MIGRATIONS if migrations is None else migrations
+
+        self.conn = Database().get_conn()
+        self.curs = self.conn.cursor()
+
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
+    def run(self):
+        """
+        Apply pending migrations in version order.
+        A DB lock makes other processes starting at the same time wait instead of applying them twice
+
+        :return: Number of applied migrations
+        """
+
+        self.lock()
+
+        try:
+            self.create_schema_migrations_table()
+
+            applied = self.get_applied_versions()
+            count = 0
+
+            for version, description, statements in sorted(self.migrations, key=lambda migration: migration[0]):
+                if version in applied:
+                    continue
+
+                logger.info("migrations -> applying " + str(version) + " (" + description + ")")
+
+                for statement in statements:
+                    if callable(statement):
+                        statement(self.curs)
+                    else:
+                        self.curs.execute(statement)
+
+                self.curs.execute("""
+                                  INSERT INTO schema_migrations(version, description)
+                                  VALUES (%s, %s)
+                                  """, (version, description))
+                self.conn.commit()
+
+                count += 1
+
+            return count
+        finally:
+            self.unlock()
+
+    def lock(self):
+        if not Database.get_backend().lock(self.conn, LOCK_NAME, LOCK_TIMEOUT):
+            raise RuntimeError("Schema migrations are locked by another process")
+
+    def unlock(self):
+        Database.get_backend().unlock(self.conn, LOCK_NAME)
+
+    def create_schema_migrations_table(self):
+        """
+        Init schema_migrations table
+
+        :return: void
+        """
+
+        query = """
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT NOT NULL PRIMARY KEY,
+                    description VARCHAR(255) NOT NULL,
+                    applied_on TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+                );
+                """
+
+        self.curs.execute(query)
+        self.conn.commit()
+
+    def get_applied_versions(self):
+        """
+        Get the versions already applied
+
+        :return: set()
+        """
+
+        query = """
+                SELECT version
+                FROM schema_migrations
+                """
+
+        self.curs.execute(query)
+
+        return {version for (version,) in self.curs.fetchall()}
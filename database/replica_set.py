@@ -0,0 +1,201 @@
+from functools import lru_cache
+import threading
+import time
+
+from database.connection_pool import PoolError
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+DEFAULT_MAX_LAG = 5
+DEFAULT_LAG_CHECK_INTERVAL = 5
+DEFAULT_RETRY_INTERVAL = 30
+
+
+@lru_cache(maxsize=512)
+def is_read(query):
+    """
+    Check if a query only reads and can be sent to a replica
+
+    :param query: SQL query
+    :return: True | False
+    """
+
+    query = query.lstrip().upper()
+
+    return query.startswith("SELECT") and "FOR UPDATE" not in query and "LOCK IN SHARE MODE" not in query and "_LOCK(" not in query
+
+
+class Replica:
+    """
+    A read-only copy of the DB with its own connection pool
+    """
+
+    def __init__(self, name, backend, pool):
+        self.name = name
+        self.backend = backend
+        self.pool = pool
+
+        self.down_until = 0
+        self.lag = None
+        self.lag_checked_at = None
+
+        self.reads = 0
+        self.failures = 0
+        self.lagging = 0
+
+
+class ReplicaSet:
+    """
+    Provide connections to the replicas, in turn.
+    Replicas that fail or lag behind the primary are skipped for a while, when none is usable the caller falls back to the primary
+    """
+
+    def __init__(self, replicas, max_lag=DEFAULT_MAX_LAG, lag_check_interval=DEFAULT_LAG_CHECK_INTERVAL, retry_interval=DEFAULT_RETRY_INTERVAL):
+        """
+        :param replicas: list(Replica)
+        :param max_lag: Max seconds a replica can be behind the primary, None to not check the lag
+        :param lag_check_interval: Seconds between two lag checks of the same replica
+        :param retry_interval: Seconds a failed or lagging replica is skipped
+        """
+
+        self.replicas = replicas
+        self.max_lag = max_lag
+        self.lag_check_interval = lag_check_interval
+        self.retry_interval = retry_interval
+
+        self.next = 0
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+    def get_conn(self):
+        """
+        Borrow a connection from the next usable replica
+
+        :return: tuple(Replica, PooledConnection) | None to use the primary
+        """
+
+        with self.lock:
+            start = self.next
+            self.next = (self.next + 1) % len(self.replicas)
+
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+
+            if replica.down_until > time.monotonic():
+                continue
+
+            try:
+                conn = replica.pool.get_conn()
+            except PoolError:
+                # Busy, not broken
+                continue
+            except Exception:
+                logger.exception("replica_set -> get_conn (" + replica.name + ")")
+
+                self.mark_failed(replica)
+
+                continue
+
+            if not self.check_lag(replica, conn):
+                conn.close()
+
+                continue
+
+            with self.lock:
+                replica.reads += 1
+
+            return replica, conn
+
+        with self.lock:
+            self.fallbacks += 1
+
+        return None
+
+    def check_lag(self, replica, conn):
+        """
+        Check, at most every lag_check_interval, that the replica is not too far behind the primary
+
+        :param replica: Replica
+        :param conn: Connection borrowed from the replica
+        :return: True | False
+        """
+
+        now = time.monotonic()
+
+        if self.max_lag is None or (replica.lag_checked_at is not None and now - replica.lag_checked_at < self.lag_check_interval):
+            return True
+
+        try:
+            replica.lag = replica.backend.get_replica_lag(conn)
+        except Exception:
+            logger.exception("replica_set -> check_lag (" + replica.name + ")")
+
+            replica.lag = None
+
+        replica.lag_checked_at = now
+
+        if replica.lag is None or replica.lag > self.max_lag:
+            logger.warning("replica_set -> replica \"" + replica.name + "\" lag " + str(replica.lag))
+
+            with self.lock:
+                replica.lagging += 1
+
+            self.mark_down(replica)
+
+            return False
+
+        return True
+
+    def mark_failed(self, replica):
+        """
+        Skip a replica whose connection or query failed
+
+        :param replica: Replica
+        :return: void
+        """
+
+        with self.lock:
+            replica.failures += 1
+
+        self.mark_down(replica)
+
+    def mark_down(self, replica):
+        """
+        Skip a replica for retry_interval seconds
+
+        :param replica: Replica
+        :return: void
+        """
+
+        with self.lock:
+            replica.down_until = time.monotonic() + self.retry_interval
+            # Check the lag again when it comes back
+            replica.lag_checked_at = None
+
+    def get_stats(self):
+        """
+        Get reads, failures and lag of each replica
+
+        :return: dict()
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            return {
+                "fallbacks": self.fallbacks,
+                "replicas": {
+                    replica.name: {
+                        "up": replica.down_until <= now,
+                        "lag": replica.lag,
+                        "reads": replica.reads,
+                        "failures": replica.failures,
+                        "lagging": replica.lagging,
+                        "pool": replica.pool.get_stats()
+                    }
+                    for replica in self.replicas
+                }
+            }
@@ -0,0 +1,142 @@
+from datetime import date, datetime
+from functools import lru_cache
+import fcntl
+import re
+import sqlite3
+import threading
+import time
+
+from database.backend import Backend
+
+DEFAULT_PATH = "djd.db"
+DEFAULT_BUSY_TIMEOUT = 5
+DEFAULT_CACHED_STATEMENTS = 128
+
+# Values stored and read like MariaDB does, local time without timezone
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+REWRITES = [
+    (re.compile(r"\bINT\s+NOT\s+NULL\s+AUTO_INCREMENT\s+PRIMARY\s+KEY\b", re.IGNORECASE), "INTEGER PRIMARY KEY AUTOINCREMENT"),
+    (re.compile(r"\bINSERT\s+IGNORE\b", re.IGNORECASE), "INSERT OR IGNORE"),
+    (re.compile(r"\bNOW\(\)\s*-\s*INTERVAL\s+(\d+)\s+(SECOND|MINUTE|HOUR|DAY)\b", re.IGNORECASE),
+     lambda match: "datetime('now', 'localtime', '-" + match.group(1) + " " + match.group(2).lower() + "s')"),
+    (re.compile(r"\bNOW\(\)", re.IGNORECASE), "datetime('now', 'localtime')"),
+    (re.compile(r"\bCURRENT_TIMESTAMP\b", re.IGNORECASE), "(datetime('now', 'localtime'))"),
+    (re.compile(r"\bCURRENT_DATE\b", re.IGNORECASE), "date('now', 'localtime')"),
+    (re.compile(r"%s"), "?"),
+]
+
+
+@lru_cache(maxsize=512)
+def translate(query):
+    """
+    Rewrite a MariaDB query of the models into the SQLite dialect
+
+    :param query: Query with %s placeholders
+    :return: Query with ? placeholders
+    """
+
+    for pattern, replacement in REWRITES:
+        query = pattern.sub(replacement, query)
+
+    return query
+
+
+class SQLiteCursor:
+    """
+    Cursor that accepts the MariaDB queries of the models
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, item):
+        return getattr(self.cursor, item)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, operation, params=None):
+        return self.cursor.execute(translate(operation), params if params is not None else ())
+
+    def executemany(self, operation, seq_params):
+        return self.cursor.executemany(translate(operation), seq_params)
+
+
+class SQLiteConnection:
+    """
+    Raw SQLite connection whose cursors accept the MariaDB queries of the models
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __getattr__(self, item):
+        return getattr(self.conn, item)
+
+    def cursor(self):
+        return SQLiteCursor(self.conn.cursor())
+
+
+class SQLiteBackend(Backend):
+    """
+    Provide connections to an embedded SQLite DB file in WAL mode, so readers do not block the writer
+    """
+
+    name = "sqlite"
+
+    def __init__(self, credential):
+        super().__init__(credential)
+
+        self.path = credential.get("path", DEFAULT_PATH)
+        self.busy_timeout = credential.get("busy_timeout", DEFAULT_BUSY_TIMEOUT)
+
+        self.lock_files = {}
+        self.lock_files_lock = threading.Lock()
+
+    def connect(self):
+        # The pool hands each connection to one thread at a time.
+        # sqlite3 keeps the compiled statements of each connection, so prepare() is not needed
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout, detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False, cached_statements=DEFAULT_CACHED_STATEMENTS)
+
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+
+        return SQLiteConnection(conn)
+
+    def ping(self, raw_conn):
+        raw_conn.execute("SELECT 1")
+
+    def lock(self, conn, name, timeout):
+        lock_file = open(self.path + "." + name + ".lock", "w")
+        deadline = time.monotonic() + timeout
+
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    lock_file.close()
+
+                    return False
+
+                time.sleep(0.1)
+
+        with self.lock_files_lock:
+            self.lock_files[name] = lock_file
+
+        return True
+
+    def unlock(self, conn, name):
+        with self.lock_files_lock:
+            lock_file = self.lock_files.pop(name, None)
+
+        if lock_file is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
@@ -0,0 +1,218 @@
+from collections import OrderedDict
+from functools import lru_cache
+import threading
+import time
+
+DEFAULT_MAX_STATEMENTS = 64
+DEFAULT_TOP_STATEMENTS = 20
+
+
+@lru_cache(maxsize=512)
+def normalize(query):
+    """
+    Collapse the whitespaces of a query, used as key of the stats
+
+    :param query: SQL query
+    :return: str
+    """
+
+    return " ".join(query.split())
+
+
+class StatementStats:
+    """
+    Count executions and time of each statement sent to the DB
+    """
+
+    def __init__(self):
+        # normalized query -> [executions, prepares, errors, total_time, max_time]
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def record(self, query, elapsed, prepared=False, failed=False):
+        """
+        :param query: SQL query
+        :param elapsed: Seconds spent executing it
+        :param prepared: True if it was prepared before this execution
+        :param failed: True if it raised
+        :return: void
+        """
+
+        key = normalize(query)
+
+        with self.lock:
+            entry = self.statements.get(key)
+
+            if entry is None:
+                entry = self.statements[key] = [0, 0, 0, 0.0, 0.0]
+
+            entry[0] += 1
+            entry[1] += int(prepared)
+            entry[2] += int(failed)
+            entry[3] += elapsed
+            entry[4] = max(entry[4], elapsed)
+
+    def get_stats(self, top=DEFAULT_TOP_STATEMENTS):
+        """
+        Get the statements that took most time overall
+
+        :param top: Max number of statements returned
+        :return: list(dict())
+        """
+
+        with self.lock:
+            items = sorted(self.statements.items(), key=lambda item: item[1][3], reverse=True)[:top]
+
+        return [
+            {
+                "query": query,
+                "executions": executions,
+                "prepares": prepares,
+                "errors": errors,
+                "time_total_ms": round(total * 1000, 3),
+                "time_avg_ms": round(total * 1000 / executions, 3),
+                "time_max_ms": round(max_time * 1000, 3)
+            }
+            for query, (executions, prepares, errors, total, max_time) in items
+        ]
+
+
+statement_stats = StatementStats()
+
+
+class StatementCursor:
+    """
+    Cursor that runs each parametrized query on the prepared statement kept by its connection
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+
+        self.plain = None
+        self.cursor = None
+
+    def __getattr__(self, item):
+        # fetchone(), rowcount, lastrowid... of the last executed statement
+        if self.cursor is None:
+            self.cursor = self.get_plain()
+
+        return getattr(self.cursor, item)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def get_plain(self):
+        if self.plain is None:
+            self.plain = self.conn.raw_conn.cursor()
+
+        return self.plain
+
+    def execute(self, operation, params=None):
+        return self.run("execute", operation, params)
+
+    def executemany(self, operation, seq_params):
+        return self.run("executemany", operation, seq_params)
+
+    def run(self, method, operation, params):
+        prepared = None
+
+        if params is not None:
+            prepared, created = self.conn.get_prepared(operation)
+
+        self.cursor = prepared if prepared is not None else self.get_plain()
+
+        start = time.perf_counter()
+
+        try:
+            res = getattr(self.cursor, method)(operation, params)
+        except Exception:
+            statement_stats.record(operation, time.perf_counter() - start, failed=True)
+
+            if prepared is not None:
+                self.conn.drop_prepared(operation)
+
+            raise
+
+        statement_stats.record(operation, time.perf_counter() - start, prepared=prepared is not None and created)
+
+        return res
+
+
+class StatementConnection:
+    """
+    Raw connection kept by the pool together with its prepared statements.
+    The least recently used statements are closed when there are more than max_statements
+    """
+
+    def __init__(self, raw_conn, prepare, max_statements=DEFAULT_MAX_STATEMENTS):
+        """
+        :param raw_conn: Connection opened by the backend
+        :param prepare: Callable(raw_conn) that returns a new prepared cursor, None if the backend does not need them
+        :param max_statements: Max prepared statements kept open on the connection
+        """
+
+        self.raw_conn = raw_conn
+        self.prepare = prepare
+        self.max_statements = max_statements
+
+        self.statements = OrderedDict()
+        self.can_prepare = max_statements > 0
+
+    def __getattr__(self, item):
+        return getattr(self.raw_conn, item)
+
+    def cursor(self):
+        return StatementCursor(self)
+
+    def get_prepared(self, query):
+        """
+        Get the prepared cursor of a query, preparing it on first use
+
+        :param query: SQL query
+        :return: tuple(cursor | None, created)
+        """
+
+        if not self.can_prepare:
+            return None, False
+
+        cursor = self.statements.get(query)
+
+        if cursor is not None:
+            self.statements.move_to_end(query)
+
+            return cursor, False
+
+        cursor = self.prepare(self.raw_conn)
+
+        if cursor is None:
+            self.can_prepare = False
+
+            return None, False
+
+        self.statements[query] = cursor
+
+        if len(self.statements) > self.max_statements:
+            _, oldest = self.statements.popitem(last=False)
+            self.close_quietly(oldest)
+
+        return cursor, True
+
+    def drop_prepared(self, query):
+        cursor = self.statements.pop(query, None)
+
+        if cursor is not None:
+            self.close_quietly(cursor)
+
+    def close(self):
+        for cursor in self.statements.values():
+            self.close_quietly(cursor)
+
+        self.statements.clear()
+        self.raw_conn.close()
+
+    @staticmethod
+    def close_quietly(cursor):
+        try:
+            cursor.close()
+        except Exception:
+            pass
@@ -0,0 +1,327 @@
+from flask import g, has_request_context
+
+from database.backend import DatabaseError
+from database.replica_set import is_read
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+
+class SharedCursor:
+    """
+    Cursor shared by every model of a unit of work.
+    Reads go to a replica until the first write, then everything goes to the primary.
+    A failed statement on the primary marks the whole unit of work to be rolled back
+    """
+
+    def __init__(self, unit_of_work):
+        self.unit_of_work = unit_of_work
+        self.cursor = None
+
+    def __getattr__(self, item):
+        # fetchone(), rowcount, lastrowid... of the last executed statement
+        if self.cursor is None:
+            self.cursor = self.unit_of_work.get_primary_cursor()
+
+        return getattr(self.cursor, item)
+
+    def execute(self, operation, params=None):
+        if is_read(operation):
+            cursor = self.unit_of_work.get_replica_cursor()
+
+            if cursor is not None:
+                self.cursor = cursor
+
+                try:
+                    return cursor.execute(operation, params)
+                except DatabaseError:
+                    logger.exception("unit_of_work -> replica read")
+
+                    self.unit_of_work.release_replica(failed=True)
+        else:
+            self.unit_of_work.mark_written()
+
+        return self.run("execute", operation, params)
+
+    def executemany(self, operation, seq_params):
+        self.unit_of_work.mark_written()
+
+        return self.run("executemany", operation, seq_params)
+
+    def run(self, method, operation, params):
+        self.cursor = self.unit_of_work.get_primary_cursor()
+
+        try:
+            return getattr(self.cursor, method)(operation, params)
+        except Exception:
+            self.unit_of_work.failed = True
+
+            raise
+
+
+class SharedConnection:
+    """
+    Connection handed to the models during a unit of work.
+    commit() and close() are deferred to the end of the unit of work
+    """
+
+    def __init__(self, unit_of_work):
+        self.unit_of_work = unit_of_work
+
+    def cursor(self):
+        return self.unit_of_work.cursor()
+
+    def commit(self):
+        self.unit_of_work.commits_deferred += 1
+
+    def rollback(self):
+        self.unit_of_work.failed = True
+
+    def close(self):
+        pass
+
+
+class UnitOfWork:
+    """
+    Share one connection, cursor and transaction across all the models used while serving a request
+    """
+
+    def __init__(self, pool, replicas=None):
+        """
+        :param pool: ConnectionPool of the primary
+        :param replicas: ReplicaSet used for the reads, None to read from the primary
+        """
+
+        self.pool = pool
+        self.replicas = replicas
+
+        self.conn = None
+        self.curs = None
+        self.shared_cursor = None
+
+        self.replica = None
+        self.replica_conn = None
+        self.replica_curs = None
+        self.written = False
+
+        self.failed = False
+        self.commits_deferred = 0
+        self.commit_callbacks = []
+
+    @staticmethod
+    def current():
+        """
+        Get the unit of work of the current request
+
+        :return: UnitOfWork | None
+        """
+
+        if has_request_context():
+            return g.get("unit_of_work")
+
+        return None
+
+    def get_conn(self):
+        """
+        Get the connection shared by the models
+
+        :return: SharedConnection
+        """
+
+        return SharedConnection(self)
+
+    def cursor(self):
+        """
+        Get the shared cursor, connections are borrowed on first use
+
+        :return: SharedCursor
+        """
+
+        if self.shared_cursor is None:
+            self.shared_cursor = SharedCursor(self)
+
+        return self.shared_cursor
+
+    def get_primary_cursor(self):
+        """
+        Get the cursor of the primary, borrowing the connection from the pool on first use
+
+        :return: cursor
+        """
+
+        if self.curs is None:
+            self.conn = self.pool.get_conn()
+            self.curs = self.conn.cursor()
+
+        return self.curs
+
+    def get_replica_cursor(self):
+        """
+        Get the cursor of a replica, borrowing the connection on first use
+
+        :return: cursor | None if the reads must go to the primary
+        """
+
+        if self.replicas is None or self.written:
+            return None
+
+        if self.replica_curs is None:
+            borrowed = self.replicas.get_conn()
+
+            if borrowed is None:
+                return None
+
+            self.replica, self.replica_conn = borrowed
+            self.replica_curs = self.replica_conn.cursor()
+
+        return self.replica_curs
+
+    def mark_written(self):
+        """
+        Send the next reads to the primary, so the request reads its own writes
+
+        :return: void
+        """
+
+        if not self.written:
+            self.written = True
+            self.release_replica()
+
+    def release_replica(self, failed=False):
+        """
+        Give back the replica connection
+
+        :param failed: True to skip the replica for a while
+        :return: void
+        """
+
+        if self.replica_conn is None:
+            return
+
+        if failed:
+            self.replicas.mark_failed(self.replica)
+
+        try:
+            self.replica_conn.close()
+        except Exception:
+            logger.exception("unit_of_work -> release_replica")
+
+        self.replica = None
+        self.replica_conn = None
+        self.replica_curs = None
+
+    def on_commit(self, callback):
+        """
+        Run a callback once the work is committed, it is dropped on rollback
+
+        :param callback: Callable without arguments
+        :return: void
+        """
+
+        self.commit_callbacks.append(callback)
+
+    def commit(self):
+        """
+        Commit all the work done, or roll it back if a statement failed
+
+        :return: True | False
+        """
+
+        if self.failed:
+            self.rollback()
+
+            return False
+
+        if self.conn is not None:
+            try:
+                self.conn.commit()
+            except Exception:
+                logger.exception("unit_of_work -> commit")
+
+                self.rollback()
+
+                return False
+
+        callbacks, self.commit_callbacks = self.commit_callbacks, []
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("unit_of_work -> on_commit")
+
+        return True
+
+    def rollback(self):
+        """
+        Discard all the work done, the next statements start a new transaction
+
+        :return: void
+        """
+
+        self.failed = False
+        self.commit_callbacks = []
+
+        if self.conn is not None:
+            try:
+                self.conn.rollback()
+            except Exception:
+                logger.exception("unit_of_work -> rollback")
+
+    def close(self):
+        """
+        Give the connection back to the pool, uncommitted work is discarded
+
+        :return: void
+        """
+
+        self.release_replica()
+
+        if self.conn is not None:
+            self.conn.close()
+
+            self.conn = None
+            self.curs = None
+
+    @staticmethod
+    def init_app(app, pool_getter, error_response, replicas_getter=None):
+        """
+        Open a unit of work for each request of a Flask app.
+        It is committed once after the view, unless a statement failed or the response is a server error
+
+        :param app: Flask app
+        :param pool_getter: Callable that returns the ConnectionPool to borrow from
+        :param error_response: Callable that returns the response sent when the final commit fails
+        :param replicas_getter: Callable that returns the ReplicaSet used for the reads, or None
+        :return: void
+        """
+
+        @app.before_request
+        def begin_unit_of_work():
+            g.unit_of_work = UnitOfWork(pool_getter(), replicas_getter() if replicas_getter is not None else None)
+
+        @app.after_request
+        def commit_unit_of_work(response):
+            unit_of_work = g.get("unit_of_work")
+
+            if unit_of_work is None:
+                return response
+
+            if response.status_code >= 500:
+                unit_of_work.rollback()
+            elif not unit_of_work.commit():
+                return app.make_response(error_response())
+
+            return response
+
+        @app.teardown_request
+        def close_unit_of_work(exc):
+            unit_of_work = g.pop("unit_of_work", None)
+
+            if unit_of_work is not None:
+                if exc is not None:
+                    unit_of_work.rollback()
+
+                unit_of_work.close()
@@ -0,0 +1,212 @@
+import asyncio
+
+import httpx
+
+from devices_manager.diy_device_manager import DeviceManager
+from devices_manager.health_tracker import health_tracker
+from devices_manager.session_pool import DEFAULT_MAX_CONNECTIONS, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+
+class AsyncSessionPool:
+    """
+    Provide one keep-alive async HTTP client for each device, keyed by base URL.
+    Like SessionPool, requests beyond max_connections wait for a free connection, but without holding a thread
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        """
+        :param max_connections: Max open connections to the same device
+        :param connect_timeout: Seconds to wait for the TCP connection
+        :param read_timeout: Seconds to wait for the device answer
+        """
+
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout, pool=connect_timeout + read_timeout)
+        self.max_wait = connect_timeout + read_timeout
+
+        self.clients = {}
+        self.requests = {}
+
+    def get_client(self, base_url):
+        """
+        Get the client of a device, creating it on first use
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: httpx.AsyncClient
+        """
+
+        client = self.clients.get(base_url)
+
+        if client is None:
+            client = self.clients[base_url] = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+
+        self.requests[base_url] = self.requests.get(base_url, 0) + 1
+
+        return client
+
+    def get_max_wait(self):
+        return self.max_wait
+
+    async def get(self, base_url, url):
+        return await self.get_client(base_url).get(url)
+
+    async def post(self, base_url, url, data):
+        return await self.get_client(base_url).post(url, content=data)
+
+    async def close(self):
+        """
+        Close the clients of all devices
+
+        :return: void
+        """
+
+        clients, self.clients = self.clients, {}
+
+        for client in clients.values():
+            await client.aclose()
+
+    def get_stats(self):
+        return {base_url: {"requests": count} for base_url, count in self.requests.items()}
+
+
+class AsyncSingleFlight:
+    """
+    Provide coalescing of identical concurrent reads: the first caller does the call, the others await its result
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    async def do(self, key, fn, timeout, on_timeout=None):
+        """
+        Await fn(), or the call with the same key already in flight
+
+        :param key: Identity of the call, e.g. its URL
+        :param fn: Coroutine function without arguments
+        :param timeout: Max seconds a waiter waits for the call in flight
+        :param on_timeout: Value returned to a waiter that timed out
+        :return: Result of fn | on_timeout
+        """
+
+        task = self.calls.get(key)
+
+        if task is None:
+            self.leaders += 1
+
+            task = self.calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self.calls.pop(key, None))
+
+            return await task
+
+        self.shared += 1
+
+        try:
+            # shield: a waiter that gives up must not cancel the call of the others
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+
+            return on_timeout
+
+    def get_stats(self):
+        return {"in_flight": len(self.calls), "calls": self.leaders, "shared": self.shared, "timeouts": self.timeouts}
+
+
+async_session_pool = AsyncSessionPool()
+async_single_flight = AsyncSingleFlight()
+
+
+class AsyncDeviceManager(DeviceManager):
+    """
+    Provide the device calls of DeviceManager used on the event loop, send_action and get_status, as coroutines
+    """
+
+    async def request(self, name, url, params=None):
+        """
+        Send a request to the device, failing fast if the device is known to be offline
+
+        :param name: Name of the caller, used in logs
+        :param url: URL of the request
+        :param params: JSON to POST, None for a GET
+        :return: httpx.Response | HTML error code
+        """
+
+        if not health_tracker.allow_request(self.base_url):
+            return 503
+
+        if params is None:
+            return await async_single_flight.do(url, lambda: self.send(name, url), async_session_pool.get_max_wait(), on_timeout=504)
+
+        return await self.send(name, url, params)
+
+    async def send(self, name, url, params=None):
+        """
+        Send a request to the device and record if it answered
+
+        :param name: Name of the caller, used in logs
+        :param url: URL of the request
+        :param params: JSON to POST, None for a GET
+        :return: httpx.Response | HTML error code
+        """
+
+        try:
+            if params is None:
+                res = await async_session_pool.get(self.base_url, url)
+            else:
+                res = await async_session_pool.post(self.base_url, url, params)
+
+            health_tracker.record_success(self.base_url)
+
+            return res
+        except httpx.TimeoutException:
+            logger.exception("async_device_manager -> " + name + " (504)")
+            health_tracker.record_failure(self.base_url)
+
+            return 504
+        except httpx.TransportError:
+            logger.exception("async_device_manager -> " + name + " (500)")
+            health_tracker.record_failure(self.base_url)
+
+            return 500
+        except httpx.HTTPError:
+            logger.exception("async_device_manager -> " + name + " (400)")
+
+            return 400
+
+    async def send_action(self, params):
+        """
+        Send action that device will do
+
+        :param params: JSON
+        :return: JSON | HTML error code
+        """
+
+        res = await self.request("send_action", self.action_path, params)
+
+        if isinstance(res, int):
+            return res
+
+        return {"status_code": res.status_code, "info": res.json()}
+
+    async def get_status(self):
+        """
+        Get status data of the device
+
+        :return: JSON | HTML error code
+        """
+
+        res = await self.request("get_status", self.status_path)
+
+        if isinstance(res, int):
+            return res
+
+        return {"status_code": res.status_code, "info": res.json()}
@@ -0,0 +1,286 @@
+from collections import deque
+import asyncio
+import concurrent.futures
+import threading
+import time
+
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+DEFAULT_MAX_DEPTH = 8
+DEFAULT_WAIT_TIMEOUT = 15
+
+# Max seconds the thread of a device waits for the event loop to send a command, the HTTP timeouts end a send much sooner:
+# it is only reached if the event loop stopped
+LOOP_SEND_TIMEOUT = 60
+
+
+class Command:
+    """
+    A command waiting to be sent to a device
+    """
+
+    __slots__ = ("params", "key", "send", "loop", "event", "callbacks", "waiters", "started", "result", "queued_at")
+
+    def __init__(self, params, key, send, loop=None):
+        self.params = params
+        self.key = key
+        self.send = send
+        # Event loop that runs send, None if send blocks
+        self.loop = loop
+        self.event = threading.Event()
+        # Called with the result once sent, by the waiters that cannot block on event
+        self.callbacks = []
+        # Callers waiting for the result, the command is dropped when the last one gives up before it is sent
+        self.waiters = 0
+        self.started = False
+        self.result = None
+        self.queued_at = time.monotonic()
+
+
+class DeviceQueue:
+    """
+    Commands of one device, sent one at a time in arrival order
+    """
+
+    def __init__(self):
+        self.pending = deque()
+        self.running = False
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.completed = 0
+        self.max_depth_seen = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def to_dict(self):
+        return {
+            "depth": len(self.pending),
+            "max_depth": self.max_depth_seen,
+            "submitted": self.submitted,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "completed": self.completed,
+            "latency_avg_ms": round(self.latency_total * 1000 / self.completed, 3) if self.completed else 0,
+            "latency_max_ms": round(self.latency_max * 1000, 3)
+        }
+
+
+class CommandQueue:
+    """
+    Provide a bounded, ordered command queue for each device, keyed by base URL.
+    Each device has at most one command in flight, different devices are served in parallel.
+    Threads and the event loop of the async mode submit to the same queues, so the order holds for both:
+    the commands of the event loop are sent by the event loop, the thread of the device queue only awaits them
+    """
+
+    def __init__(self, max_depth=DEFAULT_MAX_DEPTH, wait_timeout=DEFAULT_WAIT_TIMEOUT):
+        """
+        :param max_depth: Max commands waiting for the same device, the next ones are rejected
+        :param wait_timeout: Max seconds a caller waits for its command to be sent
+        """
+
+        self.max_depth = max_depth
+        self.wait_timeout = wait_timeout
+
+        self.queues = {}
+        self.lock = threading.Lock()
+
+    def submit(self, base_url, params, key, send):
+        """
+        Queue a command and wait for the device answer.
+        If the last queued command has the same key, it is replaced by this one and both callers get its answer
+
+        :param base_url: e.g. http://192.168.1.10
+        :param params: Params of the command
+        :param key: Key shared by commands that override each other, None to never replace the command
+        :param send: Callable(params) that sends the command to the device
+        :return: Result of send | 429 if the queue is full | see give_up if the command was not sent in time
+        """
+
+        command = self.enqueue(base_url, params, key, send)
+
+        if not isinstance(command, Command):
+            return command
+
+        if not command.event.wait(self.wait_timeout):
+            return self.give_up(base_url, command)
+
+        return command.result
+
+    async def submit_async(self, base_url, params, key, send):
+        """
+        Queue a command and await the device answer, like submit but without blocking the event loop.
+        The command is sent on this event loop when it is its turn
+
+        :param base_url: e.g. http://192.168.1.10
+        :param params: Params of the command
+        :param key: Key shared by commands that override each other, None to never replace the command
+        :param send: Coroutine function(params) that sends the command to the device
+        :return: Result of send | 429 if the queue is full | see give_up if the command was not sent in time
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def on_done(result):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(result))
+
+        command = self.enqueue(base_url, params, key, send, on_done, loop)
+
+        if not isinstance(command, Command):
+            return command
+
+        try:
+            return await asyncio.wait_for(future, self.wait_timeout)
+        except asyncio.TimeoutError:
+            return self.give_up(base_url, command)
+
+    def give_up(self, base_url, command):
+        """
+        Stop waiting for a command that was not sent in time.
+        It is dropped if it is still waiting and no other caller waits for it, so the caller can safely retry it
+
+        :param base_url: e.g. http://192.168.1.10
+        :param command: Command
+        :return: 504 if the command was dropped | 202 if it is being sent or will be sent | Result of send if it was just sent
+        """
+
+        with self.lock:
+            command.waiters -= 1
+
+            if command.event.is_set():
+                return command.result
+
+            if command.started or command.waiters > 0:
+                return 202
+
+            queue = self.queues[base_url]
+            queue.pending.remove(command)
+            queue.dropped += 1
+
+        return 504
+
+    def enqueue(self, base_url, params, key, send, callback=None, loop=None):
+        """
+        Queue a command, or replace the last queued one if it has the same key
+
+        :param base_url: e.g. http://192.168.1.10
+        :param params: Params of the command
+        :param key: Key shared by commands that override each other, None to never replace the command
+        :param send: Callable(params) that sends the command to the device, a coroutine function if loop is set
+        :param callback: Callable(result) called once the command is sent, None to wait on the event of the command
+        :param loop: Event loop that runs send, None if send blocks
+        :return: Command | 429 if the queue is full
+        """
+
+        with self.lock:
+            queue = self.queues.get(base_url)
+
+            if queue is None:
+                queue = self.queues[base_url] = DeviceQueue()
+
+            queue.submitted += 1
+
+            if key is not None and queue.pending and queue.pending[-1].key == key:
+                command = queue.pending[-1]
+                command.params = params
+                queue.coalesced += 1
+            elif len(queue.pending) >= self.max_depth:
+                queue.rejected += 1
+
+                return 429
+            else:
+                command = Command(params, key, send, loop)
+                queue.pending.append(command)
+                queue.max_depth_seen = max(queue.max_depth_seen, len(queue.pending))
+
+            command.waiters += 1
+
+            if callback is not None:
+                command.callbacks.append(callback)
+
+            if not queue.running:
+                queue.running = True
+                threading.Thread(target=self.run, args=(queue,), name="command-queue", daemon=True).start()
+
+        return command
+
+    def run(self, queue):
+        """
+        Body of the thread that sends the commands of a device, it stops when the queue is empty
+
+        :param queue: DeviceQueue
+        :return: void
+        """
+
+        while True:
+            with self.lock:
+                if not queue.pending:
+                    queue.running = False
+
+                    return
+
+                command = queue.pending.popleft()
+                command.started = True
+
+            try:
+                if command.loop is None:
+                    command.result = command.send(command.params)
+                else:
+                    command.result = self.run_on_loop(command)
+            except Exception:
+                logger.exception("command_queue -> run")
+
+                command.result = 500
+
+            latency = time.monotonic() - command.queued_at
+
+            with self.lock:
+                queue.completed += 1
+                queue.latency_total += latency
+                queue.latency_max = max(queue.latency_max, latency)
+
+            command.event.set()
+
+            # No callback is added once the command left the queue
+            for callback in command.callbacks:
+                callback(command.result)
+
+    def run_on_loop(self, command):
+        """
+        Send a command of the event loop on it and wait for its answer, the I/O never blocks this thread
+
+        :param command: Command
+        :return: Result of send | 504 if the event loop did not send it in time
+        """
+
+        future = asyncio.run_coroutine_threadsafe(command.send(command.params), command.loop)
+
+        try:
+            return future.result(LOOP_SEND_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            logger.error("command_queue -> run_on_loop, command not sent in " + str(LOOP_SEND_TIMEOUT) + " seconds")
+
+            return 504
+
+    def get_stats(self):
+        """
+        Get depth and latency of each device queue
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {base_url: queue.to_dict() for base_url, queue in self.queues.items()}
+
+
+command_queue = CommandQueue()
@@ -1,10 +1,23 @@
 import requests
+import json
+from devices_manager.session_pool import session_pool
+from devices_manager.health_tracker import health_tracker
+from devices_manager.single_flight import single_flight
 from services.logger_service import LoggerService
 
 logging_service = LoggerService(name=__name__)
 
 logger = logging_service.get_logger()
 
+# Params that select which part of a device a command acts on, e.g. the switch of a power strip
+TARGET_PARAMS = ("switch", "switch_number", "relay", "relay_number", "channel")
+
+# Params that set an absolute state, sending the last of two such commands gives the same result as sending both
+STATE_PARAMS = ("state", "status", "color", "brightness")
+
+# Values that change the state relatively to the current one, e.g. "toggle", so commands with them are never merged
+RELATIVE_VALUES = ("toggle", "switch", "next", "previous", "up", "down")
+
 
 class DeviceManager:
     """
@@ -12,6 +25,9 @@ class DeviceManager:
     """
 
     def __init__(self, ip=None, action_path=None):
+        self.base_url = ip
+        self.api_path = action_path
+
         if ip is not None:
             if action_path is not None:
                 self.action_path = ip + action_path
@@ -23,27 +39,74 @@ class DeviceManager:
         self.type = {"ps": "power_strip", "rc": "remote_controller", "lsc": "led_strip_controller"}
         self.path = {"ps": "/ps", "rc": "/rc", "lsc": "/rgb"}
 
-    def send_action(self, params):
+    def request(self, name, url, params=None):
         """
-        Send action that device will do
+        Send a request to the device, failing fast if the device is known to be offline
 
-        :param params: JSON
-        :return: JSON | HTML error code
+        :param name: Name of the caller, used in logs
+        :param url: URL of the request
+        :param params: JSON to POST, None for a GET
+        :return: requests.Response | HTML error code
+        """
+
+        if not health_tracker.allow_request(self.base_url):
+            return 503
+
+        if params is None:
+            # Concurrent identical reads share one request to the device
+            return single_flight.do(url, lambda: self.send(name, url), session_pool.get_max_wait(), on_timeout=504)
+
+        return self.send(name, url, params)
+
+    def send(self, name, url, params=None):
+        """
+        Send a request to the device and record if it answered
+
+        :param name: Name of the caller, used in logs
+        :param url: URL of the request
+        :param params: JSON to POST, None for a GET
+        :return: requests.Response | HTML error code
         """
 
         try:
-            res = requests.post(url=self.action_path, data=params)
+            if params is None:
+                res = session_pool.get(self.base_url, url)
+            else:
+                res = session_pool.post(self.base_url, url, params)
 
-            return {"status_code": res.status_code, "info": res.json()}
+            health_tracker.record_success(self.base_url)
+
+            return res
         except requests.exceptions.ConnectionError:
-            logger.exception("device_manager -> send_action (500)")
+            logger.exception("device_manager -> " + name + " (500)")
+            health_tracker.record_failure(self.base_url)
 
             return 500
+        except requests.exceptions.Timeout:
+            logger.exception("device_manager -> " + name + " (504)")
+            health_tracker.record_failure(self.base_url)
+
+            return 504
         except requests.exceptions.RequestException:
-            logger.exception("device_manager -> send_action (400)")
+            logger.exception("device_manager -> " + name + " (400)")
 
             return 400
 
+    def send_action(self, params):
+        """
+        Send action that device will do
+
+        :param params: JSON
+        :return: JSON | HTML error code
+        """
+
+        res = self.request("send_action", self.action_path, params)
+
+        if isinstance(res, int):
+            return res
+
+        return {"status_code": res.status_code, "info": res.json()}
+
     def get_status(self):
         """
         Get status data of the device
@@ -51,18 +114,12 @@ class DeviceManager:
         :return: JSON | HTML error code
         """
 
-        try:
-            res = requests.get(url=self.status_path)
+        res = self.request("get_status", self.status_path)
 
-            return {"status_code": res.status_code, "info": res.json()}
-        except requests.exceptions.ConnectionError:
-            logger.exception("device_manager -> get_status (500)")
+        if isinstance(res, int):
+            return res
 
-            return 500
-        except requests.exceptions.RequestException:
-            logger.exception("device_manager -> get_status (400)")
-
-            return 400
+        return {"status_code": res.status_code, "info": res.json()}
 
     def get_relay_number(self):
         """
@@ -71,16 +128,12 @@ class DeviceManager:
         :return: JSON | HTML error code
         """
 
-        try:
-            return requests.get(url=self.relay_number_path).json()["number"]
-        except requests.exceptions.ConnectionError:
-            logger.exception("device_manager -> get_relay_number (500)")
+        res = self.request("get_relay_number", self.relay_number_path)
 
-            return 500
-        except requests.exceptions.RequestException:
-            logger.exception("device_manager -> get_relay_number (400)")
+        if isinstance(res, int):
+            return res
 
-            return 400
+        return res.json()["number"]
 
     def get_device_type(self):
         """
@@ -89,16 +142,45 @@ class DeviceManager:
         :return: JSON | HTML error code
         """
 
-        try:
-            return requests.get(url=self.get_type_path).json()["type"]
-        except requests.exceptions.ConnectionError:
-            logger.exception("device_manager -> get_type (500)")
+        res = self.request("get_type", self.get_type_path)
 
-            return 500
-        except requests.exceptions.RequestException:
-            logger.exception("device_manager -> get_type (400)")
+        if isinstance(res, int):
+            return res
 
-            return 400
+        return res.json()["type"]
+
+    def get_health(self):
+        """
+        Get health state of the device
+
+        :return: dict()
+        """
+
+        return health_tracker.get_state(self.base_url)
+
+    def get_command_key(self, params):
+        """
+        Get the key shared by commands that override each other, e.g. "switch 2 on" and "switch 2 off".
+        Only commands that set an absolute state (params in TARGET_PARAMS and STATE_PARAMS, no relative value) have a key:
+        toggles and commands of remote controllers are never overridden, each one is a button press
+
+        :param params: Params of the command
+        :return: Key | None
+        """
+
+        if self.api_path not in (self.path["ps"], self.path["lsc"]) or not isinstance(params, dict):
+            return None
+
+        if not any(name in STATE_PARAMS for name in params):
+            return None
+
+        for name, value in params.items():
+            if name not in TARGET_PARAMS + STATE_PARAMS or (isinstance(value, str) and value.lower() in RELATIVE_VALUES):
+                return None
+
+        targets = tuple((name, json.dumps(params[name])) for name in TARGET_PARAMS if name in params)
+
+        return tuple(sorted(params)), targets
 
     def get_types(self):
         """
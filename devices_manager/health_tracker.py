@@ -0,0 +1,215 @@
+import threading
+import time
+
+import requests
+from devices_manager.session_pool import session_pool
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_OPEN_TIMEOUT = 15
+DEFAULT_PROBE_INTERVAL = 5
+DEFAULT_PROBE_TIMEOUT = (1, 2)
+
+
+class DeviceHealth:
+    """
+    Circuit breaker state of a device
+    """
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.last_failure = None
+        self.last_success = None
+
+    def to_dict(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "last_failure": self.last_failure,
+            "last_success": self.last_success
+        }
+
+
+class HealthTracker:
+    """
+    Provide a circuit breaker for each device, keyed by base URL.
+    Requests to a device that stopped answering fail fast until a background probe of /get_type succeeds
+    """
+
+    def __init__(self, failure_threshold=DEFAULT_FAILURE_THRESHOLD, open_timeout=DEFAULT_OPEN_TIMEOUT, probe_interval=DEFAULT_PROBE_INTERVAL):
+        """
+        :param failure_threshold: Consecutive failures after which the device is considered down
+        :param open_timeout: Seconds before the first probe of a device considered down
+        :param probe_interval: Seconds between two probe rounds
+        """
+
+        self.failure_threshold = failure_threshold
+        self.open_timeout = open_timeout
+        self.probe_interval = probe_interval
+
+        self.devices = {}
+        self.lock = threading.RLock()
+        self.prober = None
+
+        self.fast_failures = 0
+
+    def get_health(self, base_url):
+        health = self.devices.get(base_url)
+
+        if health is None:
+            with self.lock:
+                health = self.devices.setdefault(base_url, DeviceHealth())
+
+        return health
+
+    def allow_request(self, base_url):
+        """
+        Check if a request can be sent to the device
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: True | False
+        """
+
+        if self.get_health(base_url).state == CLOSED:
+            return True
+
+        with self.lock:
+            self.fast_failures += 1
+
+        return False
+
+    def record_success(self, base_url):
+        """
+        The device answered
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: void
+        """
+
+        health = self.get_health(base_url)
+
+        with self.lock:
+            if health.state != CLOSED:
+                logger.info("health_tracker -> device " + base_url + " is back online")
+
+            health.state = CLOSED
+            health.failures = 0
+            health.last_success = time.time()
+
+    def record_failure(self, base_url):
+        """
+        The device did not answer
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: void
+        """
+
+        health = self.get_health(base_url)
+
+        with self.lock:
+            health.failures += 1
+            health.last_failure = time.time()
+
+            if health.state == HALF_OPEN or (health.state == CLOSED and health.failures >= self.failure_threshold):
+                if health.state == CLOSED:
+                    logger.error("health_tracker -> device " + base_url + " is offline")
+
+                health.state = OPEN
+                health.opened_at = time.monotonic()
+
+        if health.state == OPEN:
+            self.start()
+
+    def get_state(self, base_url):
+        """
+        Get health state of a device
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: dict()
+        """
+
+        with self.lock:
+            return self.get_health(base_url).to_dict()
+
+    def start(self):
+        """
+        Start the probe thread if it is not running
+
+        :return: void
+        """
+
+        with self.lock:
+            if self.prober is None or not self.prober.is_alive():
+                self.prober = threading.Thread(target=self.run, name="device-health-probe", daemon=True)
+                self.prober.start()
+
+    def run(self):
+        """
+        Body of the probe thread, it stops when every device is back online
+
+        :return: void
+        """
+
+        while True:
+            time.sleep(self.probe_interval)
+
+            with self.lock:
+                now = time.monotonic()
+                down = [base_url for base_url, health in self.devices.items() if health.state != CLOSED]
+                to_probe = [base_url for base_url in down if now - self.devices[base_url].opened_at >= self.open_timeout]
+
+                for base_url in to_probe:
+                    self.devices[base_url].state = HALF_OPEN
+
+                if not down:
+                    self.prober = None
+
+                    return
+
+            for base_url in to_probe:
+                self.probe(base_url)
+
+    def probe(self, base_url):
+        """
+        Check if a device is back online with a cheap request
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: True | False
+        """
+
+        try:
+            session_pool.get_session(base_url).get(url=base_url + "/get_type", timeout=DEFAULT_PROBE_TIMEOUT)
+            self.record_success(base_url)
+
+            return True
+        except requests.exceptions.RequestException:
+            self.record_failure(base_url)
+
+            return False
+
+    def get_stats(self):
+        """
+        Get how many devices are down and how many requests were not sent because of it
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {
+                "devices": len(self.devices),
+                "down": sum(1 for health in self.devices.values() if health.state != CLOSED),
+                "fast_failures": self.fast_failures
+            }
+
+
+health_tracker = HealthTracker()
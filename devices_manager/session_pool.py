@@ -0,0 +1,113 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# ESP8266 boards accept very few sockets at the same time
+DEFAULT_MAX_CONNECTIONS = 2
+DEFAULT_CONNECT_TIMEOUT = 2
+DEFAULT_READ_TIMEOUT = 5
+
+
+class SessionPool:
+    """
+    Provide one keep-alive HTTP session for each device, keyed by base URL
+    """
+
+    def __init__(self, max_connections=DEFAULT_MAX_CONNECTIONS, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT):
+        """
+        :param max_connections: Max open connections to the same device, other requests wait for a free one
+        :param connect_timeout: Seconds to wait for the TCP connection
+        :param read_timeout: Seconds to wait for the device answer
+        """
+
+        self.max_connections = max_connections
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, base_url):
+        """
+        Get the session of a device, creating it on first use
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: requests.Session
+        """
+
+        session = self.sessions.get(base_url)
+
+        if session is None:
+            with self.lock:
+                session = self.sessions.get(base_url)
+
+                if session is None:
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections, pool_block=True, max_retries=0)
+
+                    session = requests.Session()
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+
+                    self.sessions[base_url] = session
+
+        return session
+
+    def get_max_wait(self):
+        """
+        Get the longest time a request can take before timing out
+
+        :return: Seconds
+        """
+
+        return self.timeout[0] + self.timeout[1]
+
+    def get(self, base_url, url):
+        return self.get_session(base_url).get(url=url, timeout=self.timeout)
+
+    def post(self, base_url, url, data):
+        return self.get_session(base_url).post(url=url, data=data, timeout=self.timeout)
+
+    def close(self, base_url):
+        """
+        Close the session of a device, e.g. when the device is deleted
+
+        :param base_url: e.g. http://192.168.1.10
+        :return: void
+        """
+
+        with self.lock:
+            session = self.sessions.pop(base_url, None)
+
+        if session is not None:
+            session.close()
+
+    def get_stats(self):
+        """
+        Get, for each device, how many requests were sent and how many connections were opened
+
+        :return: dict()
+        """
+
+        with self.lock:
+            sessions = list(self.sessions.items())
+
+        stats = {}
+
+        for base_url, session in sessions:
+            pools = session.get_adapter(base_url).poolmanager.pools
+            sent = 0
+            opened = 0
+
+            for key in pools.keys():
+                pool = pools.get(key)
+
+                if pool is not None:
+                    sent += pool.num_requests
+                    opened += pool.num_connections
+
+            stats[base_url] = {"requests": sent, "connections": opened, "reused": max(sent - opened, 0)}
+
+        return stats
+
+
+session_pool = SessionPool()
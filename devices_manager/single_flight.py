@@ -0,0 +1,92 @@
+import threading
+
+
+class Call:
+    """
+    A call in flight and the threads waiting for its result
+    """
+
+    __slots__ = ("event", "result", "error", "waiters")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Provide coalescing of identical concurrent calls: the first caller does the call, the others wait for its result
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+        self.leaders = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key, fn, timeout, on_timeout=None):
+        """
+        Call fn, or wait for the result of the call with the same key already in flight
+
+        :param key: Identity of the call, e.g. its URL
+        :param fn: Callable without arguments
+        :param timeout: Max seconds a waiter waits for the call in flight
+        :param on_timeout: Value returned to a waiter that timed out
+        :return: Result of fn | on_timeout
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+
+            if call is None:
+                call = Call()
+                self.calls[key] = call
+                self.leaders += 1
+                leader = True
+            else:
+                call.waiters += 1
+                self.shared += 1
+                leader = False
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+
+                call.event.set()
+
+            return call.result
+
+        if not call.event.wait(timeout):
+            with self.lock:
+                self.timeouts += 1
+
+            return on_timeout
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result
+
+    def get_stats(self):
+        """
+        Get how many calls were done and how many callers shared them
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {"in_flight": len(self.calls), "calls": self.leaders, "shared": self.shared, "timeouts": self.timeouts}
+
+
+single_flight = SingleFlight()
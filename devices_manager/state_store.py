@@ -0,0 +1,108 @@
+import threading
+import time
+
+
+class DeviceState:
+    """
+    Last known status of a device
+    """
+
+    __slots__ = ("status", "updated_at", "changed_at")
+
+    def __init__(self, status, updated_at):
+        self.status = status
+        self.updated_at = updated_at
+        self.changed_at = updated_at
+
+
+class StateStore:
+    """
+    Provide an in-memory store of the last known status of each device, keyed by device id
+    """
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.stale = 0
+        self.misses = 0
+
+    def put(self, device_id, status):
+        """
+        Store the status read from a device
+
+        :param device_id: ID of device
+        :param status: JSON returned by the device
+        :return: True if the status changed | False
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            state = self.states.get(device_id)
+
+            if state is None:
+                self.states[device_id] = DeviceState(status, now)
+
+                return True
+
+            state.updated_at = now
+
+            if state.status != status:
+                state.status = status
+                state.changed_at = now
+
+                return True
+
+            return False
+
+    def get(self, device_id, max_age):
+        """
+        Get the status of a device if it was read at most max_age seconds ago
+
+        :param device_id: ID of device
+        :param max_age: Seconds
+        :return: JSON | None
+        """
+
+        with self.lock:
+            state = self.states.get(device_id)
+
+            if state is None:
+                self.misses += 1
+
+                return None
+
+            if time.monotonic() - state.updated_at > max_age:
+                self.stale += 1
+
+                return None
+
+            self.hits += 1
+
+            return state.status
+
+    def invalidate(self, device_id):
+        """
+        Forget the status of a device, e.g. after a command changed it
+
+        :param device_id: ID of device
+        :return: void
+        """
+
+        with self.lock:
+            self.states.pop(device_id, None)
+
+    def get_stats(self):
+        """
+        Get hit/miss counters of the store
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {"devices": len(self.states), "hits": self.hits, "stale": self.stale, "misses": self.misses}
+
+
+state_store = StateStore()
@@ -1,11 +1,14 @@
-import mysql.connector as mysql
+from database.backend import DatabaseError
 from database.database import Database
 from services.logger_service import LoggerService
+from services.shared_cache_service import shared_cache
 
 logging_service = LoggerService(name=__name__)
 
 logger = logging_service.get_logger()
 
+POWER_STRIP_SEQUENCE = "power_strip"
+
 
 class DeviceSchema:
     def __init__(self):
@@ -14,9 +17,13 @@ class DeviceSchema:
 
         self.create_device_table()
         self.create_power_strip_table()
+        self.create_device_group_table()
+        self.create_device_group_member_table()
+        self.create_sequence_table()
 
     def __del__(self):
-        self.conn.close()
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
 
     def create_device_table(self):
         query = """
@@ -54,6 +61,93 @@ class DeviceSchema:
         self.curs.execute(query)
         self.conn.commit()
 
+    def create_device_group_table(self):
+        """
+        Init device_group table
+
+        :return: void
+        """
+
+        query = """
+                CREATE TABLE IF NOT EXISTS device_group (
+                    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL UNIQUE
+                );
+                """
+
+        self.curs.execute(query)
+        self.conn.commit()
+
+    def create_device_group_member_table(self):
+        """
+        Init device_group_member table
+
+        :return: void
+        """
+
+        query = """
+                CREATE TABLE IF NOT EXISTS device_group_member (
+                    group_id INT NOT NULL,
+                    device_id CHAR(40) NOT NULL,
+                    PRIMARY KEY (group_id, device_id),
+                    FOREIGN KEY (group_id)
+                        REFERENCES device_group(id)
+                        ON DELETE CASCADE,
+                    FOREIGN KEY (device_id)
+                        REFERENCES device(id)
+                        ON DELETE CASCADE
+                );
+                """
+
+        self.curs.execute(query)
+        self.conn.commit()
+
+    def create_sequence_table(self):
+        """
+        Init sequence table, used to give default names without looking for a free one
+
+        :return: void
+        """
+
+        query = """
+                CREATE TABLE IF NOT EXISTS sequence (
+                    name VARCHAR(50) NOT NULL PRIMARY KEY,
+                    value INT NOT NULL
+                );
+                """
+
+        self.curs.execute(query)
+        self.conn.commit()
+
+        query = """
+                SELECT EXISTS (
+                    SELECT *
+                    FROM sequence
+                    WHERE name=%s
+                )
+                """
+
+        self.curs.execute(query, (POWER_STRIP_SEQUENCE,))
+
+        if not self.curs.fetchone()[0]:
+            # Start after the default names already given by older versions
+            query = """
+                    SELECT DISTINCT name
+                    FROM power_strip
+                    WHERE name LIKE 'PS%'
+                    """
+
+            self.curs.execute(query)
+            numbers = [int(name[3:]) for (name,) in self.curs.fetchall() if name.startswith("PS_") and name[3:].isdigit()]
+
+            query = """
+                    INSERT INTO sequence(name, value)
+                    VALUES (%s, %s)
+                    """
+
+            self.curs.execute(query, (POWER_STRIP_SEQUENCE, max(numbers, default=0)))
+            self.conn.commit()
+
 
 class DeviceModel:
     """
@@ -64,6 +158,10 @@ class DeviceModel:
         self.conn = Database().get_conn()
         self.curs = self.conn.cursor()
 
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
     def create(self, id, ip, type, path):
         """
         Create new device
@@ -83,8 +181,11 @@ class DeviceModel:
             self.curs.execute(query, (id, ip, type, path))
             self.conn.commit()
 
+            # The other workers read the devices again
+            Database.on_commit(shared_cache.invalidate_devices)
+
             return True
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("device_model -> create_device")
 
             return False
@@ -106,8 +207,10 @@ class DeviceModel:
             self.curs.execute(query, (id,))
             self.conn.commit()
 
+            Database.on_commit(shared_cache.invalidate_devices)
+
             return True
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("device_model -> delete_device")
 
             return False
@@ -131,10 +234,9 @@ class DeviceModel:
         try:
             self.curs.execute(query, (id,))
             res = self.curs.fetchone()
-            self.conn.commit()
 
             return bool(res[0])
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("device_model -> check_id")
 
             return False
@@ -149,10 +251,9 @@ class DeviceModel:
         try:
             self.curs.execute(query, (id,))
             res = self.curs.fetchone()
-            self.conn.commit()
 
             return res[0]
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("device_model -> get_ip")
 
             return False
@@ -167,14 +268,135 @@ class DeviceModel:
         try:
             self.curs.execute(query, (id,))
             res = self.curs.fetchone()
-            self.conn.commit()
 
             return res[0]
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("device_model -> get_path")
 
             return False
 
+    def get_device(self, id):
+        """
+        Get data of a device
+
+        :param id:
+        :return: tuple(ip, path, type) | None | False
+        """
+
+        query = """
+                SELECT ip, path, type
+                FROM device
+                WHERE id=%s
+                """
+
+        try:
+            self.curs.execute(query, (id,))
+
+            return self.curs.fetchone()
+        except DatabaseError:
+            logger.exception("device_model -> get_device")
+
+            return False
+
+    def get_all(self):
+        """
+        Get all devices
+
+        :return: list(tuple(id, ip, type, path)) | False
+        """
+
+        query = """
+                SELECT id, ip, type, path
+                FROM device
+                """
+
+        try:
+            self.curs.execute(query)
+            res = self.curs.fetchall()
+
+            return res
+        except DatabaseError:
+            logger.exception("device_model -> get_all")
+
+            return False
+
+    def get_push_secret(self, id):
+        """
+        Get the secret a device signs its state reports with
+
+        :param id:
+        :return: str | None if the device or its secret do not exist | False
+        """
+
+        query = """
+                SELECT push_secret
+                FROM device
+                WHERE id=%s
+                """
+
+        try:
+            self.curs.execute(query, (id,))
+            res = self.curs.fetchone()
+
+            return res[0] if res else None
+        except DatabaseError:
+            logger.exception("device_model -> get_push_secret")
+
+            return False
+
+    def set_push_secret(self, id, secret):
+        """
+        Set the secret a device signs its state reports with, the sequence of its reports starts again
+
+        :param id:
+        :param secret:
+        :return: True | False
+        """
+
+        query = """
+                UPDATE device
+                SET push_secret=%s, push_boot=-1, push_seq=-1
+                WHERE id=%s
+                """
+
+        try:
+            self.curs.execute(query, (secret, id))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("device_model -> set_push_secret")
+
+            return False
+
+    def advance_push_sequence(self, id, boot, seq):
+        """
+        Store the (boot, seq) of a state report only if it is newer than the last one, in a single conditional query,
+        so that a report is accepted once whatever the process that receives it
+
+        :param id:
+        :param boot: Counter the device increases at each restart
+        :param seq: Counter of the reports since the restart
+        :return: 1 if newer | 0 if a duplicate or a replay | False
+        """
+
+        query = """
+                UPDATE device
+                SET push_boot=%s, push_seq=%s
+                WHERE id=%s AND (push_boot < %s OR (push_boot = %s AND push_seq < %s))
+                """
+
+        try:
+            self.curs.execute(query, (boot, seq, id, boot, boot, seq))
+            count = self.curs.rowcount
+            self.conn.commit()
+
+            return count
+        except DatabaseError:
+            logger.exception("device_model -> advance_push_sequence")
+
+            return False
+
 
 class PowerStripModel:
     """
@@ -185,6 +407,10 @@ class PowerStripModel:
         self.conn = Database().get_conn()
         self.curs = self.conn.cursor()
 
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
     def create(self, device_id, name, switch_number, switch_name):
         """
         Create new power strip
@@ -206,11 +432,68 @@ class PowerStripModel:
             self.conn.commit()
 
             return True
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("power_strip_model -> create")
 
             return False
 
+    def create_many(self, device_id, name, switch_names):
+        """
+        Create new power strip with all its switches in a single statement
+
+        :param device_id:
+        :param name: The name of the power strip
+        :param switch_names: Name of each switch, by switch number
+        :return: True | False
+        """
+
+        query = """
+                INSERT INTO power_strip(device_id, name, switch_number, switch_name)
+                VALUES (%s, %s, %s, %s)
+                """
+
+        try:
+            self.curs.executemany(query, [(device_id, name, switch_number, switch_name) for switch_number, switch_name in enumerate(switch_names)])
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("power_strip_model -> create_many")
+
+            return False
+
+    def next_name_number(self):
+        """
+        Get a number never used for a default power strip name (PS_<number>).
+        The sequence row stays locked until the end of the transaction
+
+        :return: Number | False
+        """
+
+        update_query = """
+                       UPDATE sequence
+                       SET value=value + 1
+                       WHERE name=%s
+                       """
+
+        select_query = """
+                       SELECT value
+                       FROM sequence
+                       WHERE name=%s
+                       """
+
+        try:
+            self.curs.execute(update_query, (POWER_STRIP_SEQUENCE,))
+            self.curs.execute(select_query, (POWER_STRIP_SEQUENCE,))
+            res = self.curs.fetchone()
+            self.conn.commit()
+
+            return res[0]
+        except DatabaseError:
+            logger.exception("power_strip_model -> next_name_number")
+
+            return False
+
     def delete(self, device_id):
         """
         Delete power strip by device_id
@@ -229,7 +512,7 @@ class PowerStripModel:
             self.conn.commit()
 
             return True
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("power_strip_model -> delete")
 
             return False
@@ -254,7 +537,7 @@ class PowerStripModel:
             self.conn.commit()
 
             return True
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("power_strip_model -> update_name")
 
             return False
@@ -280,7 +563,7 @@ class PowerStripModel:
             self.conn.commit()
 
             return True
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("power_strip_model -> update_switch_name")
 
             return False
@@ -304,10 +587,9 @@ class PowerStripModel:
         try:
             self.curs.execute(query, (name,))
             res = self.curs.fetchone()
-            self.conn.commit()
 
             return bool(res[0])
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("power_strip_model -> check_name")
 
             return False
@@ -329,10 +611,194 @@ class PowerStripModel:
         try:
             self.curs.execute(query, (id,))
             res = self.curs.fetchone()
-            self.conn.commit()
 
             return res[0]
-        except mysql.Error:
+        except DatabaseError:
             logger.exception("power_strip_model -> get_switch_number")
 
             return False
+
+
+class DeviceGroupModel:
+    """
+    Provide methods for device_group data management into the DB
+    """
+
+    def __init__(self):
+        self.conn = Database().get_conn()
+        self.curs = self.conn.cursor()
+
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
+    def create(self, name):
+        """
+        Create new group of devices
+
+        :param name: The name of the group
+        :return: ID of the group | False
+        """
+
+        query = """
+                INSERT INTO device_group(name)
+                VALUES (%s)
+                """
+
+        try:
+            self.curs.execute(query, (name,))
+            id = self.curs.lastrowid
+            self.conn.commit()
+
+            return id
+        except DatabaseError:
+            logger.exception("device_group_model -> create")
+
+            return False
+
+    def delete(self, id):
+        """
+        Delete group by id, its devices are not deleted
+
+        :param id: ID of the group
+        :return: True | False
+        """
+
+        query = """
+                DELETE FROM device_group
+                WHERE id=%s
+                """
+
+        try:
+            self.curs.execute(query, (id,))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("device_group_model -> delete")
+
+            return False
+
+    def check_id(self, id):
+        """
+        Check if group id exists into the DB
+
+        :param id: ID of the group
+        :return: True | False
+        """
+
+        query = """
+                SELECT EXISTS (
+                    SELECT *
+                    FROM device_group
+                    WHERE id=%s
+                )
+                """
+
+        try:
+            self.curs.execute(query, (id,))
+            res = self.curs.fetchone()
+
+            return bool(res[0])
+        except DatabaseError:
+            logger.exception("device_group_model -> check_id")
+
+            return False
+
+    def check_name(self, name):
+        """
+        Check if group name exists into the DB
+
+        :param name: The name of the group
+        :return: True | False
+        """
+
+        query = """
+                SELECT EXISTS (
+                    SELECT *
+                    FROM device_group
+                    WHERE name=%s
+                )
+                """
+
+        try:
+            self.curs.execute(query, (name,))
+            res = self.curs.fetchone()
+
+            return bool(res[0])
+        except DatabaseError:
+            logger.exception("device_group_model -> check_name")
+
+            return False
+
+    def add_member(self, id, device_id):
+        """
+        Add a device to a group, nothing changes if it is already there
+
+        :param id: ID of the group
+        :param device_id: ID of device
+        :return: True | False
+        """
+
+        query = """
+                INSERT IGNORE INTO device_group_member(group_id, device_id)
+                VALUES (%s, %s)
+                """
+
+        try:
+            self.curs.execute(query, (id, device_id))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("device_group_model -> add_member")
+
+            return False
+
+    def remove_member(self, id, device_id):
+        """
+        Remove a device from a group
+
+        :param id: ID of the group
+        :param device_id: ID of device
+        :return: True | False
+        """
+
+        query = """
+                DELETE FROM device_group_member
+                WHERE group_id=%s AND device_id=%s
+                """
+
+        try:
+            self.curs.execute(query, (id, device_id))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("device_group_model -> remove_member")
+
+            return False
+
+    def get_members(self, id):
+        """
+        Get the devices of a group
+
+        :param id: ID of the group
+        :return: list(tuple(device_id, ip, path)) | False
+        """
+
+        query = """
+                SELECT device.id, device.ip, device.path
+                FROM device_group_member INNER JOIN device ON device.id = device_group_member.device_id
+                WHERE device_group_member.group_id=%s
+                """
+
+        try:
+            self.curs.execute(query, (id,))
+            res = self.curs.fetchall()
+
+            return res
+        except DatabaseError:
+            logger.exception("device_group_model -> get_members")
+
+            return False
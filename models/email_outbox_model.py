@@ -0,0 +1,217 @@
+from database.backend import DatabaseError
+from database.database import Database
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+
+class EmailOutboxSchema:
+    """
+    Provide methods for email outbox management
+    """
+
+    def __init__(self):
+        self.conn = Database().get_conn()
+        self.curs = self.conn.cursor()
+
+        self.create_email_outbox_table()
+
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
+    def create_email_outbox_table(self):
+        """
+        Init email_outbox table
+
+        :return: void
+        """
+
+        query = """
+                CREATE TABLE IF NOT EXISTS email_outbox (
+                    id INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+                    receiver VARCHAR(100) NOT NULL,
+                    subject VARCHAR(255) NOT NULL,
+                    message TEXT NOT NULL,
+                    attempts INT NOT NULL DEFAULT 0,
+                    next_attempt_at TIMESTAMP NULL,
+                    sent_on TIMESTAMP NULL,
+                    failed TINYINT NOT NULL DEFAULT 0
+                );
+                """
+
+        self.curs.execute(query)
+        self.conn.commit()
+
+
+class EmailOutboxModel:
+    """
+    Provide methods for email outbox management into the DB
+    """
+
+    def __init__(self):
+        self.conn = Database().get_conn()
+        self.curs = self.conn.cursor()
+
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
+    def create(self, receiver, subject, message, next_attempt_at):
+        """
+        Queue a new email
+
+        :param receiver: The receiver
+        :param subject: The subject
+        :param message: The message
+        :param next_attempt_at: When the email can be sent
+        :return: True | False
+        """
+
+        query = """
+                INSERT INTO email_outbox(receiver, subject, message, next_attempt_at)
+                VALUES (%s, %s, %s, %s)
+                """
+
+        try:
+            self.curs.execute(query, (receiver, subject, message, next_attempt_at))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("email_outbox_model -> create")
+
+            return False
+
+    def get_pending(self, now, limit):
+        """
+        Get the emails ready to be sent, oldest first
+
+        :param now: Current time
+        :param limit: Max number of emails
+        :return: list(tuple(id, receiver, subject, message, attempts, next_attempt_at)) | False
+        """
+
+        query = """
+                SELECT id, receiver, subject, message, attempts, next_attempt_at
+                FROM email_outbox
+                WHERE sent_on IS NULL AND failed=0 AND next_attempt_at <= %s
+                ORDER BY id
+                LIMIT %s
+                """
+
+        try:
+            self.curs.execute(query, (now, limit))
+            res = self.curs.fetchall()
+            self.conn.commit()
+
+            return res
+        except DatabaseError:
+            logger.exception("email_outbox_model -> get_pending")
+
+            return False
+
+    def claim(self, id, next_attempt_at, lease_until):
+        """
+        Take an email for sending, so that other workers skip it until lease_until
+
+        :param id: ID of the email
+        :param next_attempt_at: The value read by get_pending
+        :param lease_until: When the email can be taken again if not sent
+        :return: True | False
+        """
+
+        query = """
+                UPDATE email_outbox
+                SET next_attempt_at=%s
+                WHERE id=%s AND next_attempt_at=%s AND sent_on IS NULL
+                """
+
+        try:
+            self.curs.execute(query, (lease_until, id, next_attempt_at))
+            claimed = self.curs.rowcount == 1
+            self.conn.commit()
+
+            return claimed
+        except DatabaseError:
+            logger.exception("email_outbox_model -> claim")
+
+            return False
+
+    def mark_sent(self, id, sent_on):
+        """
+        Mark an email as sent
+
+        :param id: ID of the email
+        :param sent_on: When the email was sent
+        :return: True | False
+        """
+
+        query = """
+                UPDATE email_outbox
+                SET sent_on=%s
+                WHERE id=%s
+                """
+
+        try:
+            self.curs.execute(query, (sent_on, id))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("email_outbox_model -> mark_sent")
+
+            return False
+
+    def mark_retry(self, id, attempts, next_attempt_at, failed):
+        """
+        Record a failed attempt
+
+        :param id: ID of the email
+        :param attempts: Number of attempts done
+        :param next_attempt_at: When the email can be sent again
+        :param failed: True if the email will not be sent anymore
+        :return: True | False
+        """
+
+        query = """
+                UPDATE email_outbox
+                SET attempts=%s, next_attempt_at=%s, failed=%s
+                WHERE id=%s
+                """
+
+        try:
+            self.curs.execute(query, (attempts, next_attempt_at, int(failed), id))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("email_outbox_model -> mark_retry")
+
+            return False
+
+    def delete_done(self, before):
+        """
+        Delete the emails sent or failed before a time, so that the table does not keep old OTP codes
+
+        :param before: Emails done before this time are deleted
+        :return: Number of deleted emails | False
+        """
+
+        query = """
+                DELETE FROM email_outbox
+                WHERE sent_on < %s OR (failed=1 AND next_attempt_at < %s)
+                """
+
+        try:
+            self.curs.execute(query, (before, before))
+            count = self.curs.rowcount
+            self.conn.commit()
+
+            return count
+        except DatabaseError:
+            logger.exception("email_outbox_model -> delete_done")
+
+            return False
@@ -1,4 +1,4 @@
-import mysql.connector as mariadb
+from database.backend import DatabaseError
 from database.database import Database
 from services.logger_service import LoggerService
 
@@ -19,7 +19,8 @@ class OctoPrintSchema:
         self.create_octoprint_table()
 
     def __del__(self):
-        self.conn.close()
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
 
     def create_octoprint_table(self):
         """
@@ -49,6 +50,10 @@ class OctoPrintModel:
         self.conn = Database().get_conn()
         self.curs = self.conn.cursor()
 
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
     def create(self, ip, host, x_api_key):
         """
         Create new OctoPrint profile
@@ -69,7 +74,7 @@ class OctoPrintModel:
             self.conn.commit()
 
             return True
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("octoprint_model -> create")
 
             return False
@@ -92,7 +97,7 @@ class OctoPrintModel:
             self.conn.commit()
 
             return True
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("octoprint_model -> delete")
 
             return False
@@ -0,0 +1,126 @@
+from database.backend import DatabaseError
+from database.database import Database
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+
+class TokenSchema:
+    """
+    Provide methods for session token management
+    """
+
+    def __init__(self):
+        self.conn = Database().get_conn()
+        self.curs = self.conn.cursor()
+
+        self.create_token_revocation_table()
+
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
+    def create_token_revocation_table(self):
+        """
+        Init token_revocation table
+
+        :return: void
+        """
+
+        query = """
+                CREATE TABLE IF NOT EXISTS token_revocation (
+                    jti CHAR(32) NOT NULL PRIMARY KEY,
+                    expires_at INT NOT NULL
+                );
+                """
+
+        self.curs.execute(query)
+        self.conn.commit()
+
+
+class TokenRevocationModel:
+    """
+    Provide methods for revoked session tokens into the DB, shared by every app instance
+    """
+
+    def __init__(self):
+        self.conn = Database().get_conn()
+        self.curs = self.conn.cursor()
+
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
+    def create(self, jti, expires_at):
+        """
+        Revoke a token
+
+        :param jti: ID of the token
+        :param expires_at: Unix time when the token expires anyway
+        :return: True | False
+        """
+
+        query = """
+                REPLACE INTO token_revocation(jti, expires_at)
+                VALUES (%s, %s)
+                """
+
+        try:
+            self.curs.execute(query, (jti, expires_at))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("token_model -> create")
+
+            return False
+
+    def get_active(self, now):
+        """
+        Get the revoked tokens not expired yet
+
+        :param now: Unix time
+        :return: list(tuple(jti, expires_at)) | False
+        """
+
+        query = """
+                SELECT jti, expires_at
+                FROM token_revocation
+                WHERE expires_at > %s
+                """
+
+        try:
+            self.curs.execute(query, (now,))
+            res = self.curs.fetchall()
+            self.conn.commit()
+
+            return res
+        except DatabaseError:
+            logger.exception("token_model -> get_active")
+
+            return False
+
+    def delete_expired(self, now):
+        """
+        Forget the revoked tokens that expired
+
+        :param now: Unix time
+        :return: True | False
+        """
+
+        query = """
+                DELETE FROM token_revocation
+                WHERE expires_at <= %s
+                """
+
+        try:
+            self.curs.execute(query, (now,))
+            self.conn.commit()
+
+            return True
+        except DatabaseError:
+            logger.exception("token_model -> delete_expired")
+
+            return False
@@ -1,5 +1,6 @@
-import mysql.connector as mariadb
+from database.backend import DatabaseError
 from database.database import Database
+from services.auth_cache_service import auth_cache
 from services.logger_service import LoggerService
 
 logging_service = LoggerService(name=__name__)
@@ -26,7 +27,8 @@ class UserSchema:
         :return: void
         """
 
-        self.conn.close()
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
 
     def create_user_table(self):
         """
@@ -83,6 +85,10 @@ class UserModel:
         self.conn = Database().get_conn()
         self.curs = self.conn.cursor()
 
+    def __del__(self):
+        if getattr(self, "conn", None) is not None:
+            self.conn.close()
+
     def create(self, name: str, surname: str, username: str, email: str, api_key: str):
         """
         Create new user.
@@ -104,8 +110,11 @@ class UserModel:
             self.curs.execute(query, (name, surname, username, email, api_key))
             self.conn.commit()
 
+            # The api_key may be cached as not valid, by any worker
+            Database.on_commit(lambda: auth_cache.invalidate(api_key))
+
             return api_key
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("user_model -> create")
 
             return False
@@ -114,23 +123,6 @@ class UserModel:
     def delete(self):
         pass
 
-    def update_otp(self, otp_requests, otp_timestamp, api_key):
-        query = """
-                UPDATE user
-                SET otp_requests=%s, last_otp_timestamp=%s
-                WHERE api_key=%s
-                """
-
-        try:
-            self.curs.execute(query, (otp_requests, otp_timestamp, api_key))
-            self.conn.commit()
-
-            return True
-        except mariadb.Error:
-            logger.exception("user_model -> update_otp")
-
-            return False
-
     def reset_otp_requests(self, api_key):
         query = """
                 UPDATE user
@@ -143,29 +135,11 @@ class UserModel:
             self.conn.commit()
 
             return True
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("user_model -> reset_otp_requests")
 
             return False
 
-    def get_otp_requests(self, api_key):
-        query = """
-                SELECT otp_requests
-                FROM user 
-                WHERE api_key=%s
-                """
-
-        try:
-            self.curs.execute(query, (api_key,))
-            res = self.curs.fetchone()
-            self.conn.commit()
-
-            return res[0]
-        except mariadb.Error:
-            logger.exception("user_model -> get_otp_requests")
-
-            return False
-
     def check_user(self, email: str, api_key: str):
         """
         Find user by:
@@ -189,7 +163,7 @@ class UserModel:
             self.conn.commit()
 
             return bool(res[0])
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("user_model -> check_user")
 
             return False
@@ -216,7 +190,7 @@ class UserModel:
             self.conn.commit()
 
             return bool(res[0])
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("user_model -> check_username")
 
             return False
@@ -243,66 +217,73 @@ class UserModel:
             self.conn.commit()
 
             return bool(res[0])
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("user_model -> check_api_key")
 
             return False
 
-    def get_user_with_otp(self, email, api_key, otp):
+    def reserve_otp(self, email: str, api_key: str, max_requests: int):
         """
-        Find user by:
+        Count a new OTP request of the user, in a single query.
+        The count restarts when the last OTP was sent at least 10 minutes ago
 
         :param email:
         :param api_key:
-        :param otp:
-        :return: True | False
+        :param max_requests: Max OTP requests in 10 minutes
+        :return: True | False if the user does not exist or the limit is reached
         """
 
-        # NOTE: "SELECT EXISTS" -> Not work
         query = """
-                SELECT user.email, user.api_key, otp.otp_code
-                FROM user INNER JOIN otp ON otp.api_key = user.api_key
-                WHERE user.email=%s AND user.api_key=%s AND otp.otp_code=%s
-                AND otp.otp_timestamp >= NOW() - INTERVAL 5 MINUTE
+                UPDATE user
+                SET otp_requests = CASE
+                        WHEN last_otp_timestamp IS NULL OR last_otp_timestamp <= NOW() - INTERVAL 10 MINUTE THEN 1
+                        ELSE otp_requests + 1
+                    END,
+                    last_otp_timestamp = NOW()
+                WHERE email=%s AND api_key=%s
+                AND (last_otp_timestamp IS NULL OR last_otp_timestamp <= NOW() - INTERVAL 10 MINUTE OR otp_requests < %s)
                 """
 
         try:
-            self.curs.execute(query, (email, api_key, otp))
-            res = self.curs.fetchone()
+            self.curs.execute(query, (email, api_key, max_requests))
+            reserved = self.curs.rowcount == 1
             self.conn.commit()
 
-            if res is not None:
-                return True
+            return reserved
+        except DatabaseError:
+            logger.exception("user_model -> reserve_otp")
 
             return False
-        except mariadb.Error:
-            logger.exception("user_model -> get_user_with_otp")
 
-            return False
-
-    def check_user_otp_timestamp(self, api_key):
+    def use_otp(self, email: str, api_key: str, otp_code: int):
         """
-        Check if the last OTP was sent at least 10 minutes ago
+        Delete the OTP of the user if it matches and is not older than 5 minutes, in a single query
 
+        :param email:
         :param api_key:
+        :param otp_code:
         :return: True | False
         """
+
         query = """
-                SELECT EXISTS (
-                    SELECT name
+                DELETE FROM otp
+                WHERE api_key=%s AND otp_code=%s
+                AND otp_timestamp >= NOW() - INTERVAL 5 MINUTE
+                AND EXISTS (
+                    SELECT *
                     FROM user
-                    WHERE api_key=%s AND last_otp_timestamp <= NOW() - INTERVAL 10 MINUTE
+                    WHERE user.api_key = otp.api_key AND user.email=%s
                 )
                 """
 
         try:
-            self.curs.execute(query, (api_key,))
-            res = self.curs.fetchone()
+            self.curs.execute(query, (api_key, otp_code, email))
+            used = self.curs.rowcount == 1
             self.conn.commit()
 
-            return bool(res[0])
-        except mariadb.Error:
-            logger.exception("user_model -> check_user_otp_timestamp")
+            return used
+        except DatabaseError:
+            logger.exception("user_model -> use_otp")
 
             return False
 
@@ -325,7 +306,7 @@ class UserModel:
             self.conn.commit()
 
             return True
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("user_model -> create_otp")
 
             return False
@@ -349,25 +330,7 @@ class UserModel:
             self.conn.commit()
 
             return True
-        except mariadb.Error:
+        except DatabaseError:
             logger.exception("user_model -> delete_otp")
 
             return False
-
-    def get_otp_timestamp(self, api_key):
-        query = """
-                SELECT otp_timestamp
-                FROM otp
-                WHERE api_key=%s
-                """
-
-        try:
-            self.curs.execute(query, (api_key,))
-            res = self.curs.fetchone()
-            self.conn.commit()
-
-            return res[0]
-        except mariadb.Error:
-            logger.exception("user_model -> get_otp_info")
-
-            return False
@@ -0,0 +1,499 @@
+import errno
+import json
+import os
+import secrets
+import select
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+from services.logger_service import LoggerService
+from services.shared_cache_service import shared_cache, DEFAULT_AUTH_SLOTS, DEFAULT_DEVICE_SLOTS, DEFAULT_REPORT_SLOTS
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 5000
+DEFAULT_THREADS = 6
+DEFAULT_BACKLOG = 2048
+DEFAULT_GRACEFUL_TIMEOUT = 30
+
+# Read by services.token_service, the master cannot import it, the secret rules are the ones of services.token_service
+TOKEN_KEY_ENV = "DJD_TOKEN_KEY"
+MIN_SECRET_LENGTH = 32
+PLACEHOLDER_PREFIX = "YOUR_"
+
+# A worker that dies sooner than this after its start is respawned after RESPAWN_DELAY, to not spin on a broken worker
+MIN_WORKER_LIFETIME = 5
+RESPAWN_DELAY = 1
+
+
+def load_credential(section="server"):
+    """
+    Read a section of credentials.json
+
+    :param section: Name of the section
+    :return: dict()
+    """
+
+    with open('credentials.json') as json_file:
+        file = json.load(json_file)
+
+    return file.get(section, {})
+
+
+class Worker:
+    """
+    A worker process seen by the master
+    """
+
+    __slots__ = ("pid", "index", "generation", "ready_fd", "ready", "started_at", "stopping_at")
+
+    def __init__(self, pid, index, generation, ready_fd):
+        self.pid = pid
+        self.index = index
+        self.generation = generation
+        self.ready_fd = ready_fd
+        self.ready = False
+        self.started_at = time.monotonic()
+        self.stopping_at = None
+
+
+def get_socket_prefix(credential, generation):
+    """
+    Get the prefix of the Unix socket paths of the sharded workers of a generation.
+    Each generation has its own paths, so the new workers never take over the ones the old workers still serve on
+
+    :param credential: Server section of credentials.json
+    :param generation: Generation of the workers
+    :return: str
+    """
+
+    socket_dir = credential.get("socket_dir", tempfile.gettempdir())
+
+    return os.path.join(socket_dir, "djd-" + str(credential.get("port", DEFAULT_PORT)) + "-" + str(generation) + "-worker")
+
+
+def run_worker(sock, ready_fd, credential, index, count, generation):
+    """
+    Body of a worker process: import the app, warm it up, tell the master and serve on the shared socket
+
+    :param sock: Listening socket shared by all workers
+    :param ready_fd: Pipe to the master, closed once the worker is ready
+    :param credential: Server section of credentials.json
+    :param index: Position of the worker
+    :param count: Number of workers
+    :param generation: Generation of the worker
+    :return: void
+    """
+
+    for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+        signal.signal(signum, signal.SIG_DFL)
+
+    signal.set_wakeup_fd(-1)
+
+    graceful_timeout = credential.get("graceful_timeout", DEFAULT_GRACEFUL_TIMEOUT)
+
+    if credential.get("sharded", False):
+        from services.shard_service import shard_service
+
+        shard_service.configure(index, count, get_socket_prefix(credential, generation))
+    elif index > 0:
+        from services.status_poller_service import status_poller
+
+        # Without sharding every worker sees all the devices, only the first one polls them
+        status_poller.polling = False
+
+    # Imported here so that every worker, also after a reload, runs the code on disk
+    from app import app, warm_up
+
+    warm_up()
+
+    if credential.get("async", False):
+        import uvicorn
+        from asgi import application
+
+        server = uvicorn.Server(uvicorn.Config(application, lifespan="on", timeout_graceful_shutdown=graceful_timeout))
+
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+
+        # uvicorn stops accepting and drains the requests in flight on SIGTERM
+        server.run(sockets=[sock])
+    else:
+        from waitress.server import create_server
+
+        server = create_server(app, sockets=[sock], threads=credential.get("threads", DEFAULT_THREADS))
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: stop_waitress(server, graceful_timeout))
+
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+
+        server.run()
+
+
+def stop_waitress(server, graceful_timeout):
+    """
+    Stop accepting connections and exit once the requests in flight are done, or after graceful_timeout
+
+    :param server: waitress server
+    :param graceful_timeout: Max seconds to wait for the requests in flight
+    :return: void
+    """
+
+    server.close()
+
+    def drain():
+        deadline = time.monotonic() + graceful_timeout
+        dispatcher = server.task_dispatcher
+
+        while time.monotonic() < deadline and (dispatcher.active_count or dispatcher.queue):
+            time.sleep(0.1)
+
+        # Let the main thread write the last responses
+        time.sleep(0.5)
+        os._exit(0)
+
+    threading.Thread(target=drain, name="drain", daemon=True).start()
+
+
+class PreforkServer:
+    """
+    Provide a master process that prepares the DB once and keeps a pool of worker processes serving the app on one socket.
+
+    The master never imports the app: schemas are created by a short-lived child and every worker imports the app
+    after the fork, so on SIGHUP a new generation of workers runs the code and credentials.json on disk.
+    Only the shared caches are created by the master, so that all the workers see the same memory.
+    The old generation is stopped only once all the new workers are warmed up and ready
+    """
+
+    def __init__(self, credential=None):
+        """
+        :param credential: Server section of credentials.json, None to read it
+        """
+
+        self.credential = load_credential() if credential is None else credential
+
+        self.sock = None
+        self.workers = {}
+        self.generation = 0
+        self.stopping = False
+
+        self.signals = []
+        self.wakeup_fd = None
+
+    def get_workers_count(self):
+        return self.credential.get("workers") or os.cpu_count() or 1
+
+    def bind(self):
+        """
+        Open the socket shared by all workers
+
+        :return: void
+        """
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.credential.get("host", DEFAULT_HOST), self.credential.get("port", DEFAULT_PORT)))
+        self.sock.listen(self.credential.get("backlog", DEFAULT_BACKLOG))
+        self.sock.setblocking(False)
+
+    def init_schema(self):
+        """
+        Create the schemas and apply the migrations in a child process, so the master keeps no DB connection
+
+        :return: True | False
+        """
+
+        pid = os.fork()
+
+        if pid == 0:
+            code = 1
+
+            try:
+                from app import init_schema
+
+                init_schema()
+                code = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+
+        _, status = os.waitpid(pid, 0)
+
+        return os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+    def spawn(self, index):
+        """
+        Fork a worker of the current generation
+
+        :param index: Position of the worker, kept when it is respawned
+        :return: void
+        """
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+
+        if pid == 0:
+            os.close(read_fd)
+            code = 1
+
+            try:
+                run_worker(self.sock, write_fd, self.credential, index, self.get_workers_count(), self.generation)
+                code = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(code)
+
+        os.close(write_fd)
+
+        self.workers[pid] = Worker(pid, index, self.generation, read_fd)
+
+    def spawn_generation(self):
+        for index in range(self.get_workers_count()):
+            self.spawn(index)
+
+    def on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    def install_signals(self):
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(write_fd, False)
+
+        self.wakeup_fd = read_fd
+        signal.set_wakeup_fd(write_fd)
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGCHLD):
+            signal.signal(signum, self.on_signal)
+
+    def run(self):
+        """
+        Prepare the DB, start the workers and keep them running until SIGTERM or SIGINT
+
+        :return: void
+        """
+
+        if not self.init_schema():
+            logger.error("server -> schema init failed")
+            sys.exit(1)
+
+        self.bind()
+        self.create_shared_cache()
+        self.share_token_key()
+        self.install_signals()
+        self.spawn_generation()
+
+        logger.info("server -> listening on port " + str(self.credential.get("port", DEFAULT_PORT)) + " with " + str(self.get_workers_count()) + " workers")
+
+        while self.workers or not self.stopping:
+            self.wait()
+
+            while self.signals:
+                signum = self.signals.pop(0)
+
+                if signum == signal.SIGHUP and not self.stopping:
+                    self.reload()
+                elif signum in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+                    self.stop()
+
+            self.reap()
+            self.manage()
+
+        self.sock.close()
+        shared_cache.close()
+
+    def create_shared_cache(self):
+        """
+        Create the caches shared by all workers, of all generations, unless "shared_cache" is false
+
+        :return: void
+        """
+
+        options = self.credential.get("shared_cache", True)
+
+        if options is False:
+            return
+
+        options = options if isinstance(options, dict) else {}
+
+        shared_cache.create(options.get("auth_slots", DEFAULT_AUTH_SLOTS), options.get("device_slots", DEFAULT_DEVICE_SLOTS), options.get("report_slots", DEFAULT_REPORT_SLOTS))
+
+    def share_token_key(self):
+        """
+        Give all workers, of all generations, the same token key when credentials.json has no usable one,
+        otherwise a token issued by a worker is rejected by the others
+
+        :return: void
+        """
+
+        keys = load_credential("tokens").get("keys", {}).values()
+        usable = [secret for secret in keys if isinstance(secret, str) and len(secret) >= MIN_SECRET_LENGTH and not secret.startswith(PLACEHOLDER_PREFIX)]
+
+        if usable or os.environ.get(TOKEN_KEY_ENV):
+            return
+
+        logger.warning("server -> no token keys in credentials.json, tokens are valid until the server is restarted")
+
+        os.environ[TOKEN_KEY_ENV] = secrets.token_hex(32)
+
+    def wait(self):
+        """
+        Sleep until a signal or a worker ready, at most one second
+
+        :return: void
+        """
+
+        starting = {worker.ready_fd: worker for worker in self.workers.values() if not worker.ready}
+
+        try:
+            readable, _, _ = select.select([self.wakeup_fd] + list(starting), [], [], 1)
+        except InterruptedError:
+            return
+
+        for fd in readable:
+            if fd == self.wakeup_fd:
+                os.read(fd, 512)
+            else:
+                worker = starting[fd]
+
+                if os.read(fd, 1):
+                    worker.ready = True
+
+                os.close(fd)
+                worker.ready_fd = None
+
+    def reap(self):
+        """
+        Collect the workers that exited, respawning the ones of the current generation
+
+        :return: void
+        """
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            worker = self.workers.pop(pid, None)
+
+            if worker is None:
+                continue
+
+            if worker.ready_fd is not None:
+                os.close(worker.ready_fd)
+
+            self.remove_socket(worker)
+
+            if worker.generation == self.generation and worker.stopping_at is None and not self.stopping:
+                logger.error("server -> worker " + str(pid) + " exited with status " + str(status))
+
+                if time.monotonic() - worker.started_at < MIN_WORKER_LIFETIME:
+                    time.sleep(RESPAWN_DELAY)
+
+                self.spawn(worker.index)
+
+    def remove_socket(self, worker):
+        """
+        Remove the Unix socket path of a sharded worker that exited
+
+        :param worker: Worker
+        :return: void
+        """
+
+        if not self.credential.get("sharded", False):
+            return
+
+        try:
+            os.unlink(get_socket_prefix(self.credential, worker.generation) + "-" + str(worker.index) + ".sock")
+        except FileNotFoundError:
+            pass
+
+    def manage(self):
+        """
+        Stop the old generation once the new one is ready and kill the workers that did not stop in time
+
+        :return: void
+        """
+
+        current = [worker for worker in self.workers.values() if worker.generation == self.generation]
+
+        if len(current) >= self.get_workers_count() and all(worker.ready for worker in current):
+            for worker in self.workers.values():
+                if worker.generation != self.generation and worker.stopping_at is None:
+                    self.terminate(worker)
+
+        deadline = time.monotonic() - self.credential.get("graceful_timeout", DEFAULT_GRACEFUL_TIMEOUT) - 5
+
+        for worker in self.workers.values():
+            if worker.stopping_at is not None and worker.stopping_at < deadline:
+                self.kill(worker.pid, signal.SIGKILL)
+
+    def terminate(self, worker):
+        worker.stopping_at = time.monotonic()
+
+        self.kill(worker.pid, signal.SIGTERM)
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def reload(self):
+        """
+        Start a new generation of workers with the code and the configuration on disk, the old one serves until it is ready
+
+        :return: void
+        """
+
+        try:
+            credential = load_credential()
+        except (OSError, ValueError):
+            logger.exception("server -> reload")
+
+            return
+
+        if not self.init_schema():
+            logger.error("server -> schema init failed, reload aborted")
+
+            return
+
+        # The socket stays the same, a new host or port needs a restart
+        self.credential = {**credential, "host": self.credential.get("host", DEFAULT_HOST), "port": self.credential.get("port", DEFAULT_PORT)}
+        self.generation += 1
+
+        logger.info("server -> reload, generation " + str(self.generation))
+
+        self.spawn_generation()
+
+    def stop(self):
+        """
+        Stop all the workers, letting them finish the requests in flight
+
+        :return: void
+        """
+
+        self.stopping = True
+
+        for worker in self.workers.values():
+            if worker.stopping_at is None:
+                self.terminate(worker)
+
+
+if __name__ == "__main__":
+    PreforkServer().run()
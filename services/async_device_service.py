@@ -0,0 +1,269 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import json
+
+from models.device_model import DeviceGroupModel
+from models.user_model import UserModel
+from devices_manager.async_device_manager import AsyncDeviceManager
+from devices_manager.command_queue import command_queue
+from devices_manager.state_store import state_store
+from services.auth_cache_service import auth_cache
+from services.device_registry_service import device_registry
+from services.shard_service import shard_service
+from services.device_service import DeviceService, DEFAULT_MAX_AGE, MAX_BATCH_ACTIONS
+from services.status_poller_service import status_poller
+from services.state_ingest_service import state_ingest
+from services.token_service import token_service
+
+# Max DB queries run at the same time by the event loop, keep it <= "pool_size" in credentials.json
+DEFAULT_DB_WORKERS = 6
+
+# Actions served on the event loop, the others are served by the Flask app
+ASYNC_ACTIONS = ("send", "get", "health", "group_send")
+ASYNC_BATCH_ACTIONS = ("send", "get", "group_send")
+
+db_executor = ThreadPoolExecutor(max_workers=DEFAULT_DB_WORKERS, thread_name_prefix="async-db")
+
+
+async def run_db(fn, *args):
+    """
+    Run a blocking DB call without blocking the event loop
+
+    :param fn: Callable
+    :param args: Arguments of fn
+    :return: Result of fn
+    """
+
+    return await asyncio.get_running_loop().run_in_executor(db_executor, fn, *args)
+
+
+class AsyncDeviceService:
+    """
+    Provide the /device actions that contact devices without blocking the event loop.
+    Devices are read from the registry, the DB is only used on registry or auth cache misses
+    """
+
+    make_response = staticmethod(DeviceService.make_response)
+
+    @staticmethod
+    def can_handle(data):
+        """
+        Check if a /device request can be served on the event loop
+
+        :param data: Body of the request
+        :return: True | False
+        """
+
+        # Sharded workers forward device actions on blocking sockets, they are served by the Flask app
+        if not isinstance(data, dict) or "device" in data or shard_service.is_enabled():
+            return False
+
+        if "actions" in data:
+            actions = data["actions"]
+
+            return isinstance(actions, list) and 0 < len(actions) <= MAX_BATCH_ACTIONS and \
+                all(isinstance(item, dict) and item.get("action") in ASYNC_BATCH_ACTIONS for item in actions)
+
+        return data.get("action") in ASYNC_ACTIONS
+
+    @staticmethod
+    async def is_authenticated(data):
+        """
+        Check the session token or the api_key of a request
+
+        :param data: Body of the request
+        :return: True | False
+        """
+
+        if "token" in data:
+            return token_service.verify(data["token"]) is not None
+
+        api_key = data.get("api_key")
+
+        if not isinstance(api_key, str):
+            return False
+
+        valid = auth_cache.get(api_key)
+
+        if valid is None:
+            valid = bool(await run_db(lambda: UserModel().check_api_key(api_key)))
+            auth_cache.put(api_key, valid)
+
+        return valid
+
+    @staticmethod
+    async def get_device(id):
+        """
+        Get a device from the registry, reading the DB only if it is not there
+
+        :param id: ID of device
+        :return: DeviceRecord | None
+        """
+
+        device = device_registry.peek(id)
+
+        if device is None:
+            device = await run_db(device_registry.get, id)
+
+        return device
+
+    async def manager(self, data):
+        """
+        Manage the actions accepted by can_handle
+
+        :param data: Body of the request
+        :return: dict()
+        """
+
+        if "actions" in data:
+            return await self.batch(data["actions"])
+
+        return await self.run_action(data)
+
+    async def run_action(self, item):
+        try:
+            action = item["action"]
+            info = item.get("info", {})
+
+            if action == "send":
+                return await self.send_action(info["id"], info["params"])
+            elif action == "get":
+                return await self.get_status(info["id"], info.get("max_age"), info.get("fresh", False))
+            elif action == "health":
+                return await self.get_health(info.get("id"))
+            elif action == "group_send":
+                return await self.group_send(info["group_id"], info["params"])
+            else:
+                return self.make_response(False, "Not valid action", 400)
+        except (KeyError, TypeError, AttributeError):
+            return self.make_response(False, "Not valid input", 400)
+
+    async def send_action(self, id, params):
+        device = await self.get_device(id)
+
+        if device is not None:
+            return await self.send_to_device(id, device.ip, device.path, params)
+
+        return self.make_response(False, "Not valid id", 400)
+
+    @staticmethod
+    async def send_to_device(id, ip, path, params):
+        """
+        Send action to a device, one at a time and in order with the other actions to the same device.
+        The queue is the one of the Flask app, so actions of both paths never reach the same device at the same time,
+        the action is sent on the event loop when it is its turn
+
+        :param id: ID of device
+        :param ip: IP of device
+        :param path: API path of device
+        :param params: JSON
+        :return: dict()
+        """
+
+        device_manager = AsyncDeviceManager(ip, path)
+
+        res = await command_queue.submit_async(ip, params, device_manager.get_command_key(params), lambda command_params: device_manager.send_action(json.dumps(command_params)))
+
+        return DeviceService.make_action_response(id, res)
+
+    async def get_status(self, id, max_age=None, fresh=False):
+        """
+        Get status of a device, from the state store if it is recent enough
+
+        :param id: ID of device
+        :param max_age: Max seconds since the status was read from the device
+        :param fresh: True to always ask the device
+        :return: dict()
+        """
+
+        status_poller.start()
+
+        if not fresh:
+            max_age = DEFAULT_MAX_AGE if max_age is None else max_age
+            status = state_store.get(id, max_age)
+
+            if status is None:
+                # The device may have pushed it to another worker
+                status = state_ingest.get_status(id, max_age)
+
+            if status is not None:
+                return self.make_response(True, status, 200)
+
+        device = await self.get_device(id)
+
+        if device is not None:
+            return DeviceService.make_status_response(id, await AsyncDeviceManager(device.ip, device.path).get_status())
+
+        return self.make_response(False, "Not valid id", 400)
+
+    async def get_health(self, id=None):
+        """
+        Get health state of a device, or of all devices if id is None
+
+        :param id: ID of device
+        :return: dict()
+        """
+
+        if id is None:
+            devices = await run_db(device_registry.get_all)
+
+            return self.make_response(True, {device.id: AsyncDeviceManager(device.ip).get_health() for device in devices}, 200)
+
+        device = await self.get_device(id)
+
+        if device is not None:
+            return self.make_response(True, {id: AsyncDeviceManager(device.ip).get_health()}, 200)
+
+        return self.make_response(False, "Not valid id", 400)
+
+    @staticmethod
+    def get_group_members(id):
+        """
+        Read the devices of a group, it blocks
+
+        :param id: ID of the group
+        :return: list(tuple(device_id, ip, path)) | dict() error response
+        """
+
+        device_group_model = DeviceGroupModel()
+
+        if not device_group_model.check_id(id):
+            return DeviceService.make_response(False, "Not valid group id", 400)
+
+        members = device_group_model.get_members(id)
+
+        if members is False:
+            return DeviceService.make_response(False, "Error", 500)
+
+        return members
+
+    async def group_send(self, id, params):
+        """
+        Send the same action to all devices of a group at the same time
+
+        :param id: ID of the group
+        :param params: JSON
+        :return: dict() with the response of each device
+        """
+
+        members = await run_db(self.get_group_members, id)
+
+        if isinstance(members, dict):
+            return members
+
+        results = await asyncio.gather(*[self.send_to_device(device_id, ip, path, params) for device_id, ip, path in members])
+
+        return DeviceService.make_multi_response({device_id: res for (device_id, _, _), res in zip(members, results)})
+
+    async def batch(self, actions):
+        """
+        Run the actions of a single request at the same time, the response of each one is in the same position
+
+        :param actions: list() of dict(action, info)
+        :return: dict() with the list of responses
+        """
+
+        return DeviceService.make_multi_response(list(await asyncio.gather(*[self.run_action(item) for item in actions])))
+
+
+async_device_service = AsyncDeviceService()
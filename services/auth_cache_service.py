@@ -0,0 +1,197 @@
+from collections import OrderedDict
+import threading
+import time
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_TTL = 300
+DEFAULT_NEGATIVE_TTL = 10
+
+
+class AuthCacheService:
+    """
+    Provide an in-process LRU cache, with TTL, of the api_key checks,
+    or a view on a SharedTable when the workers share their caches
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL, negative_ttl=DEFAULT_NEGATIVE_TTL):
+        """
+        :param max_size: Max number of cached api_key
+        :param ttl: Seconds a valid api_key stays cached
+        :param negative_ttl: Seconds a not valid api_key stays cached
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.shared = None
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def use_shared(self, table):
+        """
+        Keep the api_key checks in a table shared by all workers instead of this process
+
+        :param table: SharedTable
+        :return: void
+        """
+
+        with self.lock:
+            self.shared = table
+            self.entries.clear()
+
+    def check_api_key(self, api_key, loader):
+        """
+        Check if the api_key is valid, asking the loader only on cache miss
+
+        :param api_key:
+        :param loader: Callable(api_key) that returns True | False
+        :return: True | False
+        """
+
+        valid = self.get(api_key)
+
+        if valid is not None:
+            return valid
+
+        valid = bool(loader(api_key))
+
+        self.put(api_key, valid)
+
+        return valid
+
+    def get(self, api_key):
+        """
+        Get the cached result of an api_key check
+
+        :param api_key:
+        :return: True | False | None on cache miss
+        """
+
+        if self.shared is not None:
+            return self.get_shared(api_key)
+
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(api_key)
+
+            if entry is not None:
+                valid, expire_at = entry
+
+                if expire_at > now:
+                    self.entries.move_to_end(api_key)
+
+                    if valid:
+                        self.hits += 1
+                    else:
+                        self.negative_hits += 1
+
+                    return valid
+
+                del self.entries[api_key]
+
+            self.misses += 1
+
+        return None
+
+    def get_shared(self, api_key):
+        value = self.shared.get(api_key)
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+
+                return None
+
+            if value == b"\x01":
+                self.hits += 1
+
+                return True
+
+            self.negative_hits += 1
+
+            return False
+
+    def put(self, api_key, valid):
+        """
+        Store the result of an api_key check
+
+        :param api_key:
+        :param valid: True | False
+        :return: void
+        """
+
+        if self.shared is not None:
+            self.shared.put(api_key, b"\x01" if valid else b"\x00", self.ttl if valid else self.negative_ttl)
+
+            return
+
+        expire_at = time.monotonic() + (self.ttl if valid else self.negative_ttl)
+
+        with self.lock:
+            self.entries[api_key] = (valid, expire_at)
+            self.entries.move_to_end(api_key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, api_key=None):
+        """
+        Drop an api_key from the cache, or the whole cache if api_key is None
+
+        :param api_key:
+        :return: void
+        """
+
+        if self.shared is not None:
+            with self.lock:
+                self.invalidations += 1
+
+            # Seen by every worker at once
+            if api_key is None:
+                self.shared.bump_generation()
+            else:
+                self.shared.delete(api_key)
+
+            return
+
+        with self.lock:
+            self.invalidations += 1
+
+            if api_key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(api_key, None)
+
+    def get_stats(self):
+        """
+        Get hit/miss counters of the cache
+
+        :return: dict()
+        """
+
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+
+            return {
+                "shared": self.shared is not None,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "negative_hits": self.negative_hits,
+                "misses": self.misses,
+                "hit_ratio": round((self.hits + self.negative_hits) / lookups, 3) if lookups else 0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations
+            }
+
+
+auth_cache = AuthCacheService()
@@ -0,0 +1,277 @@
+import sys
+import threading
+
+from database.database import Database
+from models.device_model import DeviceModel
+from services.shared_cache_service import DEVICE_SEPARATOR
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+
+class DeviceRecord:
+    """
+    Compact copy of a row of the device table
+    """
+
+    __slots__ = ("id", "ip", "type", "path")
+
+    def __init__(self, id, ip, type, path):
+        self.id = id
+        self.ip = ip
+        # Few distinct values shared by all records
+        self.type = sys.intern(type)
+        self.path = sys.intern(path) if path is not None else None
+
+
+class DeviceRegistryService:
+    """
+    Provide an in-memory registry of the devices, indexed by id,
+    so that commands to devices do not need DB queries.
+    When the workers share their caches the devices are kept in a SharedTable: a device write increases its generation
+    and every worker reads the devices from the DB again
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+        self.shared = None
+        self.generation = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def use_shared(self, table):
+        """
+        Keep the devices in a table shared by all workers instead of this process
+
+        :param table: SharedTable
+        :return: void
+        """
+
+        with self.lock:
+            self.shared = table
+            self.by_id = {}
+            self.loaded = False
+
+    def is_loaded(self):
+        """
+        Check if the devices were read from the DB after the last device write
+
+        :return: True | False
+        """
+
+        return self.loaded and (self.shared is None or self.generation == self.shared.get_generation())
+
+    def load(self):
+        """
+        Read all devices from the DB
+
+        :return: True | False
+        """
+
+        # Read before the devices, so that a write made meanwhile makes the next access load them again
+        generation = self.shared.get_generation() if self.shared is not None else None
+
+        devices = DeviceModel().get_all()
+
+        if devices is False:
+            return False
+
+        records = [DeviceRecord(id, ip, type, path) for id, ip, type, path in devices]
+
+        with self.lock:
+            self.by_id = {}
+
+            stored = all(self._put(record, generation) for record in records)
+
+            # Otherwise a device was written meanwhile and the old generation makes the next access load them again
+            if not stored and self.shared.get_generation() == generation:
+                logger.warning("device_registry_service -> shared table full or locked, increase \"device_slots\" if full: devices kept in this process")
+
+                # The dicts of this process always hold all the devices
+                self.shared = None
+                generation = None
+
+                for record in records:
+                    self._put(record)
+
+            self.generation = generation
+            self.loaded = True
+
+        return True
+
+    def peek(self, id):
+        """
+        Get a device by id only if it is in the registry, without reading the DB
+
+        :param id: ID of device
+        :return: DeviceRecord | None
+        """
+
+        return self._get(id) if self.is_loaded() else None
+
+    def get(self, id):
+        """
+        Get a device by id, reading only that row from the DB if it is not in the registry
+
+        :param id: ID of device
+        :return: DeviceRecord | None
+        """
+
+        if not self.is_loaded():
+            self.load()
+
+        record = self._get(id)
+
+        with self.lock:
+            if record is not None:
+                self.hits += 1
+
+                return record
+
+            self.misses += 1
+
+        generation = self.shared.get_generation() if self.shared is not None else None
+        device = DeviceModel().get_device(id)
+
+        if not device:
+            return None
+
+        ip, path, type = device
+        record = DeviceRecord(id, ip, type, path)
+
+        with self.lock:
+            self._put(record, generation)
+
+        return record
+
+    def get_all(self):
+        """
+        Get all devices
+
+        :return: list(DeviceRecord)
+        """
+
+        if not self.is_loaded():
+            self.load()
+
+        if self.shared is not None:
+            values = self.shared.get_values()
+
+            if values is not None:
+                return [self.decode(value) for value in values]
+
+            # A worker died holding the lock of the shared table
+            self.detach()
+
+            return self.get_all()
+
+        return list(self.by_id.values())
+
+    def detach(self):
+        """
+        Keep the devices in this process from now on, when the shared table cannot be used
+
+        :return: void
+        """
+
+        logger.warning("device_registry_service -> shared table locked: devices kept in this process")
+
+        with self.lock:
+            self.shared = None
+            self.by_id = {}
+            self.loaded = False
+
+    def add(self, id, ip, type, path):
+        """
+        Add a device once the current work is committed
+
+        :param id: ID of device
+        :param ip: IP of device
+        :param type: Type of device
+        :param path: API path of device
+        :return: void
+        """
+
+        def put():
+            with self.lock:
+                self._put(DeviceRecord(id, ip, type, path))
+
+        Database.on_commit(put)
+
+    def remove(self, id):
+        """
+        Remove a device now and again once the current work is committed,
+        so that a concurrent read of the old row does not bring it back
+
+        :param id: ID of device
+        :return: void
+        """
+
+        def pop():
+            with self.lock:
+                if self.shared is not None:
+                    self.shared.delete(id)
+
+                    return
+
+                self.by_id.pop(id, None)
+
+        pop()
+        Database.on_commit(pop)
+
+    def _put(self, record, generation=None):
+        """
+        Store a device, must be called holding the lock
+
+        :param record: DeviceRecord
+        :param generation: Generation of the shared table read before reading the device from the DB
+        :return: True | False if the device was written meanwhile or the shared table is full
+        """
+
+        if self.shared is not None:
+            # Evicting another device would hide it from get_all
+            return self.shared.put(record.id, self.encode(record), generation=generation, evict=False)
+
+        self.by_id[record.id] = record
+
+        return True
+
+    def _get(self, id):
+        if self.shared is not None:
+            value = self.shared.get(id)
+
+            return self.decode(value) if value is not None else None
+
+        return self.by_id.get(id)
+
+    @staticmethod
+    def encode(record):
+        return DEVICE_SEPARATOR.join((record.id, record.ip, record.type, record.path or "")).encode()
+
+    @staticmethod
+    def decode(value):
+        id, ip, type, path = value.decode().split(DEVICE_SEPARATOR)
+
+        return DeviceRecord(id, ip, type, path or None)
+
+    def get_stats(self):
+        """
+        Get size and hit/miss counters of the registry
+
+        :return: dict()
+        """
+
+        values = self.shared.get_values() if self.shared is not None else None
+        devices = len(values) if values is not None else len(self.by_id)
+
+        with self.lock:
+            return {"devices": devices, "shared": self.shared is not None, "hits": self.hits, "misses": self.misses}
+
+
+device_registry = DeviceRegistryService()
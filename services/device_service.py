@@ -1,9 +1,19 @@
-from models.device_model import DeviceModel, PowerStripModel
+from models.device_model import DeviceModel, PowerStripModel, DeviceGroupModel
 from devices_manager.diy_device_manager import DeviceManager
-
+from database.database import Database
+from database.unit_of_work import UnitOfWork
+from devices_manager.state_store import state_store
+from devices_manager.command_queue import command_queue
+from services.status_poller_service import status_poller
+from services.device_registry_service import device_registry
+from services.shard_service import shard_service
+from services.state_ingest_service import state_ingest
+
+from concurrent.futures import ThreadPoolExecutor
 import hashlib
 import json
 import re
+import secrets
 
 from services.logger_service import LoggerService
 
@@ -11,15 +21,36 @@ logging_service = LoggerService(name=__name__)
 
 logger = logging_service.get_logger()
 
+# Seconds a status read from a device is served to clients that do not set "max_age"
+DEFAULT_MAX_AGE = 30
+
+# Max devices contacted at the same time by group actions, shared by all requests
+DEFAULT_FAN_OUT_WORKERS = 16
+
+# Max actions in a single /device request
+MAX_BATCH_ACTIONS = 50
+
+# Actions of a batch that write to the DB, they share the request transaction
+DB_ACTIONS = ("create", "bulk_create", "delete", "change_ps_name", "change_switch_name", "create_group", "delete_group", "add_to_group", "remove_from_group", "push_secret")
+
+fan_out_executor = ThreadPoolExecutor(max_workers=DEFAULT_FAN_OUT_WORKERS, thread_name_prefix="device-fan-out")
+
 
 class DeviceService:
     """
     Provide methods to manage devices
     """
 
-    def __init__(self):
-        self.device_model = DeviceModel()
-        self.power_strip_model = PowerStripModel()
+    def __init__(self, use_db=True):
+        """
+        :param use_db: False to serve only the actions that contact devices (send, get, health, report):
+                       outside a request each model holds a pooled connection as long as the service lives
+        """
+
+        if use_db:
+            self.device_model = DeviceModel()
+            self.power_strip_model = PowerStripModel()
+            self.device_group_model = DeviceGroupModel()
 
         self.type = DeviceManager().get_types()
 
@@ -36,6 +67,26 @@ class DeviceService:
 
         return {'valid': is_valid, 'info': info, 'code': error_code}
 
+    @staticmethod
+    def make_device_error(error_code: int):
+        """
+        Make response for a request to a device that got no answer
+
+        :param error_code: HTML error code returned by DeviceManager
+        :return: dict()
+        """
+
+        if error_code == 500:
+            return DeviceService.make_response(False, "Server error", error_code)
+        elif error_code == 429:
+            return DeviceService.make_response(False, "Too many commands", error_code)
+        elif error_code == 503:
+            return DeviceService.make_response(False, "Device offline", error_code)
+        elif error_code == 504:
+            return DeviceService.make_response(False, "Device timeout", error_code)
+        else:
+            return DeviceService.make_response(False, "Request error", error_code)
+
     def manager(self, data: dict):
         """
         Manage the different actions
@@ -47,6 +98,8 @@ class DeviceService:
         if "device" not in data:
             if data["action"] == "create":
                 return self.create(data["info"]["ip"])
+            elif data["action"] == "bulk_create":
+                return self.bulk_create(data["info"]["ips"])
             elif data["action"] == "delete":
                 return self.delete(data["info"]["device_id"])
             elif data["action"] == "change_ps_name":
@@ -56,7 +109,21 @@ class DeviceService:
             elif data["action"] == "send":
                 return self.send_action(data["info"]["id"], data["info"]["params"])
             elif data["action"] == "get":
-                return self.get_status(data["info"]["id"])
+                return self.get_status(data["info"]["id"], data["info"].get("max_age"), data["info"].get("fresh", False))
+            elif data["action"] == "health":
+                return self.get_health(data.get("info", {}).get("id"))
+            elif data["action"] == "create_group":
+                return self.group_create(data["info"]["name"])
+            elif data["action"] == "delete_group":
+                return self.group_delete(data["info"]["group_id"])
+            elif data["action"] == "add_to_group":
+                return self.group_add(data["info"]["group_id"], data["info"]["device_id"])
+            elif data["action"] == "remove_from_group":
+                return self.group_remove(data["info"]["group_id"], data["info"]["device_id"])
+            elif data["action"] == "group_send":
+                return self.group_send(data["info"]["group_id"], data["info"]["params"])
+            elif data["action"] == "push_secret":
+                return self.create_push_secret(data["info"]["device_id"])
             else:
                 return self.make_response(False, "Not valid action", 400)
 
@@ -122,23 +189,85 @@ class DeviceService:
         checked_ip = self.check_ip(ip)
 
         if checked_ip:
-            type = DeviceManager(checked_ip).get_device_type()
+            type, relay_number = self.probe(checked_ip)
 
-            if self.is_valid_type(type):
-                id = self.id_creator(checked_ip, type)
-                path = DeviceManager().get_path(type)
+            return self.register(checked_ip, type, relay_number)
 
-                if not self.device_model.check_id(id):
-                    if not self.device_model.create(id, checked_ip, type, path):
-                        logger.error("device_service -> device not added")
+        return self.make_response(False, "Not valid input", 400)
 
-                        return self.make_response(False, "Error", 500)
+    def bulk_create(self, ips: list):
+        """
+        Create many devices, asking all of them their type at the same time
+
+        :param ips: list() of IP
+        :return: dict() with the response of each IP, in the same order
+        """
+
+        if not isinstance(ips, list) or not 0 < len(ips) <= MAX_BATCH_ACTIONS:
+            return self.make_response(False, "Not valid input", 400)
+
+        checked_ips = [self.check_ip(ip) if isinstance(ip, str) else False for ip in ips]
+        futures = {index: fan_out_executor.submit(self.probe, checked_ip) for index, checked_ip in enumerate(checked_ips) if checked_ip}
+        results = []
 
-                    if type == self.type["ps"]:
-                        if not self.ps_create(id, DeviceManager(checked_ip, path).get_relay_number()):
-                            logger.error("device_service -> power strip data for id \"" + id + "\" not added")
+        for index, checked_ip in enumerate(checked_ips):
+            if index in futures:
+                type, relay_number = futures[index].result()
+                results.append(self.register(checked_ip, type, relay_number))
+            else:
+                results.append(self.make_response(False, "Not valid input", 400))
+
+        if all(res["valid"] for res in results):
+            return self.make_response(True, results, 201)
+
+        return self.make_response(False, results, 207)
+
+    def probe(self, checked_ip: str):
+        """
+        Ask a device its type and, if it is a power strip, its number of relay
+
+        :param checked_ip: IP returned by check_ip
+        :return: tuple(type, relay_number)
+        """
 
-                    return self.make_response(True, id, 201)
+        type = DeviceManager(checked_ip).get_device_type()
+        relay_number = None
+
+        if type == self.type["ps"]:
+            relay_number = DeviceManager(checked_ip, DeviceManager().get_path(type)).get_relay_number()
+
+        return type, relay_number
+
+    def register(self, checked_ip: str, type, relay_number):
+        """
+        Store a device that answered to probe
+
+        :param checked_ip: IP returned by check_ip
+        :param type: Type of device
+        :param relay_number: Number of relay of a power strip
+        :return: dict()
+        """
+
+        if self.is_valid_type(type):
+            id = self.id_creator(checked_ip, type)
+            path = DeviceManager().get_path(type)
+
+            if not self.device_model.check_id(id):
+                if not self.device_model.create(id, checked_ip, type, path):
+                    logger.error("device_service -> device not added")
+
+                    return self.make_response(False, "Error", 500)
+
+                device_registry.add(id, checked_ip, type, path)
+
+                if type == self.type["ps"]:
+                    if not self.ps_create(id, relay_number):
+                        logger.error("device_service -> power strip data for id \"" + id + "\" not added")
+
+                        # The device row is rolled back with the rest of the request
+                        return self.make_response(False, "Error", 500)
+
+                return self.make_response(True, id, 201)
 
         return self.make_response(False, "Not valid input", 400)
 
@@ -152,6 +281,9 @@ class DeviceService:
 
         if self.device_model.check_id(id):
             if self.power_strip_model.delete(id) and self.device_model.delete(id):
+                device_registry.remove(id)
+                state_store.invalidate(id)
+
                 return self.make_response(True, "Ok", 200)
             else:
                 logger.error("device_service -> delete_device")
@@ -171,25 +303,13 @@ class DeviceService:
         :return: True | False
         """
 
-        try:
-            i = 0
-            while True:
-                i += 1
-                name = "PS_" + str(i)
-
-                if not self.power_strip_model.check_name(name):
-                    break
-
-            for num in range(number):
-                switch_name = "Switch " + str(num)
-                self.power_strip_model.create(id, name, num, switch_name)
-
-            return True
-        except Exception:
-            logger.exception("device_service -> create_power_strip")
+        name_number = self.power_strip_model.next_name_number()
 
+        if name_number is False:
             return False
 
+        return self.power_strip_model.create_many(id, "PS_" + str(name_number), ["Switch " + str(num) for num in range(number)])
+
     def ps_change_name(self, id: str, new_name: str):
         """
         Update name of a specific power strip
@@ -232,38 +352,448 @@ class DeviceService:
 
             return self.make_response(False, "Not valid id", 400)
 
+    def create_push_secret(self, id: str):
+        """
+        Make a new secret for the state reports of a device, the old one stops working
+
+        :param id: ID of device
+        :return: dict() with the secret to set in the firmware
+        """
+
+        if not self.device_model.check_id(id):
+            return self.make_response(False, "Not valid id", 400)
+
+        secret = secrets.token_hex(32)
+
+        if not self.device_model.set_push_secret(id, secret):
+            return self.make_response(False, "Error", 500)
+
+        Database.on_commit(lambda: state_ingest.forget_secret(id))
+
+        return self.make_response(True, {"secret": secret}, 201)
+
     def send_action(self, id, params):
-        if self.device_model.check_id(id):
-            ip = self.device_model.get_ip(id)
-            path = self.device_model.get_path(id)
-
-            res = DeviceManager(ip, path).send_action(json.dumps(params))
-
-            if res["status_code"] == 200:
-                return self.make_response(True, res["info"]["msg"], res["status_code"])
-            elif res["status_code"] == 500:
-                return self.make_response(False, res["info"]["msg"], res["status_code"])
-            elif res["status_code"] == 400:
-                return self.make_response(False, res["info"]["msg"], res["status_code"])
-            elif res == 500:
-                return self.make_response(False, "Server error", res)
-            else:
-                return self.make_response(False, "Request error", res)
+        device = device_registry.get(id)
 
-    def get_status(self, id):
-        if self.device_model.check_id(id):
-            ip = self.device_model.get_ip(id)
-            path = self.device_model.get_path(id)
-
-            res = DeviceManager(ip, path).get_status()
-
-            if res["status_code"] == 200:
-                return self.make_response(True, res["info"], res["status_code"])
-            elif res["status_code"] == 500:
-                return self.make_response(False, res["info"]["msg"], res["status_code"])
-            elif res["status_code"] == 400:
-                return self.make_response(False, res["info"]["msg"], res["status_code"])
-            elif res == 500:
-                return self.make_response(False, "Server error", res)
-            else:
-                return self.make_response(False, "Request error", res)
+        if device is not None:
+            return self.send_to_device(id, device.ip, device.path, params)
+
+        return self.make_response(False, "Not valid id", 400)
+
+    def send_to_device(self, id, ip, path, params):
+        """
+        Send action to a device whose data was already read from the DB
+
+        :param id: ID of device
+        :param ip: IP of device
+        :param path: API path of device
+        :param params: JSON
+        :return: dict()
+        """
+
+        if not shard_service.is_local(id):
+            return self.forward(id, {"action": "send", "info": {"id": id, "params": params}})
+
+        device_manager = DeviceManager(ip, path)
+
+        # Commands to the same device are sent one at a time, in order
+        res = command_queue.submit(ip, params, device_manager.get_command_key(params), lambda command_params: device_manager.send_action(json.dumps(command_params)))
+
+        return self.make_action_response(id, res)
+
+    @staticmethod
+    def make_action_response(id, res):
+        """
+        Make response for an action sent to a device
+
+        :param id: ID of device
+        :param res: Result of DeviceManager.send_action
+        :return: dict()
+        """
+
+        if res == 202:
+            # Not answered in time, but it reached or will reach the device: retrying it would run it twice
+            return DeviceService.make_response(True, "Queued", 202)
+
+        if isinstance(res, int):
+            return DeviceService.make_device_error(res)
+
+        # The command may have changed the status of the device
+        state_store.invalidate(id)
+        status_poller.touch(id)
+
+        if res["status_code"] == 200:
+            return DeviceService.make_response(True, res["info"]["msg"], res["status_code"])
+        elif res["status_code"] == 500:
+            return DeviceService.make_response(False, res["info"]["msg"], res["status_code"])
+        elif res["status_code"] == 400:
+            return DeviceService.make_response(False, res["info"]["msg"], res["status_code"])
+        else:
+            return DeviceService.make_device_error(res["status_code"])
+
+    def get_status(self, id, max_age=None, fresh=False):
+        """
+        Get status of a device, from the state store if it is recent enough
+
+        :param id: ID of device
+        :param max_age: Max seconds since the status was read from the device
+        :param fresh: True to always ask the device
+        :return: dict()
+        """
+
+        if not shard_service.is_local(id):
+            return self.forward(id, {"action": "get", "info": {"id": id, "max_age": max_age, "fresh": fresh}})
+
+        cached = self.get_cached_status(id, max_age, fresh)
+
+        if cached is not None:
+            return cached
+
+        device = device_registry.get(id)
+
+        if device is not None:
+            return self.get_from_device(id, device.ip, device.path)
+
+        return self.make_response(False, "Not valid id", 400)
+
+    def get_cached_status(self, id, max_age=None, fresh=False):
+        """
+        Get status of a device from the state store
+
+        :param id: ID of device
+        :param max_age: Max seconds since the status was read from the device
+        :param fresh: True to always ask the device
+        :return: dict() | None if the device must be asked
+        """
+
+        status_poller.start()
+
+        if not fresh:
+            max_age = DEFAULT_MAX_AGE if max_age is None else max_age
+            status = state_store.get(id, max_age)
+
+            if status is None:
+                # The device may have pushed it to another worker
+                status = state_ingest.get_status(id, max_age)
+
+            if status is not None:
+                return self.make_response(True, status, 200)
+
+        return None
+
+    def get_from_device(self, id, ip, path):
+        """
+        Get status of a device whose data was already read from the DB
+
+        :param id: ID of device
+        :param ip: IP of device
+        :param path: API path of device
+        :return: dict()
+        """
+
+        return self.make_status_response(id, DeviceManager(ip, path).get_status())
+
+    @staticmethod
+    def make_status_response(id, res):
+        """
+        Make response for a status read from a device, keeping it in the state store
+
+        :param id: ID of device
+        :param res: Result of DeviceManager.get_status
+        :return: dict()
+        """
+
+        if isinstance(res, int):
+            return DeviceService.make_device_error(res)
+        elif res["status_code"] == 200:
+            state_store.put(id, res["info"])
+
+            return DeviceService.make_response(True, res["info"], res["status_code"])
+        elif res["status_code"] == 500:
+            return DeviceService.make_response(False, res["info"]["msg"], res["status_code"])
+        elif res["status_code"] == 400:
+            return DeviceService.make_response(False, res["info"]["msg"], res["status_code"])
+        else:
+            return DeviceService.make_device_error(res["status_code"])
+
+    def get_health(self, id=None):
+        """
+        Get health state of a device, or of all devices if id is None.
+        It does not contact the devices
+
+        :param id: ID of device
+        :return: dict()
+        """
+
+        if id is None:
+            health = {device.id: DeviceManager(device.ip).get_health() for device in device_registry.get_all() if shard_service.is_owner(device.id)}
+
+            if shard_service.is_forwarding():
+                # The other workers answer for the devices they own
+                for index in shard_service.get_others():
+                    res = shard_service.forward_to(index, {"action": "health", "info": {}})
+
+                    if res is None or not res["valid"]:
+                        return self.make_response(False, "Device owner not available", 503)
+
+                    health.update(res["info"])
+
+            return self.make_response(True, health, 200)
+
+        if not shard_service.is_local(id):
+            return self.forward(id, {"action": "health", "info": {"id": id}})
+
+        device = device_registry.get(id)
+
+        if device is not None:
+            return self.make_response(True, {id: DeviceManager(device.ip).get_health()}, 200)
+
+        return self.make_response(False, "Not valid id", 400)
+
+    @staticmethod
+    def forward(id, item):
+        """
+        Run an action on the worker that owns a device
+
+        :param id: ID of device
+        :param item: dict(action, info)
+        :return: dict()
+        """
+
+        res = shard_service.forward(id, item)
+
+        if res is None:
+            return DeviceService.make_response(False, "Device owner not available", 503)
+
+        return res
+
+    def run_owned(self, item):
+        """
+        Run an action forwarded by another worker for a device owned by this one, it needs no model
+
+        :param item: dict(action, info)
+        :return: dict()
+        """
+
+        info = item["info"]
+
+        if item["action"] == "send":
+            return self.send_action(info["id"], info["params"])
+        elif item["action"] == "get":
+            return self.get_status(info["id"], info.get("max_age"), info.get("fresh", False))
+        elif item["action"] == "health":
+            return self.get_health(info.get("id"))
+        elif item["action"] == "report":
+            return state_ingest.ingest(info["body"].encode(), info["signature"])
+
+        return self.make_response(False, "Not valid action", 400)
+
+    def group_create(self, name: str):
+        """
+        Create new group of devices
+
+        :param name: The name of the group
+        :return: dict()
+        """
+
+        if not name or self.device_group_model.check_name(name):
+            return self.make_response(False, "Not valid name", 400)
+
+        id = self.device_group_model.create(name)
+
+        if id is False:
+            return self.make_response(False, "Error", 500)
+
+        return self.make_response(True, id, 201)
+
+    def group_delete(self, id: int):
+        """
+        Delete a group, its devices are not deleted
+
+        :param id: ID of the group
+        :return: dict()
+        """
+
+        if self.device_group_model.check_id(id):
+            if self.device_group_model.delete(id):
+                return self.make_response(True, "Ok", 200)
+
+            return self.make_response(False, "Error", 500)
+
+        return self.make_response(False, "Not valid group id", 400)
+
+    def group_add(self, id: int, device_id: str):
+        """
+        Add a device to a group
+
+        :param id: ID of the group
+        :param device_id: ID of device
+        :return: dict()
+        """
+
+        if not self.device_group_model.check_id(id):
+            return self.make_response(False, "Not valid group id", 400)
+
+        if not self.device_model.check_id(device_id):
+            return self.make_response(False, "Not valid id", 400)
+
+        if self.device_group_model.add_member(id, device_id):
+            return self.make_response(True, "Ok", 200)
+
+        return self.make_response(False, "Error", 500)
+
+    def group_remove(self, id: int, device_id: str):
+        """
+        Remove a device from a group
+
+        :param id: ID of the group
+        :param device_id: ID of device
+        :return: dict()
+        """
+
+        if self.device_group_model.check_id(id):
+            if self.device_group_model.remove_member(id, device_id):
+                return self.make_response(True, "Ok", 200)
+
+            return self.make_response(False, "Error", 500)
+
+        return self.make_response(False, "Not valid group id", 400)
+
+    def group_send(self, id: int, params):
+        """
+        Send the same action to all devices of a group at the same time
+
+        :param id: ID of the group
+        :param params: JSON
+        :return: dict() with the response of each device
+        """
+
+        res = self.group_send_submit(id, params)
+
+        if "futures" not in res:
+            return res
+
+        return self.group_send_collect(res["futures"])
+
+    def group_send_submit(self, id: int, params):
+        """
+        Start sending the same action to all devices of a group
+
+        :param id: ID of the group
+        :param params: JSON
+        :return: dict() with a Future for each device | dict() error response
+        """
+
+        if not self.device_group_model.check_id(id):
+            return self.make_response(False, "Not valid group id", 400)
+
+        members = self.device_group_model.get_members(id)
+
+        if members is False:
+            return self.make_response(False, "Error", 500)
+
+        # Device data is read here, so the fan-out threads do not touch the DB
+        return {"futures": {device_id: fan_out_executor.submit(self.send_to_device, device_id, ip, path, params) for device_id, ip, path in members}}
+
+    def group_send_collect(self, futures: dict):
+        """
+        Wait for the responses of all devices of a group
+
+        :param futures: dict() of Future returned by group_send_submit
+        :return: dict() with the response of each device
+        """
+
+        return self.make_multi_response({device_id: future.result() for device_id, future in futures.items()})
+
+    @staticmethod
+    def make_multi_response(results):
+        """
+        Make response for many actions, 207 if some of them failed
+
+        :param results: dict() | list() of responses
+        :return: dict()
+        """
+
+        values = results.values() if isinstance(results, dict) else results
+
+        if all(res["valid"] for res in values):
+            return DeviceService.make_response(True, results, 200)
+
+        return DeviceService.make_response(False, results, 207)
+
+    def batch(self, actions: list):
+        """
+        Run many actions of a single request, the response of each one is in the same position.
+        Actions that write to the DB run in order in the request transaction, that is rolled back if one of them fails.
+        Actions that contact devices run at the same time
+
+        :param actions: list() of dict(action, info)
+        :return: dict() with the list of responses
+        """
+
+        if not isinstance(actions, list) or not 0 < len(actions) <= MAX_BATCH_ACTIONS:
+            return self.make_response(False, "Not valid input", 400)
+
+        results = [None] * len(actions)
+        futures = {}
+        group_futures = {}
+        db_items = []
+
+        for index, item in enumerate(actions):
+            try:
+                action = item["action"]
+                info = item.get("info", {})
+
+                if action == "send":
+                    device = device_registry.get(info["id"])
+
+                    if device is not None:
+                        futures[index] = fan_out_executor.submit(self.send_to_device, info["id"], device.ip, device.path, info["params"])
+                    else:
+                        results[index] = self.make_response(False, "Not valid id", 400)
+                elif action == "get" and not shard_service.is_local(info["id"]):
+                    futures[index] = fan_out_executor.submit(self.get_status, info["id"], info.get("max_age"), info.get("fresh", False))
+                elif action == "get":
+                    results[index] = self.get_cached_status(info["id"], info.get("max_age"), info.get("fresh", False))
+
+                    if results[index] is None:
+                        device = device_registry.get(info["id"])
+
+                        if device is not None:
+                            futures[index] = fan_out_executor.submit(self.get_from_device, info["id"], device.ip, device.path)
+                        else:
+                            results[index] = self.make_response(False, "Not valid id", 400)
+                elif action == "group_send":
+                    res = self.group_send_submit(info["group_id"], info["params"])
+
+                    if "futures" in res:
+                        group_futures[index] = res["futures"]
+                    else:
+                        results[index] = res
+                elif action == "health":
+                    results[index] = self.get_health(info.get("id"))
+                elif action in DB_ACTIONS:
+                    db_items.append(index)
+                    results[index] = self.manager(item)
+                else:
+                    results[index] = self.make_response(False, "Not valid action", 400)
+            except (KeyError, TypeError, AttributeError):
+                results[index] = self.make_response(False, "Not valid input", 400)
+
+        unit_of_work = UnitOfWork.current()
+
+        if any(not results[index]["valid"] for index in db_items) or (unit_of_work is not None and unit_of_work.failed):
+            if unit_of_work is not None:
+                unit_of_work.rollback()
+
+            for index in db_items:
+                if results[index]["valid"]:
+                    results[index] = self.make_response(False, "Rolled back", 409)
+
+        for index, future in futures.items():
+            results[index] = future.result()
+
+        for index, device_futures in group_futures.items():
+            results[index] = self.group_send_collect(device_futures)
+
+        return self.make_multi_response(results)
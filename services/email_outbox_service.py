@@ -0,0 +1,317 @@
+import smtplib
+import threading
+import time
+import json
+
+from datetime import datetime, timedelta
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+from database.database import Database
+from models.email_outbox_model import EmailOutboxModel
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+logger = logging_service.get_logger()
+
+DEFAULT_BATCH_SIZE = 20
+DEFAULT_POLL_INTERVAL = 30
+DEFAULT_MAX_ATTEMPTS = 6
+DEFAULT_RETRY_DELAY = 10
+DEFAULT_LEASE = 120
+DEFAULT_SMTP_IDLE_TIMEOUT = 60
+DEFAULT_RETENTION = 86400
+DEFAULT_PURGE_INTERVAL = 3600
+
+
+class SmtpSession:
+    """
+    Provide a lazily opened SMTP session that is reused across emails
+    """
+
+    def __init__(self, credential, idle_timeout=DEFAULT_SMTP_IDLE_TIMEOUT):
+        """
+        :param credential: Email section of credentials.json
+        :param idle_timeout: Seconds after which an unused session is closed
+        """
+
+        self.credential = credential
+        self.idle_timeout = idle_timeout
+
+        self.smtp_server = None
+        self.last_used = 0
+
+        self.opened = 0
+
+    def get_server(self):
+        """
+        Get the SMTP connection, opening and logging in only if needed
+
+        :return: smtplib.SMTP
+        """
+
+        if self.smtp_server is not None and time.monotonic() - self.last_used > self.idle_timeout:
+            self.close()
+
+        if self.smtp_server is None:
+            if self.credential.get("ssl", True):
+                smtp_server = smtplib.SMTP_SSL(host=self.credential["host"], port=self.credential["port"])
+            else:
+                smtp_server = smtplib.SMTP(host=self.credential["host"], port=self.credential["port"])
+
+            try:
+                smtp_server.ehlo()
+
+                if self.credential.get("password"):
+                    smtp_server.login(self.credential["address"], self.credential["password"])
+            except (smtplib.SMTPException, OSError):
+                smtp_server.close()
+
+                raise
+
+            self.smtp_server = smtp_server
+            self.opened += 1
+
+        return self.smtp_server
+
+    def send_message(self, receiver, subject, message):
+        """
+        Send an email, the session is dropped if it fails
+
+        :param receiver: The receiver
+        :param subject: The subject
+        :param message: The message
+        :return: void | SMTPException | OSError
+        """
+
+        msg = MIMEMultipart()
+
+        msg["From"] = self.credential["address"]
+        msg["To"] = receiver
+        msg["Subject"] = subject
+
+        msg.attach(MIMEText(message, 'plain'))
+
+        try:
+            self.get_server().send_message(msg)
+            self.last_used = time.monotonic()
+        except (smtplib.SMTPException, OSError):
+            self.close(quit=False)
+
+            raise
+
+    def close(self, quit=True):
+        """
+        Close the SMTP connection
+
+        :param quit: Send QUIT before closing
+        :return: void
+        """
+
+        if self.smtp_server is not None:
+            try:
+                if quit:
+                    self.smtp_server.quit()
+                else:
+                    self.smtp_server.close()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+            self.smtp_server = None
+
+
+class EmailOutboxService:
+    """
+    Provide a durable email queue, drained by a background worker over a reused SMTP session
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, poll_interval=DEFAULT_POLL_INTERVAL, max_attempts=DEFAULT_MAX_ATTEMPTS, retry_delay=DEFAULT_RETRY_DELAY, lease=DEFAULT_LEASE, retention=DEFAULT_RETENTION, purge_interval=DEFAULT_PURGE_INTERVAL):
+        """
+        :param batch_size: Max number of emails sent for each DB read
+        :param poll_interval: Seconds between two checks of the queue when nobody wakes the worker
+        :param max_attempts: Attempts after which an email is marked as failed
+        :param retry_delay: Seconds before the first retry, doubled at each attempt
+        :param lease: Seconds an email taken by a worker is hidden from the others
+        :param retention: Seconds sent and failed emails are kept before being deleted
+        :param purge_interval: Seconds between two deletions of the old emails
+        """
+
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self.retention = retention
+        self.purge_interval = purge_interval
+        self.purged_at = None
+
+        self.smtp_session = None
+
+        self.wake_event = threading.Event()
+        self.lock = threading.Lock()
+        self.worker = None
+
+        self.queued = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.batches = 0
+        self.purged = 0
+
+    @staticmethod
+    def now():
+        # TIMESTAMP columns have no fractional seconds
+        return datetime.now().replace(microsecond=0)
+
+    def enqueue(self, receiver, subject, message):
+        """
+        Queue an email, it is sent by the worker once the current work is committed
+
+        :param receiver: The receiver
+        :param subject: The subject
+        :param message: The message
+        :return: True | False
+        """
+
+        if not EmailOutboxModel().create(receiver, subject, message, self.now()):
+            return False
+
+        with self.lock:
+            self.queued += 1
+
+        self.start()
+        Database.on_commit(self.wake)
+
+        return True
+
+    def wake(self):
+        """
+        Make the worker check the queue now
+
+        :return: void
+        """
+
+        self.wake_event.set()
+
+    def start(self):
+        """
+        Start the worker thread if it is not running
+
+        :return: void
+        """
+
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self.run, name="email-outbox", daemon=True)
+                self.worker.start()
+
+    def run(self):
+        """
+        Body of the worker thread
+
+        :return: void
+        """
+
+        with open("credentials.json") as json_file:
+            credential = json.load(json_file)["email"]
+
+        self.smtp_session = SmtpSession(credential)
+
+        while True:
+            self.wake_event.wait(self.poll_interval)
+            self.wake_event.clear()
+
+            try:
+                while self.drain() == self.batch_size:
+                    pass
+
+                if self.purged_at is None or time.monotonic() - self.purged_at > self.purge_interval:
+                    self.purge()
+            except Exception:
+                logger.exception("email_outbox_service -> run")
+
+            if time.monotonic() - self.smtp_session.last_used > self.smtp_session.idle_timeout:
+                self.smtp_session.close()
+
+    def drain(self):
+        """
+        Send one batch of pending emails
+
+        :return: Number of emails taken from the queue
+        """
+
+        email_outbox_model = EmailOutboxModel()
+        pending = email_outbox_model.get_pending(self.now(), self.batch_size)
+
+        if not pending:
+            return 0
+
+        with self.lock:
+            self.batches += 1
+
+        claimed = 0
+
+        for id, receiver, subject, message, attempts, next_attempt_at in pending:
+            if not email_outbox_model.claim(id, next_attempt_at, self.now() + timedelta(seconds=self.lease)):
+                continue
+
+            claimed += 1
+
+            try:
+                self.smtp_session.send_message(receiver, subject, message)
+                email_outbox_model.mark_sent(id, self.now())
+
+                with self.lock:
+                    self.sent += 1
+            except (smtplib.SMTPException, OSError):
+                logger.exception("email_outbox_service -> drain (email " + str(id) + ")")
+
+                attempts += 1
+                failed = attempts >= self.max_attempts
+                delay = self.retry_delay * 2 ** (attempts - 1)
+
+                email_outbox_model.mark_retry(id, attempts, self.now() + timedelta(seconds=delay), failed)
+
+                with self.lock:
+                    if failed:
+                        self.failed += 1
+                    else:
+                        self.retried += 1
+
+        return claimed
+
+    def purge(self):
+        """
+        Delete the emails sent or failed more than retention seconds ago
+
+        :return: void
+        """
+
+        self.purged_at = time.monotonic()
+
+        count = EmailOutboxModel().delete_done(self.now() - timedelta(seconds=self.retention))
+
+        if count:
+            with self.lock:
+                self.purged += count
+
+    def get_stats(self):
+        """
+        Get counters of the outbox
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {
+                "queued": self.queued,
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed,
+                "batches": self.batches,
+                "purged": self.purged,
+                "smtp_sessions": self.smtp_session.opened if self.smtp_session is not None else 0
+            }
+
+
+email_outbox = EmailOutboxService()
@@ -1,10 +1,5 @@
-import smtplib
-
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
+from services.email_outbox_service import email_outbox
 from services.logger_service import LoggerService
-import json
 
 logging_service = LoggerService(name=__name__)
 logger = logging_service.get_logger()
@@ -16,48 +11,26 @@ class EmailService:
     """
 
     def __init__(self):
-        with open("credentials.json") as json_file:
-            file = json.load(json_file)
-
-        self.credential = file["email"]
-
-        self.smtp_server = smtplib.SMTP_SSL(host=self.credential["host"], port=self.credential["port"])
-        self.smtp_server.ehlo()
-
         self.local_domain = "localhost"
         self.local_port = "5000"
 
     def send_message(self, receiver, subject, message):
         """
-        Send email to an user with a subject and a message
+        Queue an email to an user with a subject and a message.
+        It is sent in background by the email outbox, no SMTP connection is opened here
 
         :param receiver: The receiver
         :param subject: The subject
         :param message: The message
-        :return: Boolean | SMTPException
+        :return: Boolean
         """
 
-        try:
-            self.smtp_server.login(self.credential["address"], self.credential["password"])
-
-            msg = MIMEMultipart()
-
-            msg["From"] = self.credential["address"]
-            msg["To"] = receiver
-            msg["Subject"] = subject
-
-            msg.attach(MIMEText(message, 'plain'))
-
-            self.smtp_server.send_message(msg)
-            del msg
-
-            self.smtp_server.quit()
-
+        if email_outbox.enqueue(receiver, subject, message):
             return True
-        except smtplib.SMTPException:
-            logger.exception("email_service -> send_message")
 
-            return False
+        logger.error("email_service -> send_message")
+
+        return False
 
     def send_otp(self, receiver, otp):
         """
@@ -65,7 +38,7 @@ class EmailService:
 
         :param receiver: The receiver
         :param otp: The OTP Code
-        :return: Boolean | SMTPException
+        :return: Boolean
         """
 
         subject = "RPI-Controller: OTP code"
@@ -78,7 +51,7 @@ class EmailService:
         Send a link for reset password to a specific user
 
         :param receiver: The receiver
-        :return: Boolean | SMTPException
+        :return: Boolean
         """
 
         change_password_link = self.local_domain + ":" + self.local_port + "/change-password"
@@ -1,4 +1,6 @@
 from services.email_service import EmailService
+from services.auth_cache_service import auth_cache
+from services.token_service import token_service
 from models.user_model import UserModel
 
 from validate_email import validate_email
@@ -11,6 +13,9 @@ logging_service = LoggerService(name=__name__)
 
 logger = logging_service.get_logger()
 
+# OTP codes a user can request in 10 minutes
+MAX_OTP_REQUESTS = 4
+
 
 class LoginService:
     """
@@ -103,7 +108,7 @@ class LoginService:
         """
 
         if self.is_valid_email(email):
-            if self.user_model.get_user_with_otp(email, api_key, otp_code) and self.clear_otp(api_key, otp_code):
+            if self.user_model.use_otp(email, api_key, otp_code):
                 self.user_model.reset_otp_requests(api_key)
 
                 return True
@@ -144,29 +149,31 @@ class LoginService:
 
     def send_otp_code(self, email, api_key):
         """
-        Send OTP code via email
+        Send OTP code via email, at most MAX_OTP_REQUESTS times in 10 minutes
 
         :param email:
         :param api_key:
-        :return: True | False
+        :return: dict()
         """
 
-        if self.is_valid_email(email) and self.user_exists(email, api_key):
-            otp_code = self.generate_otp()
-            self.user_model.create_otp(api_key, otp_code)
+        if not self.is_valid_email(email):
+            logger.error("login_service -> send_otp_code")
 
-            if self.check_otp_requests(email, api_key, otp_code):
-                timestamp = self.user_model.get_otp_timestamp(api_key)
-                otp_requests = self.user_model.get_otp_requests(api_key) + 1
+            return self.make_response(False, "Not valid user", 400)
 
-                self.user_model.update_otp(otp_requests, timestamp, api_key)
+        if not self.user_model.reserve_otp(email, api_key, MAX_OTP_REQUESTS):
+            # Only rejected requests pay for telling the two cases apart
+            if self.user_model.check_user(email, api_key):
+                return self.make_response(False, "Too many OTP requests", 429)
 
-                if self.email.send_otp(email, otp_code):
-                    return True
-        else:
-            logger.error("login_service -> send_otp_code")
+            return self.make_response(False, "Not valid user", 400)
+
+        otp_code = self.generate_otp()
 
-        return False
+        if self.user_model.create_otp(api_key, otp_code) and self.email.send_otp(email, otp_code):
+            return self.make_response(True, "Email send", 200)
+
+        return self.make_response(False, "Error when send OTP code", 500)
 
     def clear_otp(self, api_key, otp_code):
         """
@@ -179,29 +186,37 @@ class LoginService:
 
         return self.user_model.delete_otp(api_key, otp_code)
 
-    def check_otp_requests(self, email, api_key, otp_code):
+    def check_api_key(self, api_key):
         """
-        Check if the requested limit of otp has been reached
+        Find user by:
 
-        :param email:
         :param api_key:
-        :param otp_code:
-        :return: True | False
+        :return True | False
         """
-        if self.user_model.check_user_otp_timestamp(api_key):
-            self.user_model.reset_otp_requests(api_key)
 
-        if 0 <= self.user_model.get_otp_requests(api_key) <= 3 and self.user_model.get_user_with_otp(email, api_key, otp_code):
-            return True
+        return auth_cache.check_api_key(api_key, self.user_model.check_api_key)
 
-        return False
-
-    def check_api_key(self, api_key):
+    @staticmethod
+    def is_valid_api_key(api_key):
         """
-        Find user by:
+        Check api_key through the auth cache, without opening SMTP or DB connections on cache hit
 
         :param api_key:
-        :return True | False
+        :return: True | False
+        """
+
+        return auth_cache.check_api_key(api_key, lambda key: UserModel().check_api_key(key))
+
+    @staticmethod
+    def is_authenticated(data):
         """
+        Check the session token of a request, without any I/O, or its api_key if it has no token
+
+        :param data: Body of the request
+        :return: True | False
+        """
+
+        if "token" in data:
+            return token_service.verify(data["token"]) is not None
 
-        return self.user_model.check_api_key(api_key)
+        return "api_key" in data and LoginService.is_valid_api_key(data["api_key"])
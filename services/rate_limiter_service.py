@@ -0,0 +1,184 @@
+from collections import Counter
+import json
+import threading
+import time
+
+from flask import request
+
+DEFAULT_SWEEP_INTERVAL = 60
+
+# (tokens per second, burst)
+DEFAULT_IP_LIMIT = (20, 40)
+DEFAULT_ENDPOINT_LIMITS = {
+    "/device": (10, 20),
+    "/stats": (1, 5),
+    "/signup": (0.05, 3),
+    "/otp_request": (0.05, 3),
+    "/login": (0.2, 5),
+    "/logout": (0.2, 5),
+    "/state": (10, 20)
+}
+DEFAULT_ACTION_LIMIT = (1, 5)
+DEFAULT_ACTION_LIMITS = {
+    "send": (5, 10),
+    "get": (10, 20),
+    "health": (2, 5),
+    "group_send": (1, 3),
+    "create": (0.5, 3),
+    "bulk_create": (0.1, 1)
+}
+
+
+class RateLimiterService:
+    """
+    Provide in-process token buckets keyed by source IP, by client and endpoint and by client and /device action.
+    A bucket only keeps its tokens and last update, buckets that refilled are dropped
+    """
+
+    def __init__(self, sweep_interval=DEFAULT_SWEEP_INTERVAL):
+        """
+        :param sweep_interval: Seconds between two scans for full buckets to drop
+        """
+
+        self.sweep_interval = sweep_interval
+
+        self.ip_limit = DEFAULT_IP_LIMIT
+        self.endpoint_limits = dict(DEFAULT_ENDPOINT_LIMITS)
+        self.action_limit = DEFAULT_ACTION_LIMIT
+        self.action_limits = dict(DEFAULT_ACTION_LIMITS)
+
+        # key -> [tokens, updated, full_at]
+        self.buckets = {}
+        self.next_sweep = time.monotonic() + sweep_interval
+        self.lock = threading.Lock()
+
+        self.allowed = 0
+        self.rejected = Counter()
+
+    @staticmethod
+    def load_credential():
+        """
+        Read rate_limits section of credentials.json
+
+        :return: dict()
+        """
+
+        with open('credentials.json') as json_file:
+            file = json.load(json_file)
+
+        return file.get("rate_limits", {})
+
+    def configure(self, credential):
+        """
+        Override the default limits, each one is [tokens per second, burst]
+
+        :param credential: dict(ip, endpoints, action, actions)
+        :return: void
+        """
+
+        self.ip_limit = tuple(credential.get("ip", self.ip_limit))
+        self.endpoint_limits.update({endpoint: tuple(limit) for endpoint, limit in credential.get("endpoints", {}).items()})
+        self.action_limit = tuple(credential.get("action", self.action_limit))
+        self.action_limits.update({action: tuple(limit) for action, limit in credential.get("actions", {}).items()})
+
+    def allow(self, checks):
+        """
+        Take tokens from every bucket, only if all of them have enough
+
+        :param checks: list(tuple(key, rate, burst, cost))
+        :return: None if allowed | the first key without enough tokens
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            levels = []
+
+            for key, rate, burst, cost in checks:
+                bucket = self.buckets.get(key)
+                tokens = burst if bucket is None else min(burst, bucket[0] + (now - bucket[1]) * rate)
+
+                if tokens < cost:
+                    self.rejected[key[0]] += 1
+
+                    return key
+
+                levels.append(tokens - cost)
+
+            for (key, rate, burst, cost), tokens in zip(checks, levels):
+                self.buckets[key] = [tokens, now, now + (burst - tokens) / rate]
+
+            self.allowed += 1
+
+            if now >= self.next_sweep:
+                self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[2] > now}
+                self.next_sweep = now + self.sweep_interval
+
+        return None
+
+    def get_checks(self, endpoint, ip, data):
+        """
+        Get the buckets a request takes tokens from
+
+        :param endpoint: Path of the request
+        :param ip: Source IP
+        :param data: Body of the request, or None
+        :return: list(tuple(key, rate, burst, cost))
+        """
+
+        checks = [(("ip", ip), self.ip_limit[0], self.ip_limit[1], 1)]
+
+        data = data if isinstance(data, dict) else {}
+        client = data.get("token") or data.get("api_key") or ip
+
+        if not isinstance(client, str):
+            client = ip
+
+        limit = self.endpoint_limits.get(endpoint)
+
+        if limit is not None:
+            checks.append((("endpoint", endpoint, client), limit[0], limit[1], 1))
+
+        if endpoint == "/device":
+            items = data.get("actions") if isinstance(data.get("actions"), list) else [data]
+            actions = Counter(item.get("action") for item in items if isinstance(item, dict) and isinstance(item.get("action"), str))
+
+            for action, cost in actions.items():
+                rate, burst = self.action_limits.get(action, self.action_limit)
+                # Each action of a batch takes one token, at most the burst: a larger batch waits for a full bucket instead of never fitting
+                checks.append((("action", action, client), rate, burst, min(cost, burst)))
+
+        return checks
+
+    def init_app(self, app, error_response):
+        """
+        Reject the requests over the limits before any DB or device work
+
+        :param app: Flask app
+        :param error_response: Callable that returns the response sent to rejected requests
+        :return: void
+        """
+
+        self.configure(self.load_credential())
+
+        @app.before_request
+        def check_rate_limit():
+            data = request.get_json(force=True, silent=True) if request.method == "POST" else None
+
+            if self.allow(self.get_checks(request.path, request.remote_addr, data)) is not None:
+                return error_response()
+
+            return None
+
+    def get_stats(self):
+        """
+        Get active buckets and allowed and rejected requests
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {"buckets": len(self.buckets), "allowed": self.allowed, "rejected": dict(self.rejected)}
+
+
+rate_limiter = RateLimiterService()
@@ -0,0 +1,375 @@
+from bisect import bisect
+import hashlib
+import json
+import os
+import queue
+import socket
+import struct
+import threading
+import time
+
+from devices_manager.command_queue import DEFAULT_WAIT_TIMEOUT
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+# Points of each worker on the ring, more points spread the devices more evenly
+DEFAULT_VIRTUAL_NODES = 64
+
+# Max seconds to wait for the owner, it answers within the wait of its command queue
+DEFAULT_IPC_TIMEOUT = DEFAULT_WAIT_TIMEOUT + 5
+
+# Idle connections kept open to each other worker
+DEFAULT_IPC_CONNECTIONS = 4
+
+# Seconds to wait after a failed accept, not to spin while the process has no free file descriptors
+ACCEPT_RETRY_DELAY = 0.1
+
+HEADER = struct.Struct("!I")
+
+
+def get_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode()
+
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_exactly(sock, size):
+    data = b""
+
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+
+        if not chunk:
+            raise ConnectionError("connection closed")
+
+        data += chunk
+
+    return data
+
+
+def recv_message(sock):
+    size, = HEADER.unpack(recv_exactly(sock, HEADER.size))
+
+    return json.loads(recv_exactly(sock, size))
+
+
+class ShardRing:
+    """
+    Provide a consistent hash ring of workers: changing the number of workers moves only the devices of the added or removed ones
+    """
+
+    def __init__(self, count, virtual_nodes=DEFAULT_VIRTUAL_NODES):
+        """
+        :param count: Number of workers
+        :param virtual_nodes: Points of each worker on the ring
+        """
+
+        points = sorted((get_hash(str(index) + "-" + str(node)), index) for index in range(count) for node in range(virtual_nodes))
+
+        self.hashes = [point for point, _ in points]
+        self.owners = [index for _, index in points]
+
+    def get_owner(self, key):
+        """
+        Get the worker that owns a key
+
+        :param key: e.g. ID of device
+        :return: int index of the worker
+        """
+
+        return self.owners[bisect(self.hashes, get_hash(key)) % len(self.hashes)]
+
+
+class ShardService:
+    """
+    Provide the sharding of devices among the worker processes.
+    Each device is owned by one worker, the only one that contacts it and keeps its queue, its state and its health:
+    the other workers forward its actions to the owner on a local Unix socket
+    """
+
+    def __init__(self, ipc_timeout=DEFAULT_IPC_TIMEOUT, max_connections=DEFAULT_IPC_CONNECTIONS):
+        """
+        :param ipc_timeout: Max seconds to wait for the owner answer
+        :param max_connections: Idle connections kept open to each other worker
+        """
+
+        self.ipc_timeout = ipc_timeout
+        self.max_connections = max_connections
+
+        self.index = None
+        self.count = 1
+        self.ring = None
+        self.path_prefix = None
+
+        self.handler = None
+        self.server = None
+        self.thread = None
+        self.idle = {}
+        self.lock = threading.Lock()
+
+        # Actions received from other workers are always run here, so that they are never forwarded again
+        self.serving = threading.local()
+
+        self.forwarded = 0
+        self.served = 0
+        self.errors = 0
+
+    def configure(self, index, count, path_prefix):
+        """
+        Enable sharding in this worker
+
+        :param index: Index of this worker
+        :param count: Number of workers
+        :param path_prefix: Prefix of the Unix socket paths, the worker index is appended
+        :return: void
+        """
+
+        self.index = index
+        self.count = count
+        self.path_prefix = path_prefix
+        self.ring = ShardRing(count) if count > 1 else None
+
+    def is_enabled(self):
+        return self.ring is not None
+
+    def is_forwarding(self):
+        """
+        Check if the actions of devices owned by other workers must be forwarded to them
+
+        :return: True | False
+        """
+
+        return self.ring is not None and not getattr(self.serving, "active", False)
+
+    def is_local(self, device_id):
+        """
+        Check if this worker owns a device
+
+        :param device_id: ID of device
+        :return: True | False
+        """
+
+        return not self.is_forwarding() or self.ring.get_owner(device_id) == self.index
+
+    def is_owner(self, device_id):
+        """
+        Check if this worker owns a device, also while it serves an action forwarded by another worker
+
+        :param device_id: ID of device
+        :return: True | False
+        """
+
+        return self.ring is None or self.ring.get_owner(device_id) == self.index
+
+    def get_path(self, index):
+        return self.path_prefix + "-" + str(index) + ".sock"
+
+    def start(self, handler):
+        """
+        Start accepting the actions forwarded by the other workers
+
+        :param handler: Callable(item) that runs an action and returns its response
+        :return: void
+        """
+
+        if self.ring is None:
+            return
+
+        with self.lock:
+            if self.thread is not None:
+                return
+
+            path = self.get_path(self.index)
+
+            # Left by a worker of this generation that died, the paths of the other generations are never reused
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            self.handler = handler
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(path)
+            self.server.listen(128)
+
+            self.thread = threading.Thread(target=self.accept, name="shard-ipc", daemon=True)
+            self.thread.start()
+
+    def accept(self):
+        """
+        Body of the thread that accepts connections from the other workers
+
+        :return: void
+        """
+
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                # e.g. too many open files or a connection reset before it was accepted, the next ones may work
+                logger.exception("shard_service -> accept")
+
+                with self.lock:
+                    self.errors += 1
+
+                time.sleep(ACCEPT_RETRY_DELAY)
+
+                continue
+
+            threading.Thread(target=self.serve, args=(conn,), name="shard-ipc-conn", daemon=True).start()
+
+    def serve(self, conn):
+        """
+        Run the actions received on a connection, one at a time, until the other worker closes it
+
+        :param conn: socket
+        :return: void
+        """
+
+        self.serving.active = True
+
+        with conn:
+            while True:
+                try:
+                    item = recv_message(conn)
+                except (OSError, ValueError):
+                    return
+
+                try:
+                    res = self.handler(item)
+                except Exception:
+                    logger.exception("shard_service -> serve")
+
+                    res = {'valid': False, 'info': "Server error", 'code': 500}
+
+                with self.lock:
+                    self.served += 1
+
+                try:
+                    send_message(conn, res)
+                except OSError:
+                    return
+
+    def forward(self, device_id, item):
+        """
+        Run an action on the worker that owns a device
+
+        :param device_id: ID of device
+        :param item: dict(action, info)
+        :return: dict() response | None if the owner did not answer
+        """
+
+        return self.forward_to(self.ring.get_owner(device_id), item)
+
+    def forward_to(self, index, item):
+        """
+        Run an action on another worker
+
+        :param index: Index of the worker
+        :param item: dict(action, info)
+        :return: dict() response | None if the worker did not answer
+        """
+
+        conn = None
+
+        try:
+            conn = self.send(index, item)
+            res = recv_message(conn)
+        except (OSError, ValueError):
+            logger.exception("shard_service -> forward_to " + str(index))
+
+            if conn is not None:
+                conn.close()
+
+            with self.lock:
+                self.errors += 1
+
+            return None
+
+        self.release(index, conn)
+
+        with self.lock:
+            self.forwarded += 1
+
+        return res
+
+    def send(self, index, item):
+        """
+        Send an action on an idle connection, or on a new one if the idle ones were closed by a worker that stopped
+
+        :param index: Index of the worker
+        :param item: dict(action, info)
+        :return: socket
+        """
+
+        while True:
+            conn, reused = self.get_conn(index)
+
+            try:
+                send_message(conn, item)
+
+                return conn
+            except OSError:
+                conn.close()
+
+                # The action was not received, it is safe to send it again
+                if not reused:
+                    raise
+
+    def get_conn(self, index):
+        idle = self.get_idle(index)
+
+        try:
+            return idle.get_nowait(), True
+        except queue.Empty:
+            pass
+
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(self.ipc_timeout)
+
+        try:
+            conn.connect(self.get_path(index))
+        except OSError:
+            conn.close()
+
+            raise
+
+        return conn, False
+
+    def release(self, index, conn):
+        try:
+            self.get_idle(index).put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def get_idle(self, index):
+        idle = self.idle.get(index)
+
+        if idle is None:
+            with self.lock:
+                idle = self.idle.setdefault(index, queue.LifoQueue(maxsize=self.max_connections))
+
+        return idle
+
+    def get_others(self):
+        return [index for index in range(self.count) if index != self.index] if self.ring is not None else []
+
+    def get_stats(self):
+        """
+        Get index of this worker and forwarded and served actions
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {"worker": self.index, "workers": self.count, "forwarded": self.forwarded, "served": self.served, "errors": self.errors}
+
+
+shard_service = ShardService()
@@ -0,0 +1,369 @@
+from multiprocessing import shared_memory
+import hashlib
+import math
+import multiprocessing
+import struct
+import time
+
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+DEFAULT_AUTH_SLOTS = 16384
+DEFAULT_DEVICE_SLOTS = 4096
+DEFAULT_REPORT_SLOTS = 4096
+DEFAULT_MAX_PROBES = 16
+
+# Bytes of "id ip path type" of a device
+DEVICE_VALUE_SIZE = 192
+DEVICE_SEPARATOR = "\x1f"
+
+# Bytes of the last status pushed by a device, bigger ones are seen only by the worker that received them
+REPORT_VALUE_SIZE = 1024
+
+EMPTY = 0
+USED = 1
+DELETED = 2
+
+# The lock is held for microseconds: not getting it in LOCK_TIMEOUT seconds means a process was killed holding it.
+# The table is then skipped by this process, as if empty, for LOCK_RETRY_INTERVAL seconds before trying again
+LOCK_TIMEOUT = 1
+LOCK_RETRY_INTERVAL = 60
+
+GENERATION = struct.Struct("=Q")
+
+
+class SharedTable:
+    """
+    Provide a fixed-size hash table in shared memory, seen by every process forked after its creation.
+
+    Keys are stored as SHA1 digests and values as bytes of at most value_size.
+    Each slot keeps the generation it was written in: increasing the generation drops every entry, in every process, at once.
+    Collisions use linear probing on at most max_probes slots, then the first slot of the key is overwritten, unless the caller
+    needs every entry to stay (evict=False).
+    A process that cannot get the lock in time reads nothing and writes nothing, so a worker killed holding it never blocks the others
+    """
+
+    def __init__(self, slots, value_size, max_probes=DEFAULT_MAX_PROBES):
+        """
+        :param slots: Max number of entries, the memory used does not grow after creation
+        :param value_size: Max bytes of a value
+        :param max_probes: Slots checked for each key
+        """
+
+        self.slots = slots
+        self.value_size = value_size
+        self.max_probes = min(max_probes, slots)
+
+        # state, generation, expire_at, key digest, value length, value
+        self.slot = struct.Struct("=BQd20sH" + str(value_size) + "s")
+
+        self.shm = shared_memory.SharedMemory(create=True, size=GENERATION.size + slots * self.slot.size)
+        self.buf = self.shm.buf
+        self.lock = multiprocessing.Lock()
+        self.skip_until = 0
+
+        # Counters of this process
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.overflows = 0
+        self.lock_timeouts = 0
+
+    @staticmethod
+    def get_digest(key):
+        return hashlib.sha1(key.encode()).digest()
+
+    def get_offsets(self, digest):
+        start = int.from_bytes(digest[:8], "little") % self.slots
+
+        return [GENERATION.size + ((start + i) % self.slots) * self.slot.size for i in range(self.max_probes)]
+
+    def acquire(self):
+        """
+        Take the lock of the table, the caller releases it
+
+        :return: True | False if it was not free in time, the caller acts as if the table was empty
+        """
+
+        if time.monotonic() < self.skip_until:
+            return False
+
+        if self.lock.acquire(timeout=LOCK_TIMEOUT):
+            return True
+
+        self.skip_until = time.monotonic() + LOCK_RETRY_INTERVAL
+        self.lock_timeouts += 1
+
+        logger.error("shared_cache_service -> lock not free in " + str(LOCK_TIMEOUT) + " seconds, table skipped for " + str(LOCK_RETRY_INTERVAL) + " seconds")
+
+        return False
+
+    def get_generation(self):
+        # A single aligned word, read without the lock
+        return GENERATION.unpack_from(self.buf, 0)[0]
+
+    def bump_generation(self):
+        """
+        Drop every entry
+
+        :return: True | False if the lock was not free
+        """
+
+        if not self.acquire():
+            return False
+
+        try:
+            GENERATION.pack_into(self.buf, 0, GENERATION.unpack_from(self.buf, 0)[0] + 1)
+        finally:
+            self.lock.release()
+
+        return True
+
+    def get(self, key):
+        """
+        Get the value of a key
+
+        :param key: str
+        :return: bytes | None if missing, expired or the lock was not free
+        """
+
+        digest = self.get_digest(key)
+        now = time.monotonic()
+
+        if not self.acquire():
+            self.misses += 1
+
+            return None
+
+        try:
+            generation = GENERATION.unpack_from(self.buf, 0)[0]
+
+            for offset in self.get_offsets(digest):
+                state, slot_generation, expire_at, slot_digest, length, value = self.slot.unpack_from(self.buf, offset)
+
+                if state == EMPTY:
+                    break
+
+                if state == USED and slot_digest == digest:
+                    if slot_generation == generation and expire_at > now:
+                        self.hits += 1
+
+                        return value[:length]
+
+                    break
+
+            self.misses += 1
+        finally:
+            self.lock.release()
+
+        return None
+
+    def put(self, key, value, ttl=None, generation=None, evict=True):
+        """
+        Store the value of a key
+
+        :param key: str
+        :param value: bytes
+        :param ttl: Seconds the entry is valid, None to keep it until it is dropped
+        :param generation: Generation read before reading the value, None for the current one
+        :param evict: False to not overwrite another key when all the slots of this one are taken
+        :return: True | False if the value is too big, the generation changed meanwhile, the table is full or the lock was not free
+        """
+
+        if len(value) > self.value_size:
+            return False
+
+        digest = self.get_digest(key)
+        now = time.monotonic()
+        expire_at = now + ttl if ttl is not None else math.inf
+
+        if not self.acquire():
+            return False
+
+        try:
+            current = GENERATION.unpack_from(self.buf, 0)[0]
+
+            # The value may have been dropped after it was read, e.g. a deleted device
+            if generation is not None and generation != current:
+                return False
+
+            generation = current
+            offsets = self.get_offsets(digest)
+            target = None
+            free = None
+
+            for offset in offsets:
+                state, slot_generation, slot_expire_at, slot_digest, _, _ = self.slot.unpack_from(self.buf, offset)
+
+                if state == USED and slot_digest == digest:
+                    target = offset
+                    break
+
+                if free is None and (state != USED or slot_generation != generation or slot_expire_at <= now):
+                    free = offset
+
+                if state == EMPTY:
+                    break
+
+            if target is None:
+                target = free
+
+            if target is None:
+                if not evict:
+                    self.overflows += 1
+
+                    return False
+
+                target = offsets[0]
+                self.evictions += 1
+
+            self.slot.pack_into(self.buf, target, USED, generation, expire_at, digest, len(value), value)
+        finally:
+            self.lock.release()
+
+        return True
+
+    def delete(self, key):
+        """
+        Drop the entry of a key
+
+        :param key: str
+        :return: True | False if the lock was not free
+        """
+
+        digest = self.get_digest(key)
+
+        if not self.acquire():
+            return False
+
+        try:
+            for offset in self.get_offsets(digest):
+                state, _, _, slot_digest, _, _ = self.slot.unpack_from(self.buf, offset)
+
+                if state == EMPTY:
+                    break
+
+                if state == USED and slot_digest == digest:
+                    # Keeps the probe sequence of the next keys
+                    self.buf[offset] = DELETED
+                    break
+        finally:
+            self.lock.release()
+
+        return True
+
+    def get_values(self):
+        """
+        Get the values of all valid entries
+
+        :return: list(bytes) | None if the lock was not free
+        """
+
+        now = time.monotonic()
+        values = []
+
+        if not self.acquire():
+            return None
+
+        try:
+            generation = GENERATION.unpack_from(self.buf, 0)[0]
+
+            for index in range(self.slots):
+                state, slot_generation, expire_at, _, length, value = self.slot.unpack_from(self.buf, GENERATION.size + index * self.slot.size)
+
+                if state == USED and slot_generation == generation and expire_at > now:
+                    values.append(value[:length])
+        finally:
+            self.lock.release()
+
+        return values
+
+    def close(self, unlink=False):
+        """
+        Release the shared memory
+
+        :param unlink: True to destroy it, only in the process that created it
+        :return: void
+        """
+
+        self.buf.release()
+        self.shm.close()
+
+        if unlink:
+            self.shm.unlink()
+
+    def get_stats(self):
+        return {"slots": self.slots, "bytes": self.shm.size, "generation": self.get_generation(), "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "overflows": self.overflows, "lock_timeouts": self.lock_timeouts}
+
+
+class SharedCacheService:
+    """
+    Provide the caches shared by the worker processes: api_key checks, device records and the last status pushed by each device.
+    It is created by the master before the workers are forked, so the memory used is the same for any number of workers
+    """
+
+    def __init__(self):
+        self.auth = None
+        self.devices = None
+        self.reports = None
+
+    def create(self, auth_slots=DEFAULT_AUTH_SLOTS, device_slots=DEFAULT_DEVICE_SLOTS, report_slots=DEFAULT_REPORT_SLOTS):
+        """
+        Create the shared tables, before forking the workers
+
+        :param auth_slots: Max cached api_key
+        :param device_slots: Max cached devices
+        :param report_slots: Max devices pushing their status
+        :return: void
+        """
+
+        self.auth = SharedTable(auth_slots, 1)
+        self.devices = SharedTable(device_slots, DEVICE_VALUE_SIZE)
+        self.reports = SharedTable(report_slots, REPORT_VALUE_SIZE)
+
+    def is_enabled(self):
+        return self.auth is not None
+
+    def invalidate_devices(self):
+        """
+        Make every process read the devices from the DB again, e.g. after a device was added or deleted
+
+        :return: void
+        """
+
+        if self.devices is not None:
+            self.devices.bump_generation()
+
+    def close(self):
+        """
+        Destroy the shared tables, only in the master
+
+        :return: void
+        """
+
+        if self.auth is not None:
+            self.auth.close(unlink=True)
+            self.devices.close(unlink=True)
+            self.reports.close(unlink=True)
+
+            self.auth = None
+            self.devices = None
+            self.reports = None
+
+    def get_stats(self):
+        """
+        Get size, generation and counters of this process of each table
+
+        :return: dict() | None if not enabled
+        """
+
+        if self.auth is None:
+            return None
+
+        return {"auth": self.auth.get_stats(), "devices": self.devices.get_stats(), "reports": self.reports.get_stats()}
+
+
+shared_cache = SharedCacheService()
@@ -0,0 +1,351 @@
+import hashlib
+import hmac
+import json
+import socket
+import threading
+import time
+
+from database.database import Database
+from models.device_model import DeviceModel
+from devices_manager.state_store import state_store
+from services.device_registry_service import device_registry
+from services.shard_service import shard_service
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+# Seconds without reports after which a device that pushes its state is polled again
+DEFAULT_PUSH_TIMEOUT = 60
+
+# Seconds a secret is trusted before a report with a bad signature makes it read again, e.g. after a rotation
+DEFAULT_SECRET_TTL = 10
+
+# Datagram: 64 hex chars of signature, a space and the JSON report
+SIGNATURE_SIZE = 64
+MAX_DATAGRAM_SIZE = 2048
+
+
+class StateIngestService:
+    """
+    Provide the ingestion of the state reports pushed by the devices, over HTTP or UDP.
+
+    A report is the JSON { id, boot, seq, status } signed with HMAC-SHA256 and the secret of the device.
+    Reports are accepted only with a "seq" greater than the last one of the same "boot",
+    or with a greater "boot" (a counter the firmware increases at each restart), so that replays and duplicates are dropped.
+    The last (boot, seq) is kept in the DB, so this holds across workers and restarts.
+    When the workers share their caches the last status is kept in a SharedTable, seen by the poller and by "get" of every worker
+    """
+
+    def __init__(self, push_timeout=DEFAULT_PUSH_TIMEOUT, secret_ttl=DEFAULT_SECRET_TTL):
+        """
+        :param push_timeout: Seconds without reports after which a device is polled again
+        :param secret_ttl: Seconds a secret is trusted before a bad signature makes it read again
+        """
+
+        self.push_timeout = push_timeout
+        self.secret_ttl = secret_ttl
+
+        # device_id -> (secret, loaded_at)
+        self.secrets = {}
+        # device_id -> time of the last accepted report
+        self.reported_at = {}
+        self.lock = threading.Lock()
+
+        self.shared = None
+
+        self.udp_sock = None
+        self.thread = None
+
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    @staticmethod
+    def make_response(is_valid: bool, info, error_code: int):
+        """
+        Make response for client
+
+        :param is_valid: The success of the operation
+        :param info: Some information
+        :param error_code: HTMl error code
+        :return: dict()
+        """
+
+        return {'valid': is_valid, 'info': info, 'code': error_code}
+
+    def use_shared(self, table):
+        """
+        Keep the last status of each device in a table shared by all workers
+
+        :param table: SharedTable
+        :return: void
+        """
+
+        self.shared = table
+
+    @staticmethod
+    def load_credential():
+        """
+        Read push section of credentials.json
+
+        :return: dict()
+        """
+
+        with open('credentials.json') as json_file:
+            file = json.load(json_file)
+
+        return file.get("push", {})
+
+    @staticmethod
+    def parse(body):
+        """
+        Read a report
+
+        :param body: bytes
+        :return: tuple(id, boot, seq, status) | None if not valid
+        """
+
+        try:
+            report = json.loads(body.decode())
+        except ValueError:
+            return None
+
+        if not isinstance(report, dict):
+            return None
+
+        id = report.get("id")
+        boot = report.get("boot", 0)
+        seq = report.get("seq")
+        status = report.get("status")
+
+        if not isinstance(id, str) or not isinstance(boot, int) or not isinstance(seq, int) or seq < 0 or not isinstance(status, dict):
+            return None
+
+        return id, boot, seq, status
+
+    def get_secret(self, id, reload=False):
+        """
+        Get the secret of a device, reading it from the DB if it is not cached
+
+        :param id: ID of device
+        :param reload: True to read it again if it was cached more than secret_ttl seconds ago
+        :return: bytes | None if the device or its secret do not exist
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.secrets.get(id)
+
+        if entry is not None and not (reload and now - entry[1] > self.secret_ttl):
+            return entry[0]
+
+        secret = DeviceModel().get_push_secret(id)
+
+        if secret is False:
+            return None
+
+        secret = secret.encode() if secret else None
+
+        with self.lock:
+            self.secrets[id] = (secret, now)
+
+        return secret
+
+    def forget_secret(self, id):
+        with self.lock:
+            self.secrets.pop(id, None)
+
+    def is_signed(self, id, body, signature):
+        """
+        Check the signature of a report, reading the secret again once if it does not match
+
+        :param id: ID of device
+        :param body: bytes
+        :param signature: Hex HMAC-SHA256 of body
+        :return: True | False
+        """
+
+        for reload in (False, True):
+            secret = self.get_secret(id, reload)
+
+            if secret is not None and hmac.compare_digest(hmac.new(secret, body, hashlib.sha256).hexdigest().encode(), signature.encode()):
+                return True
+
+        return False
+
+    def ingest(self, body, signature):
+        """
+        Check a report and merge its status into the state store
+
+        :param body: bytes of the JSON report
+        :param signature: Hex HMAC-SHA256 of body
+        :return: dict()
+        """
+
+        report = self.parse(body)
+
+        if report is None or not isinstance(signature, str):
+            return self.reject("Not valid input")
+
+        id, boot, seq, status = report
+
+        if not shard_service.is_local(id):
+            res = shard_service.forward(id, {"action": "report", "info": {"body": body.decode(), "signature": signature}})
+
+            return res if res is not None else self.make_response(False, "Device owner not available", 503)
+
+        # The registry reads the DB only for the devices it does not have, e.g. just created ones
+        if device_registry.get(id) is None:
+            return self.reject("Not valid id")
+
+        if not self.is_signed(id, body, signature):
+            return self.reject("Not valid signature")
+
+        newer = DeviceModel().advance_push_sequence(id, boot, seq)
+
+        if newer is False:
+            return self.make_response(False, "Error", 500)
+
+        if not newer:
+            with self.lock:
+                self.duplicates += 1
+
+            # Nothing to send again
+            return self.make_response(True, "Duplicate", 200)
+
+        with self.lock:
+            self.accepted += 1
+
+        Database.on_commit(lambda: self.publish(id, status))
+
+        return self.make_response(True, "Ok", 200)
+
+    def publish(self, id, status):
+        """
+        Make an accepted status the one served for a device
+
+        :param id: ID of device
+        :param status: dict()
+        :return: void
+        """
+
+        now = time.monotonic()
+
+        with self.lock:
+            self.reported_at[id] = now
+
+        state_store.put(id, status)
+
+        if self.shared is not None:
+            # A status too big for the table is served only by this worker
+            self.shared.put(id, json.dumps([now, status]).encode(), self.push_timeout)
+
+    def get_status(self, id, max_age):
+        """
+        Get the last status pushed by a device to any worker
+
+        :param id: ID of device
+        :param max_age: Max seconds since the status was pushed
+        :return: dict() | None if there is no recent one
+        """
+
+        value = self.shared.get(id) if self.shared is not None else None
+
+        if value is None:
+            return None
+
+        reported_at, status = json.loads(value)
+
+        return status if time.monotonic() - reported_at <= max_age else None
+
+    def reject(self, info):
+        with self.lock:
+            self.rejected += 1
+
+        return self.make_response(False, info, 400)
+
+    def is_pushing(self, id):
+        """
+        Check if a device reported its state recently, to any worker, so it does not need to be polled
+
+        :param id: ID of device
+        :return: True | False
+        """
+
+        # Entries of the shared table expire after push_timeout
+        if self.shared is not None:
+            return self.shared.get(id) is not None
+
+        reported_at = self.reported_at.get(id)
+
+        return reported_at is not None and time.monotonic() - reported_at < self.push_timeout
+
+    def start(self):
+        """
+        Read the push section of credentials.json and listen for UDP reports if "udp_port" is set
+
+        :return: void
+        """
+
+        credential = self.load_credential()
+
+        self.push_timeout = credential.get("timeout", self.push_timeout)
+        port = credential.get("udp_port")
+
+        with self.lock:
+            if port is None or self.thread is not None:
+                return
+
+            self.udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+            # Every worker listens on the same port, the kernel spreads the datagrams
+            if hasattr(socket, "SO_REUSEPORT"):
+                self.udp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            self.udp_sock.bind((credential.get("host", "0.0.0.0"), port))
+
+            self.thread = threading.Thread(target=self.run, name="state-ingest-udp", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        """
+        Body of the UDP thread, datagrams get no answer
+
+        :return: void
+        """
+
+        while True:
+            data, _ = self.udp_sock.recvfrom(MAX_DATAGRAM_SIZE)
+
+            try:
+                res = self.ingest(data[SIGNATURE_SIZE + 1:], data[:SIGNATURE_SIZE].decode("ascii", "replace"))
+
+                if not res["valid"]:
+                    logger.warning("state_ingest_service -> udp report rejected: " + str(res["info"]))
+            except Exception:
+                logger.exception("state_ingest_service -> run")
+
+    def get_stats(self):
+        """
+        Get accepted, duplicate and rejected reports
+
+        :return: dict()
+        """
+
+        values = self.shared.get_values() if self.shared is not None else None
+
+        if values is not None:
+            pushing = len(values)
+        else:
+            with self.lock:
+                pushing = sum(1 for reported_at in self.reported_at.values() if time.monotonic() - reported_at < self.push_timeout)
+
+        with self.lock:
+            return {"pushing": pushing, "accepted": self.accepted, "duplicates": self.duplicates, "rejected": self.rejected}
+
+
+state_ingest = StateIngestService()
@@ -0,0 +1,193 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+
+from services.device_registry_service import device_registry
+from services.shard_service import shard_service
+from services.state_ingest_service import state_ingest
+from devices_manager.diy_device_manager import DeviceManager
+from devices_manager.state_store import state_store
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+DEFAULT_MIN_INTERVAL = 2
+DEFAULT_MAX_INTERVAL = 30
+DEFAULT_RELOAD_INTERVAL = 60
+DEFAULT_WORKERS = 4
+
+
+class StatusPollerService:
+    """
+    Provide a background poller that keeps the status of every registered device in the state store.
+    Devices whose status changes are polled every min_interval, the interval doubles each time the status does not change
+    """
+
+    def __init__(self, min_interval=DEFAULT_MIN_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL, reload_interval=DEFAULT_RELOAD_INTERVAL, workers=DEFAULT_WORKERS):
+        """
+        :param min_interval: Min seconds between two polls of the same device
+        :param max_interval: Max seconds between two polls of the same device
+        :param reload_interval: Seconds between two reads of the device list from the DB
+        :param workers: Number of devices polled at the same time
+        """
+
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.reload_interval = reload_interval
+        self.workers = workers
+
+        # False in the workers that only keep the registry in line, while another one polls the devices
+        self.polling = True
+
+        # device_id -> [ip, path, interval, next_poll]
+        self.schedule = {}
+        self.lock = threading.Lock()
+        self.wake_event = threading.Event()
+        self.thread = None
+
+        self.polls = 0
+        self.changes = 0
+
+    def start(self):
+        """
+        Start the poller thread if it is not running
+
+        :return: void
+        """
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="status-poller", daemon=True)
+                self.thread.start()
+
+    def touch(self, device_id):
+        """
+        Poll a device as soon as possible, e.g. after a command was sent to it
+
+        :param device_id: ID of device
+        :return: void
+        """
+
+        with self.lock:
+            entry = self.schedule.get(device_id)
+
+            if entry is not None:
+                entry[2] = self.min_interval
+                entry[3] = time.monotonic()
+
+        self.wake_event.set()
+
+    def reload(self):
+        """
+        Read the registered devices from the DB
+
+        :return: void
+        """
+
+        # Also keeps the registry in line with devices added or deleted by other processes
+        if not device_registry.load():
+            return
+
+        now = time.monotonic()
+
+        with self.lock:
+            schedule = {}
+
+            for device in device_registry.get_all():
+                # The other devices are polled by the worker that owns them
+                if not self.polling or not shard_service.is_local(device.id):
+                    continue
+
+                entry = self.schedule.get(device.id)
+
+                if entry is None or entry[0] != device.ip or entry[1] != device.path:
+                    entry = [device.ip, device.path, self.min_interval, now]
+
+                schedule[device.id] = entry
+
+            self.schedule = schedule
+
+    def run(self):
+        """
+        Body of the poller thread
+
+        :return: void
+        """
+
+        next_reload = 0
+
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="status-poll") as executor:
+            while True:
+                now = time.monotonic()
+
+                try:
+                    if now >= next_reload:
+                        self.reload()
+                        next_reload = now + self.reload_interval
+
+                    with self.lock:
+                        due = [(device_id, entry[0], entry[1]) for device_id, entry in self.schedule.items() if entry[3] <= now]
+
+                        for device_id, ip, path in due:
+                            self.schedule[device_id][3] = now + self.schedule[device_id][2]
+
+                    # Devices that push their state are polled only if they stop
+                    for future in [executor.submit(self.poll, device_id, ip, path) for device_id, ip, path in due if not state_ingest.is_pushing(device_id)]:
+                        future.result()
+                except Exception:
+                    logger.exception("status_poller_service -> run")
+
+                with self.lock:
+                    next_poll = min([entry[3] for entry in self.schedule.values()], default=next_reload)
+
+                self.wake_event.wait(max(min(next_poll, next_reload) - time.monotonic(), 0.1))
+                self.wake_event.clear()
+
+    def poll(self, device_id, ip, path):
+        """
+        Read the status of a device and adapt its poll interval
+
+        :param device_id: ID of device
+        :param ip: IP of device
+        :param path: API path of device
+        :return: void
+        """
+
+        res = DeviceManager(ip, path).get_status()
+
+        with self.lock:
+            self.polls += 1
+
+        if isinstance(res, int) or res["status_code"] != 200:
+            return
+
+        changed = state_store.put(device_id, res["info"])
+
+        with self.lock:
+            entry = self.schedule.get(device_id)
+
+            if entry is None:
+                return
+
+            if changed:
+                self.changes += 1
+                entry[2] = self.min_interval
+            else:
+                entry[2] = min(entry[2] * 2, self.max_interval)
+
+            entry[3] = time.monotonic() + entry[2]
+
+    def get_stats(self):
+        """
+        Get number of polls and of status changes seen
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {"polling": self.polling, "devices": len(self.schedule), "polls": self.polls, "changes": self.changes}
+
+
+status_poller = StatusPollerService()
@@ -0,0 +1,282 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+
+from models.token_model import TokenRevocationModel
+from services.logger_service import LoggerService
+
+logging_service = LoggerService(name=__name__)
+
+logger = logging_service.get_logger()
+
+DEFAULT_TTL = 900
+DEFAULT_REFRESH_INTERVAL = 10
+
+# Hex key set by server.py for all its workers when credentials.json has no keys
+TOKEN_KEY_ENV = "DJD_TOKEN_KEY"
+
+# Secrets shorter than this, or left as in the credentials.json template, are never used to sign tokens
+MIN_SECRET_LENGTH = 32
+PLACEHOLDER_PREFIX = "YOUR_"
+
+
+def is_valid_secret(secret):
+    """
+    Check that a secret from credentials.json is fit to sign tokens
+
+    :param secret: str
+    :return: bool
+    """
+
+    return isinstance(secret, str) and len(secret) >= MIN_SECRET_LENGTH and not secret.startswith(PLACEHOLDER_PREFIX)
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class TokenService:
+    """
+    Provide short-lived session tokens signed with HMAC-SHA256, checked without any I/O.
+
+    A token is "key_id.payload.signature": the key id selects the secret, so keys can be rotated by adding a new one,
+    making it the active one and removing the old one once its tokens expired.
+    Revoked tokens are kept in memory until they expire and shared with the other instances through the DB
+    """
+
+    def __init__(self, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        """
+        :param refresh_interval: Seconds between two reads of the tokens revoked by other instances
+        """
+
+        self.refresh_interval = refresh_interval
+
+        self.keys = None
+        self.active_key = None
+        self.ttl = DEFAULT_TTL
+
+        # jti -> expires_at
+        self.revoked = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+
+    @staticmethod
+    def load_credential():
+        """
+        Read tokens section of credentials.json
+
+        :return: dict()
+        """
+
+        with open('credentials.json') as json_file:
+            file = json.load(json_file)
+
+        return file.get("tokens", {})
+
+    def get_keys(self):
+        """
+        Get the signing keys, reading them on first use
+
+        :return: dict()
+        """
+
+        if self.keys is None:
+            with self.lock:
+                if self.keys is None:
+                    credential = self.load_credential()
+                    keys = {}
+
+                    for key_id, secret in credential.get("keys", {}).items():
+                        if is_valid_secret(secret):
+                            keys[key_id] = secret.encode()
+                        else:
+                            logger.error("token_service -> key " + key_id + " skipped, secrets must be at least " + str(MIN_SECRET_LENGTH) + " random characters")
+
+                    if not keys and os.environ.get(TOKEN_KEY_ENV):
+                        keys = {"local": bytes.fromhex(os.environ[TOKEN_KEY_ENV])}
+                    elif not keys:
+                        logger.warning("token_service -> no keys in credentials.json, tokens are valid only on this instance until restart")
+
+                        keys = {"local": secrets.token_bytes(32)}
+
+                    self.ttl = credential.get("ttl", DEFAULT_TTL)
+                    self.active_key = credential.get("active_key")
+
+                    if self.active_key not in keys:
+                        if self.active_key is not None:
+                            logger.error("token_service -> active_key " + str(self.active_key) + " is not a usable key")
+
+                        self.active_key = next(iter(keys))
+                    self.keys = keys
+
+        return self.keys
+
+    @staticmethod
+    def get_subject(api_key):
+        """
+        Get the user identity carried by the tokens, without exposing the api_key
+
+        :param api_key:
+        :return: str
+        """
+
+        return hashlib.sha256(api_key.encode()).hexdigest()[:32]
+
+    def sign(self, key_id, body):
+        return b64encode(hmac.new(self.get_keys()[key_id], (key_id + "." + body).encode(), hashlib.sha256).digest())
+
+    def issue(self, api_key):
+        """
+        Make a new token for a user
+
+        :param api_key: api_key of the user
+        :return: tuple(token, expires_in)
+        """
+
+        self.get_keys()
+
+        payload = {"sub": self.get_subject(api_key), "exp": int(time.time()) + self.ttl, "jti": secrets.token_hex(16)}
+        body = b64encode(json.dumps(payload, separators=(",", ":")).encode())
+
+        with self.lock:
+            self.issued += 1
+
+        return self.active_key + "." + body + "." + self.sign(self.active_key, body), self.ttl
+
+    def verify(self, token):
+        """
+        Check signature, expiry and revocation of a token
+
+        :param token:
+        :return: dict() payload | None if not valid
+        """
+
+        payload = self.decode(token)
+
+        with self.lock:
+            if payload is None or payload["exp"] <= time.time() or payload["jti"] in self.revoked:
+                self.rejected += 1
+
+                return None
+
+            self.verified += 1
+
+        return payload
+
+    def decode(self, token):
+        """
+        Get the payload of a token if its signature is valid, whether it expired or not
+
+        :param token:
+        :return: dict() | None
+        """
+
+        if not isinstance(token, str) or token.count(".") != 2:
+            return None
+
+        key_id, body, signature = token.split(".")
+
+        if key_id not in self.get_keys() or not hmac.compare_digest(self.sign(key_id, body).encode(), signature.encode()):
+            return None
+
+        try:
+            payload = json.loads(b64decode(body))
+        except (binascii.Error, ValueError):
+            return None
+
+        if not isinstance(payload, dict) or not isinstance(payload.get("exp"), int) or not isinstance(payload.get("jti"), str):
+            return None
+
+        return payload
+
+    def revoke(self, token):
+        """
+        Revoke a token on this instance now, on the others within refresh_interval
+
+        :param token:
+        :return: True | False if the token is not valid
+        """
+
+        payload = self.decode(token)
+
+        if payload is None:
+            return False
+
+        with self.lock:
+            self.revoked[payload["jti"]] = payload["exp"]
+
+        return TokenRevocationModel().create(payload["jti"], payload["exp"])
+
+    def start(self):
+        """
+        Start the thread that reads the tokens revoked by other instances
+
+        :return: void
+        """
+
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name="token-revocations", daemon=True)
+                self.thread.start()
+
+    def run(self):
+        """
+        Body of the revocations thread
+
+        :return: void
+        """
+
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("token_service -> run")
+
+            time.sleep(self.refresh_interval)
+
+    def refresh(self):
+        """
+        Replace the revocation list with the one of the DB, dropping the expired tokens
+
+        :return: void
+        """
+
+        now = int(time.time())
+        model = TokenRevocationModel()
+
+        model.delete_expired(now)
+        revoked = model.get_active(now)
+
+        if revoked is False:
+            return
+
+        with self.lock:
+            # Keep the local revocations not stored yet
+            self.revoked = {**{jti: exp for jti, exp in self.revoked.items() if exp > now}, **dict(revoked)}
+
+    def get_stats(self):
+        """
+        Get issued, verified and rejected tokens
+
+        :return: dict()
+        """
+
+        with self.lock:
+            return {"issued": self.issued, "verified": self.verified, "rejected": self.rejected, "revoked": len(self.revoked)}
+
+
+token_service = TokenService()
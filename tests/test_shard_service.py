@@ -0,0 +1,81 @@
+import unittest
+from unittest import mock
+
+from services.device_registry_service import DeviceRecord
+from services.device_service import DeviceService
+from services.shard_service import ShardService
+
+WORKERS = 4
+DEVICES = [DeviceRecord("device-" + str(number), "10.0.0." + str(number), "diy", None) for number in range(20)]
+
+
+class FakeDeviceManager:
+    """
+    Health seen by a worker: only the owner of a device knows its real circuit state
+    """
+
+    shards = None
+
+    def __init__(self, ip=None):
+        self.ip = ip
+
+    def get_types(self):
+        return []
+
+    def get_health(self):
+        device = next(device for device in DEVICES if device.ip == self.ip)
+
+        return {"circuit": "owner" if self.shards.ring.get_owner(device.id) == self.shards.index else "stale"}
+
+
+class ShardHealthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shards = ShardService()
+        self.shards.configure(0, WORKERS, "/tmp/djd-test-worker")
+
+        FakeDeviceManager.shards = self.shards
+
+        patches = [
+            mock.patch("services.device_service.shard_service", self.shards),
+            mock.patch("services.device_service.DeviceManager", FakeDeviceManager),
+            mock.patch("services.device_service.device_registry.get_all", return_value=DEVICES),
+            mock.patch.object(self.shards, "forward_to", side_effect=self.serve_on),
+        ]
+
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def serve_on(self, index, item):
+        """
+        Run a forwarded action as worker index would, on its serving thread
+        """
+
+        caller = self.shards.index
+        self.shards.index = index
+        self.shards.serving.active = True
+
+        try:
+            return DeviceService(use_db=False).run_owned(item)
+        finally:
+            self.shards.index = caller
+            self.shards.serving.active = False
+
+    def test_serving_answers_only_for_owned_devices(self):
+        res = self.serve_on(1, {"action": "health", "info": {}})
+        owned = [device.id for device in DEVICES if self.shards.ring.get_owner(device.id) == 1]
+
+        self.assertTrue(res["valid"])
+        self.assertCountEqual(res["info"].keys(), owned)
+
+    def test_merged_health_keeps_owner_state(self):
+        res = DeviceService(use_db=False).get_health()
+
+        self.assertTrue(res["valid"])
+        self.assertCountEqual(res["info"].keys(), [device.id for device in DEVICES])
+        self.assertEqual({health["circuit"] for health in res["info"].values()}, {"owner"})
+
+
+if __name__ == '__main__':
+    unittest.main()